@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Time absolute_urls on the html of the test-full posts
+
+Compares majestic's streaming implementation with the previous
+BeautifulSoup-based one, if beautifulsoup4 is installed.
+
+Usage:
+    PYTHONPATH=. python benchmarks/absolute_urls.py [repeats]
+"""
+
+import os
+from pathlib import Path
+import sys
+import timeit
+from urllib.parse import urljoin, urlparse
+
+import majestic
+from majestic.content import Post
+from majestic.utils import absolute_urls
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+TEST_FULL_DIR = REPO_DIR.joinpath('tests', 'test-full')
+
+
+def soup_absolute_urls(html, base_url):
+    """The previous BeautifulSoup-based implementation"""
+    from bs4 import BeautifulSoup
+    parsed_html = BeautifulSoup(html, 'html.parser')
+    for attr in ['href', 'src', 'poster']:
+        for tag in parsed_html.select('[{0}]'.format(attr)):
+            tag_url = tag[attr]
+            if not urlparse(tag_url).netloc:
+                tag[attr] = urljoin(base_url, tag_url)
+    return str(parsed_html)
+
+
+def main(repeats):
+    os.chdir(str(TEST_FULL_DIR))
+    settings = majestic.load_settings()
+    base_url = settings['site']['url']
+    html_list = [Post.from_file(file, settings).html
+                 for file in sorted(Path('posts').iterdir())]
+    total_kb = sum(len(html) for html in html_list) / 1024
+    print('{0} posts, {1:.1f} KiB of html, {2} repeats'.format(
+        len(html_list), total_kb, repeats))
+
+    implementations = [('streaming', absolute_urls)]
+    try:
+        import bs4  # noqa: F401
+        implementations.append(('beautifulsoup', soup_absolute_urls))
+    except ImportError:
+        print('beautifulsoup4 is not installed, skipping comparison')
+
+    timings = {}
+    for name, func in implementations:
+        timings[name] = min(timeit.repeat(
+            lambda: [func(html, base_url) for html in html_list],
+            number=repeats, repeat=5)) / repeats
+        print('{0:>14}: {1:.3f} ms per corpus'.format(
+            name, timings[name] * 1000))
+    if len(timings) == 2:
+        print('{0:>14}: {1:.1f}x'.format(
+            'speedup', timings['beautifulsoup'] / timings['streaming']))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
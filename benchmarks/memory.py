@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Measure the memory used by a synthetic corpus of posts
+
+Creates posts like those parsed from source files (with a source
+path, modification date and a few metadata fields), computes the
+attributes stored on them during a build (path part, output path,
+url and source hash) and reports the memory allocated per post,
+measured with tracemalloc. Bodies are kept short so that the figure
+is dominated by the objects themselves rather than their text.
+
+Usage:
+    PYTHONPATH=. python benchmarks/memory.py [number of posts]
+"""
+
+from datetime import datetime, timedelta
+import gc
+import os
+from pathlib import Path
+import sys
+import tracemalloc
+
+import majestic
+from majestic.content import Post
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+TEST_FULL_DIR = REPO_DIR.joinpath('tests', 'test-full')
+
+
+def make_posts(count, settings):
+    """Return count posts as a build would hold them"""
+    start = datetime(2010, 1, 1)
+    modified = datetime(2017, 1, 1)
+    posts = []
+    for n in range(count):
+        post = Post(title='Post number {0}'.format(n),
+                    body='Body {0}'.format(n),
+                    date=start + timedelta(minutes=n),
+                    source_path=Path('posts', 'post-{0}.md'.format(n)),
+                    modification_date=modified,
+                    settings=settings,
+                    author='Majestic', tags='benchmarks, memory')
+        post.url
+        post.output_path
+        post.source_hash = '{0:064x}'.format(n)
+        posts.append(post)
+    return posts
+
+
+def main(count):
+    os.chdir(str(TEST_FULL_DIR))
+    settings = majestic.load_settings()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    posts = make_posts(count, settings)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print('{0} posts: {1:.1f} MiB, {2:.0f} bytes per post'.format(
+        len(posts), used / 2 ** 20, used / len(posts)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Time sorting a synthetic corpus of posts
+
+Compares sorting with Post.sort_key as the key function (as majestic
+does) with sorting through Post.__lt__, and checks that both give the
+same order. Titles and dates are drawn from small pools so that many
+posts share a date and title and are ordered by slug.
+
+Usage:
+    PYTHONPATH=. python benchmarks/sorting.py [number of posts]
+"""
+
+from datetime import datetime, timedelta
+from operator import attrgetter
+import os
+from pathlib import Path
+import random
+import sys
+import time
+
+import majestic
+from majestic.content import Post
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+TEST_FULL_DIR = REPO_DIR.joinpath('tests', 'test-full')
+
+
+def make_posts(count, settings):
+    """Return count posts with shuffled dates, titles and slugs"""
+    rng = random.Random(0)
+    start = datetime(2010, 1, 1)
+    titles = ['Post number {0}'.format(n) for n in range(count // 10 + 1)]
+    posts = [
+        Post(title=rng.choice(titles).swapcase() if n % 2 else
+             rng.choice(titles),
+             slug='post-{0}'.format(n), body='',
+             date=start + timedelta(days=rng.randrange(count // 20 + 1)),
+             settings=settings)
+        for n in range(count)
+        ]
+    rng.shuffle(posts)
+    return posts
+
+
+def best_time(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(count):
+    os.chdir(str(TEST_FULL_DIR))
+    settings = majestic.load_settings()
+    posts = make_posts(count, settings)
+    print('{0} posts'.format(count))
+
+    by_comparison = sorted(posts, reverse=True)
+    by_key = sorted(posts, key=attrgetter('sort_key'), reverse=True)
+    assert [id(p) for p in by_key] == [id(p) for p in by_comparison]
+
+    timings = {
+        'comparison': best_time(lambda: sorted(posts, reverse=True)),
+        'sort key': best_time(
+            lambda: sorted(posts, key=attrgetter('sort_key'), reverse=True)),
+        }
+    for name, seconds in timings.items():
+        print('{0:>14}: {1:.1f} ms'.format(name, seconds * 1000))
+    print('{0:>14}: {1:.1f}x'.format(
+        'speedup', timings['comparison'] / timings['sort key']))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Measure the peak memory of a build with and without limits
+
+Writes a synthetic blog of posts with long bodies to a temporary
+directory (using the test-full templates) and builds it in full,
+first in one go, then in batches and then with a 1 MiB budget for
+html held in memory, reporting the peak memory allocated during each
+build as measured by tracemalloc.
+
+Usage:
+    PYTHONPATH=. python benchmarks/streaming.py [posts] [batch size]
+"""
+
+from datetime import datetime, timedelta
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+import majestic
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+TEST_FULL_DIR = REPO_DIR.joinpath('tests', 'test-full')
+
+PARAGRAPH = ('Lorem ipsum dolor sit amet, *consectetur* adipiscing elit, '
+             'sed do eiusmod tempor incididunt ut labore et dolore magna '
+             'aliqua. [Ut enim](/ad/minim/) veniam, quis nostrud.\n\n')
+
+
+def make_blog(directory, count):
+    """Write count posts, each with about 8 KiB of markdown"""
+    shutil.copytree(str(TEST_FULL_DIR.joinpath('templates')),
+                    str(directory.joinpath('templates')))
+    shutil.copy(str(TEST_FULL_DIR.joinpath('settings.json')),
+                str(directory))
+    posts = directory.joinpath('posts')
+    posts.mkdir()
+    directory.joinpath('pages').mkdir()
+    start = datetime(2010, 1, 1)
+    for n in range(count):
+        date = start + timedelta(days=n)
+        posts.joinpath('post-{0}.md'.format(n)).write_text(
+            'title: Post {0}\ndate: {1:%Y-%m-%d}\n\n{2}'.format(
+                n, date, PARAGRAPH * 40))
+
+
+def peak_memory(html_megabytes=None, **kwargs):
+    """Build the blog in the current directory, returning peak bytes"""
+    settings = majestic.load_settings()
+    settings['cache']['html memory megabytes'] = html_megabytes
+    shutil.rmtree(settings['paths']['output root'], ignore_errors=True)
+    tracemalloc.start()
+    majestic.process_blog(settings=settings, extensions=False,
+                          write_only_new=False, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main(count, batch_size):
+    directory = Path(tempfile.mkdtemp())
+    try:
+        make_blog(directory, count)
+        os.chdir(str(directory))
+        print('{0} posts'.format(count))
+        for name, kwargs in [('all at once', {}),
+                             ('batches of {0}'.format(batch_size),
+                              {'batch_size': batch_size}),
+                             ('html budget 1 MiB', {'html_megabytes': 1})]:
+            print('{0:>17}: {1:.1f} MiB peak'.format(
+                name, peak_memory(**kwargs) / 2 ** 20))
+    finally:
+        shutil.rmtree(str(directory))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 100)
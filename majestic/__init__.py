@@ -1,40 +1,69 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
+from functools import partial
 from http.server import HTTPServer, SimpleHTTPRequestHandler
+from operator import attrgetter
 import os
 from pathlib import Path
 import sys
 import tempfile
+import threading
+import traceback
 import webbrowser
 
-from docopt import docopt
+from docopt import docopt, DocoptExit
 import pytz
 
-from majestic.collections import Archives, Index, RSSFeed, JSONFeed, Sitemap
-from majestic.content import Page, Post, DraftError
+from majestic.cache import ContentCache
+from majestic.collections import (
+    Archives, Feed, Index, RSSFeed, JSONFeed, Sitemap, SortedPosts
+    )
+from majestic.content import Content, Page, Post
+# Re-exported so that majestic.DraftError can be caught by callers
+from majestic.content import DraftError  # noqa: F401
+import majestic.daemon as daemon
 from majestic.extensions import (
-    ExtensionStage, load_extensions, apply_extensions
+    ExtensionStage, load_extensions, reload_extensions, apply_extensions
+    )
+import majestic.git as git
+from majestic.manifest import BuildManifest, listing_fingerprint
+import majestic.md as md
+from majestic.parallel import (
+    parse_content_files, render_html, render_pool, render_to_disk
     )
 from majestic.resources import copy_resources
-from majestic.templating import jinja_environment
-from majestic.utils import markdown_files, load_settings
+from majestic.templating import (
+    compile_templates, jinja_environment, prune_bytecode_cache
+    )
+from majestic.utils import (
+    chunk, fsync_files, markdown_files, load_settings
+    )
+import majestic.watch as watch
 
 __version__ = '0.4.2'
 
 
 def process_blog(*, settings, write_only_new=True,
                  posts=True, pages=True, index=True, archives=True,
-                 feeds=True, sitemap=True, extensions=True):
+                 feeds=True, sitemap=True, extensions=True, jobs=1,
+                 lazy=False, since_git=False, content_cache=None,
+                 environment=None, batch_size=None):
     """Create output files from the blog's source
 
     By default, create the entire blog. Certain parts can
     be disabled by setting their corresponding parameter
     to False.
 
-    By default, only Pages and Posts that are considered new (by
-    checking content.is_new) are written out. This can be overridden
-    by passing False to write_only_new.
+    By default, only Pages and Posts whose source file, templates or
+    the site's settings have changed since they were last written
+    (as recorded in the build manifest in the output root, see
+    majestic.manifest), or whose is_new property has been set to True
+    (such as by an extension), are written out. Likewise index pages,
+    archives and feeds are written only if the posts they show, their
+    templates, the settings or the titles and urls of the site's posts
+    and pages have changed. This can be overridden by passing False to
+    write_only_new.
 
     Sitemap can be created by itself but will raise if the first index,
     or any of the page or post output files don't exist. This is because
@@ -42,90 +71,402 @@ def process_blog(*, settings, write_only_new=True,
 
     If extensions is False, posts and pages are not processed with any
     extension modules present in the extensions directory.
+
+    jobs sets the number of processes used to parse the source files,
+    to convert the markdown of the posts and pages to be written and
+    to render the output files. If it is 0 or None, one process per
+    CPU is used. Objects created by extensions are always rendered
+    in the main process. The same workers convert and render every
+    batch (see batch_size below).
+
+    If cache -> parsed content is true in settings, parsed posts and
+    pages are stored in the cache root directory and reused on later
+    runs for source files whose size and modification time are
+    unchanged.
+
+    If cache -> rendered html is true in settings, html converted from
+    markdown is stored in the cache root directory and reused for
+    unchanged text. Old entries are removed at the end of the build.
+
+    If jinja -> bytecode cache is set, compiled templates are stored
+    and reused on later runs, and entries for templates that no longer
+    exist are removed at the end of the build.
+
+    If output -> write only if changed is true in settings, files whose
+    contents would not change are left untouched, keeping their
+    modification times, and the number of files skipped is reported
+    on stderr.
+
+    Output files are replaced atomically, so a crash or a web server
+    reading from the output root never sees a partly written file.
+    output -> fsync in settings sets when they are flushed to disk:
+        "none":     left to the operating system
+        "file":     as each file is written
+        "batch":    all at once at the end of the build (only the
+                    files written by the build, and their directories)
+
+    content_cache can be a majestic.cache.ContentCache to use instead
+    of the one set up by cache -> parsed content (such as an in-memory
+    cache kept between builds by the preview server), and environment
+    can be a Jinja2 Environment (see majestic.templating) to use instead
+    of creating a new one, so that compiled templates are kept between
+    builds (as by the build daemon, see majestic.daemon).
+
+    If lazy is True, only the metadata header of each source file is
+    read up front, and bodies are read when they are first needed.
+    This saves time and memory when building only some of the site,
+    such as when only the archives or the sitemap are written.
+
+    If batch_size is given, the build streams through the site to keep
+    its memory use bounded: sources are read lazily (as above, and
+    as are posts and pages taken from the parsed content cache), and
+    output files are converted and written batch_size at a time. After
+    each batch, the bodies and html of the posts and pages involved
+    are discarded (see Content.release), leaving only their metadata,
+    and are read again from the source files if a later index page
+    or feed needs them. Enabling cache -> rendered html avoids
+    converting those bodies to html a second time.
+
+    Alternatively, setting cache -> html memory megabytes limits the
+    converted html kept in memory during the build, discarding the
+    least recently used html beyond that budget (see
+    majestic.md.get_html_budget). The budget is reset when the build
+    finishes, whether or not it succeeds.
+
+    If since_git is True, the content root must be in a git repository
+    (git.GitError is raised if not, or if git can't be run).
+    The source files are listed by git rather than by walking the
+    content directory, and the commit checked out is recorded in the
+    build manifest. On the next build with since_git, only files that
+    git reports as changed since that commit, or that had uncommitted
+    changes at the time, are checked: the others are taken from the
+    parsed content cache and their source hashes from the build
+    manifest, without looking at the files. The parsed content cache is
+    used by since_git builds whether or not cache -> parsed content is
+    set, as without it every file would be parsed. The commit is only
+    recorded by builds that write both posts and pages. Only the local
+    repository is used.
     """
-    content_dir = Path(settings['paths']['content root'])
-    posts_dir = content_dir.joinpath(settings['paths']['posts subdir'])
-    pages_dir = content_dir.joinpath(settings['paths']['pages subdir'])
-
-    env = jinja_environment(
-        user_templates=settings['paths']['templates root'],
-        settings=settings
-        )
-
-    post_filenames = markdown_files(posts_dir)
-    page_filenames = markdown_files(pages_dir)
-
-    posts_list = []
-    pages_list = []
-    for class_, file_list, obj_list in [(Post, post_filenames, posts_list),
-                                        (Page, page_filenames, pages_list)]:
-        for fn in file_list:
+    try:
+        content_dir = Path(settings['paths']['content root'])
+        posts_dir = content_dir.joinpath(settings['paths']['posts subdir'])
+        pages_dir = content_dir.joinpath(settings['paths']['pages subdir'])
+
+        env = environment
+        if env is None:
+            env = jinja_environment(
+                user_templates=settings['paths']['templates root'],
+                settings=settings
+                )
+        manifest = BuildManifest.load(
+            user_templates=settings['paths']['templates root'],
+            settings=settings)
+
+        if batch_size is not None:
+            lazy = True
+
+        changed_files = None
+        if since_git:
             try:
-                obj_list.append(class_.from_file(fn, settings))
-            except DraftError:
-                print('{file} is marked as a draft'.format(file=fn),
-                      file=sys.stderr)
-
-    posts_list.sort(reverse=True)
-    pages_list.sort()
-
-    objects_to_write = []
-
-    extensions_loaded = False
-    if extensions:
-        extensions_dir = Path(settings['paths']['extensions root'])
-        if extensions_dir.exists():
-            modules = load_extensions(extensions_dir)
-            extensions_loaded = True
-            processed = apply_extensions(
-                modules=modules, stage=ExtensionStage.posts_and_pages,
-                pages=pages_list, posts=posts_list, settings=settings)
-            posts_list = processed['posts']
-            pages_list = processed['pages']
-            objects_to_write.extend(processed['new_objects'])
-
-    content_objects = []
-    if posts:
-        content_objects.extend(posts_list)
-    if pages:
-        content_objects.extend(pages_list)
-    if write_only_new:
-        content_objects = [c for c in content_objects if c.is_new]
-    objects_to_write.extend(content_objects)
-
-    if index:
-        indexes = Index.paginate_posts(posts=posts_list, settings=settings)
-        objects_to_write.extend(indexes)
-
-    if archives:
-        objects_to_write.append(Archives(posts=posts_list, settings=settings))
-
-    if feeds:
-        objects_to_write.append(RSSFeed(posts=posts_list, settings=settings))
-        objects_to_write.append(JSONFeed(posts=posts_list, settings=settings))
-
-    if extensions_loaded:
-        processed = apply_extensions(
-            modules=modules, stage=ExtensionStage.objects_to_write,
-            objects=objects_to_write, settings=settings)
-        objects_to_write = processed['objects']
-
-    for obj in objects_to_write:
-        obj.render_to_disk(environment=env,
-                           build_date=datetime.now(tz=pytz.utc),
-                           all_posts=posts_list, all_pages=pages_list)
-
-    if sitemap:
+                post_filenames = git.markdown_files(posts_dir)
+                page_filenames = git.markdown_files(pages_dir)
+                head_commit = git.head_commit(content_dir)
+                # Files that differ from the commit are checked again next
+                # time, as git can't tell if they revert to the committed text
+                uncommitted = git.changed_files(content_dir, head_commit)
+            except git.GitError as error:
+                raise git.GitError(
+                    'Could not list the source files with git: {0}'.format(
+                        error)) from error
+            if manifest.git_commit is not None:
+                try:
+                    changed_files = git.changed_files(content_dir,
+                                                      manifest.git_commit)
+                except git.GitError as error:
+                    print('Checking every file as git could not compare with '
+                          'the last build: {0}'.format(error), file=sys.stderr)
+                else:
+                    changed_files |= manifest.git_uncommitted
+        else:
+            post_filenames = markdown_files(posts_dir)
+            page_filenames = markdown_files(pages_dir)
+
+        # since_git relies on the cache to skip parsing unchanged files
+        if content_cache is None and (settings['cache']['parsed content']
+                                      or since_git):
+            content_cache = ContentCache.load(
+                directory=settings['paths']['cache root'], settings=settings)
+
+        posts_list = parse_content_files(Post, post_filenames, settings,
+                                         jobs=jobs, cache=content_cache,
+                                         lazy=lazy, changed=changed_files)
+        pages_list = parse_content_files(Page, page_filenames, settings,
+                                         jobs=jobs, cache=content_cache,
+                                         lazy=lazy, changed=changed_files)
+
+        if content_cache is not None:
+            content_cache.save()
+
+        # Shared by the collections, so the posts aren't sorted again
+        sorted_posts = SortedPosts(posts_list)
+        posts_list = list(sorted_posts)
+        pages_list.sort(key=attrgetter('sort_key'))
+
+        objects_to_write = []
+        # Objects created by extensions are rendered in this process
+        extension_objects = []
+
+        extensions_loaded = False
+        if extensions:
+            extensions_dir = Path(settings['paths']['extensions root'])
+            if extensions_dir.exists():
+                modules = load_extensions(extensions_dir)
+                extensions_loaded = True
+                processed = apply_extensions(
+                    modules=modules, stage=ExtensionStage.posts_and_pages,
+                    pages=pages_list, posts=posts_list, settings=settings)
+                posts_list = processed['posts']
+                pages_list = processed['pages']
+                objects_to_write.extend(processed['new_objects'])
+                extension_objects.extend(processed['new_objects'])
+                # Extensions may have added, removed or changed posts
+                sorted_posts = SortedPosts(posts_list)
+
+        content_objects = []
+        if posts:
+            content_objects.extend(posts_list)
+        if pages:
+            content_objects.extend(pages_list)
+        for c in posts_list + pages_list:
+            if (changed_files is not None
+                    and c.source_path not in changed_files):
+                # Use the recorded hashes of files git reports as unchanged
+                recorded = manifest.recorded_source_hash(c)
+            else:
+                # Or of files whose size and modification time are the same
+                recorded = manifest.unchanged_source_hash(c)
+            if recorded is not None:
+                c.source_hash = recorded
+        manifest.listing = listing_fingerprint(posts_list, pages_list)
+
+        collections = []
         if index:
-            front_page = indexes[0]
+            indexes = Index.paginate_posts(posts=sorted_posts,
+                                           settings=settings)
+            collections.extend(indexes)
+
+        if archives:
+            collections.extend(Archives.partition_posts(posts=sorted_posts,
+                                                        settings=settings))
+
+        if feeds:
+            collections.append(RSSFeed(posts=sorted_posts, settings=settings))
+            collections.append(JSONFeed(posts=sorted_posts, settings=settings))
+
+        if write_only_new:
+            content_objects = [c for c in content_objects
+                               if c.marked_new or manifest.is_stale(c)]
+            collections = [c for c in collections if manifest.is_stale(c)]
+        objects_to_write.extend(content_objects)
+        objects_to_write.extend(collections)
+
+        if extensions_loaded:
+            built_ids = {id(obj) for obj in objects_to_write}
+            processed = apply_extensions(
+                modules=modules, stage=ExtensionStage.objects_to_write,
+                objects=objects_to_write, settings=settings)
+            objects_to_write = processed['objects']
+            extension_objects.extend(obj for obj in objects_to_write
+                                     if id(obj) not in built_ids)
+
+        if batch_size is None:
+            batches = [objects_to_write]
         else:
-            # Create dummy front so the sitemap can be generated by itself
-            front_page = Index(page_number=1, posts=[], settings=settings)
-            if not Index.output_path.exists():
-                Index.output_path.touch()
-        content_list = posts_list + pages_list + [front_page]
-        sitemap = Sitemap(content=content_list, settings=settings)
-        sitemap.render_to_disk(environment=env)
+            batches = chunk(objects_to_write, chunk_length=batch_size)
+        build_date = datetime.now(tz=pytz.utc)
+        render_kwargs = dict(build_date=build_date, all_posts=posts_list,
+                             all_pages=pages_list)
+        written = []
+        # Paths of files written, to flush to disk at the end of the build
+        fsync_batch = settings['output']['fsync'] == 'batch'
+        written_paths = []
+        # One pool of workers is shared by every batch
+        pool = render_pool(settings, jobs=jobs, **render_kwargs)
+        try:
+            for batch in batches:
+                # Convert markdown for everything in the batch up front,
+                # so the work can be shared among several processes
+                html_content = []
+                feed_content = []
+                for obj in batch:
+                    if isinstance(obj, Content):
+                        html_content.append(obj)
+                    elif isinstance(obj, (Index, Feed)):
+                        html_content.extend(obj.posts)
+                    if isinstance(obj, Feed):
+                        feed_content.extend(obj.posts)
+                render_html(html_content, settings=settings, jobs=jobs,
+                            executor=pool)
+                # Make feed html here, so the RSS and JSON feeds share it
+                # even when sent to different worker processes
+                for post in feed_content:
+                    post.feed_html
+
+                results = render_to_disk(
+                    batch, environment=env, settings=settings, jobs=jobs,
+                    serial=extension_objects, executor=pool,
+                    **render_kwargs)
+                written.extend(results)
+                if fsync_batch:
+                    written_paths.extend(
+                        obj.output_path
+                        for obj, result in zip(batch, results)
+                        if result is not False)
+                for obj in batch:
+                    manifest.record(obj)
+                if batch_size is not None:
+                    for obj in html_content:
+                        obj.release()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        if since_git and posts and pages:
+            # Only record the commit once every source file has been checked,
+            # so that changes to files skipped by this build are found later
+            manifest.git_commit = head_commit
+            manifest.git_uncommitted = uncommitted
+        manifest.save()
+        written_paths.append(manifest.path)
+
+        if sitemap:
+            if index:
+                front_page = indexes[0]
+            else:
+                # Create dummy front so the sitemap can be generated by itself
+                front_page = Index(page_number=1, posts=[], settings=settings)
+                if not Index.output_path.exists():
+                    Index.output_path.touch()
+            content_list = posts_list + pages_list + [front_page]
+            sitemap = Sitemap(content=content_list, settings=settings)
+            written.append(sitemap.render_to_disk(environment=env))
+            if written[-1] is not False:
+                written_paths.append(sitemap.output_path)
+
+        if settings['output']['write only if changed']:
+            skipped = written.count(False)
+            print('Skipped writing {0} unchanged file{1}'.format(
+                skipped, '' if skipped == 1 else 's'), file=sys.stderr)
+
+        if fsync_batch:
+            fsync_files(written_paths)
+
+        md.prune_html_cache(settings)
+        prune_bytecode_cache(env)
+    finally:
+        # Drop references to this build's content, even if it failed
+        md.reset_html_budget()
+
+
+def watch_and_rebuild(*, settings, reload_settings, build,
+                      settings_files=(), content_cache=None, watcher=None):
+    """Rebuild the blog whenever its source changes, until interrupted
+
+    settings:           dictionary containing the site's settings
+    reload_settings:    function that returns freshly loaded settings
+    build:              function that builds the site, called with the
+                        settings and a ContentCache
+    settings_files:     iterable of paths to the settings files in use
+    content_cache:      in-memory ContentCache holding the posts and
+                        pages already parsed, or None to start afresh
+    watcher:            object with changes and close methods (see
+                        majestic.watch), or None to watch the source
+                        paths given by settings and settings_files
+
+    Parsed posts and pages are kept in memory between builds, so
+    only changed files are parsed again. If a settings file changes,
+    the settings are reloaded and the cache is discarded. If a module
+    in the extensions directory changes, the extension modules are
+    reloaded. Errors raised while reloading or building are printed
+    and the next change is waited for, so that a mistake in the
+    settings, an extension, a post or a template doesn't stop the
+    preview. The same goes for SystemExit raised by build with a
+    message, which is printed without a traceback.
+    """
+    settings_files = [Path(file).resolve() for file in settings_files]
+    if content_cache is None:
+        content_cache = ContentCache(directory=None, settings=settings)
+    own_watcher = watcher is None
+    if own_watcher:
+        watcher = watch.make_watcher(
+            watch.source_paths(settings, settings_files))
+    try:
+        while True:
+            changed = watcher.changes()
+            if not changed:
+                continue
+            try:
+                if not changed.isdisjoint(settings_files):
+                    settings = reload_settings()
+                    content_cache = ContentCache(directory=None,
+                                                 settings=settings)
+                    md.reset_cached_markdown()
+                    if own_watcher:
+                        # Replace the watcher only once the new one exists,
+                        # so a failure leaves the old one watching
+                        new_watcher = watch.make_watcher(
+                            watch.source_paths(settings, settings_files))
+                        watcher.close()
+                        watcher = new_watcher
+
+                extensions_dir = Path(
+                    settings['paths']['extensions root']).resolve()
+                if any(extensions_dir in path.parents for path in changed):
+                    reload_extensions(extensions_dir)
+                    md.reset_cached_markdown()
+
+                print('Rebuilding after changes to {0} file(s)'.format(
+                    len(changed)), file=sys.stderr)
+                build(settings, content_cache)
+            except SystemExit as exit:
+                # Raised by build for errors reported without a traceback
+                if exit.code is not None and not isinstance(exit.code, int):
+                    print(exit.code, file=sys.stderr)
+            except Exception:
+                traceback.print_exc()
+    finally:
+        if own_watcher:
+            watcher.close()
+
+
+def _jobs(args):
+    """Return the --jobs option as an int
+
+    DocoptExit is raised if it is not a whole number of at least 0.
+    """
+    try:
+        jobs = int(args['--jobs'])
+    except ValueError:
+        jobs = -1
+    if jobs < 0:
+        raise DocoptExit('--jobs must be a whole number of at least 0')
+    return jobs
+
+
+def _batch_size(args):
+    """Return the --batch-size option as an int, or None if not given
+
+    DocoptExit is raised if it is not a whole number of at least 1.
+    """
+    value = args['--batch-size']
+    if value is None:
+        return None
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise DocoptExit('--batch-size must be a whole number of at least 1')
+    return size
 
 
 def main(argv):
@@ -136,6 +477,8 @@ Majestic - a simple static blog generator
 Usage:
     majestic [options]
     majestic preview [--port=PORT] [options]
+    majestic compile-templates [options]
+    majestic serve-builds [--socket=PATH] [options]
     majestic (-h | --help)
     majestic --version
 
@@ -145,9 +488,20 @@ Options:
 
     -d DIR, --blog-dir=DIR  Path to blog directory. [default: .]
     -f, --force-write       Write all files no matter the modification date.
+    -j N, --jobs=N          Number of processes to use when building.
+                            0 uses one process per CPU. [default: 1]
+    --lazy                  Read post and page bodies only when needed.
+    --batch-size=N          Write N files at a time, releasing post bodies
+                            between batches to limit memory use.
+    -c, --only-changed      Don't rewrite files whose contents are unchanged.
+    --since-git             Use git to find the files changed since the
+                            last build, and parse only those files (using
+                            the parsed content cache for the others).
 
     -p PORT, --port=PORT    Port on which to start the preview server.
                             [default: 8451]
+    --socket=PATH           Unix socket on which the build daemon listens.
+                            [default: .majestic-build.sock]
 
     -s CFG, --settings=CFG  Use the specified settings file.
     --no-defaults           Ignore Majestic's default settings.
@@ -168,6 +522,8 @@ Options:
                             --no-resources is given).
     '''
     args = docopt(doc=usage, argv=argv, version=__version__)
+    _jobs(args)
+    _batch_size(args)
 
     # Ensure the working directory is the blog directory
     os.chdir(args['--blog-dir'])
@@ -176,51 +532,122 @@ Options:
     if args['--settings'] is not None:
         custom_config = [args['--settings']]
     else:
-        custom_config = None
-    settings = load_settings(default=not args['--no-defaults'],
-                             local=not args['--no-locals'],
-                             files=custom_config)
-
-    # Modify settings to allow preview server
+        custom_config = []
+    settings_files = list(custom_config)
+    if not args['--no-locals']:
+        settings_files.append('settings.json')
     if args['preview']:
-        # URLs under our control should be relative
-        settings['site']['url'] = '/'
         temp_dir = tempfile.TemporaryDirectory()
-        settings['paths']['output root'] = temp_dir.name
-        # Symlink resources instead of copying
-        args['--link-resources'] = True
 
-    # Invert --skip-* options in args
-    # A bit unwieldy, but better than having skip_* params to process_blog
-    process_options = {k[7:]: not v for k, v in args.items()
-                       if k.find('--skip-') != -1}
-
-    # Set whether extensions should be used (same logic as skipping)
-    process_options['extensions'] = not args['--no-extensions']
+    def configure():
+        """Load settings and apply the command-line overrides"""
+        settings = load_settings(default=not args['--no-defaults'],
+                                 local=not args['--no-locals'],
+                                 files=list(custom_config))
+        if args['--only-changed']:
+            settings['output']['write only if changed'] = True
+        # Modify settings to allow preview server
+        if args['preview']:
+            # URLs under our control should be relative
+            settings['site']['url'] = '/'
+            settings['paths']['output root'] = temp_dir.name
+        return settings
+
+    settings = configure()
+
+    if args['compile-templates']:
+        bundle = compile_templates(
+            user_templates=settings['paths']['templates root'],
+            settings=settings)
+        print('Compiled templates to {0}'.format(bundle), file=sys.stderr)
+        return
+
+    # Symlink resources instead of copying when previewing
+    if args['preview']:
+        args['--link-resources'] = True
 
-    process_blog(settings=settings,
-                 write_only_new=not args['--force-write'],
-                 **process_options)
+    def build(settings, content_cache=None, environment=None, args=args):
+        # Invert --skip-* options in args
+        # A bit unwieldy, but better than having skip_* params to process_blog
+        process_options = {k[7:]: not v for k, v in args.items()
+                           if k.find('--skip-') != -1}
 
-    if not args['--no-resources']:
-        copy_resources(resources=settings['resources'],
-                       output_root=settings['paths']['output root'],
-                       use_symlinks=args['--link-resources'])
+        # Set whether extensions should be used (same logic as skipping)
+        process_options['extensions'] = not args['--no-extensions']
 
-    # Change to temp directory and start web server
-    if args['preview']:
-        os.chdir(temp_dir.name)
-        port = int(args['--port'])
-        url = 'http://localhost:{0}'.format(port)
-        httpd = HTTPServer(
-            server_address=('', port),
-            RequestHandlerClass=SimpleHTTPRequestHandler)
         try:
-            print('Starting Majestic preview server at {0}'.format(url),
-                  file=sys.stderr)
-            webbrowser.get(settings['preview']['browser']).open(url)
-            httpd.serve_forever()
+            process_blog(settings=settings,
+                         write_only_new=not args['--force-write'],
+                         jobs=_jobs(args),
+                         lazy=args['--lazy'],
+                         since_git=args['--since-git'],
+                         batch_size=_batch_size(args),
+                         content_cache=content_cache,
+                         environment=environment,
+                         **process_options)
+        except git.GitError as error:
+            # Report problems with the repository without a traceback
+            raise SystemExit('majestic: {0}'.format(error))
+        if not args['--no-resources']:
+            copy_resources(resources=settings['resources'],
+                           output_root=settings['paths']['output root'],
+                           use_symlinks=args['--link-resources'])
+
+    if args['serve-builds']:
+        def build_request(settings, argv, content_cache, environment):
+            request = docopt(doc=usage, argv=argv, version=__version__)
+            if request['preview'] or request['compile-templates'] or \
+                    request['serve-builds']:
+                raise SystemExit('Only builds can be requested')
+            # The blog directory and settings options are fixed when the
+            # daemon starts, and --only-changed applies to this build only
+            output = settings['output']
+            configured = output['write only if changed']
+            output['write only if changed'] = (configured or
+                                               request['--only-changed'])
+            try:
+                build(settings, content_cache, environment, args=request)
+            finally:
+                output['write only if changed'] = configured
+
+        builder = daemon.BuildDaemon(configure=configure,
+                                     build=build_request,
+                                     settings_files=settings_files)
+        print('Listening for builds on {0}'.format(args['--socket']),
+              file=sys.stderr)
+        try:
+            daemon.serve(builder, args['--socket'])
         except KeyboardInterrupt:
-            print('Shutting down webserver.', file=sys.stderr)
-            httpd.socket.close()
-            temp_dir.cleanup()
+            print('Shutting down build daemon.', file=sys.stderr)
+        finally:
+            builder.close()
+        return
+
+    if not args['preview']:
+        build(settings)
+        return
+
+    # Build into the temp directory, serve it from a separate thread
+    # and rebuild whenever the source changes
+    content_cache = ContentCache(directory=None, settings=settings)
+    build(settings, content_cache)
+    port = int(args['--port'])
+    url = 'http://localhost:{0}'.format(port)
+    httpd = HTTPServer(
+        server_address=('', port),
+        RequestHandlerClass=partial(SimpleHTTPRequestHandler,
+                                    directory=temp_dir.name))
+    server = threading.Thread(target=httpd.serve_forever, daemon=True)
+    server.start()
+    try:
+        print('Starting Majestic preview server at {0}'.format(url),
+              file=sys.stderr)
+        webbrowser.get(settings['preview']['browser']).open(url)
+        watch_and_rebuild(settings=settings, reload_settings=configure,
+                          build=build, settings_files=settings_files,
+                          content_cache=content_cache)
+    except KeyboardInterrupt:
+        print('Shutting down webserver.', file=sys.stderr)
+        httpd.shutdown()
+        httpd.server_close()
+        temp_dir.cleanup()
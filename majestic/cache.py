@@ -0,0 +1,323 @@
+from collections import OrderedDict
+import copy
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import pickle
+import sys
+import time
+
+
+class _SettingsPickler(pickle.Pickler):
+    """Pickler that stores a reference in place of the settings dictionary
+
+    Every Content object holds a reference to the site's settings,
+    which shouldn't be stored in the cache: it would be duplicated
+    in every entry and would override any changes made to the
+    settings since the entry was written.
+    """
+    def __init__(self, file, settings):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._settings = settings
+
+    def persistent_id(self, obj):
+        if obj is self._settings:
+            return 'settings'
+        return None
+
+
+class _SettingsUnpickler(pickle.Unpickler):
+    """Unpickler that restores references to the settings dictionary"""
+    def __init__(self, file, settings):
+        super().__init__(file)
+        self._settings = settings
+
+    def persistent_load(self, pid):
+        if pid == 'settings':
+            return self._settings
+        raise pickle.UnpicklingError('Unknown persistent id: {0}'.format(pid))
+
+
+def dumps_with_settings(obj, settings):
+    """Pickle obj to bytes, leaving out the settings dictionary"""
+    buffer = io.BytesIO()
+    _SettingsPickler(buffer, settings).dump(obj)
+    return buffer.getvalue()
+
+
+def loads_with_settings(data, settings):
+    """Unpickle obj from bytes, restoring references to settings"""
+    return _SettingsUnpickler(io.BytesIO(data), settings).load()
+
+
+def _write_pickle(obj, path):
+    """Pickle obj to path, replacing any existing file in one step"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(path.name + '.tmp')
+    with temp_path.open('wb') as file:
+        pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(str(temp_path), str(path))
+
+
+class ContentCache(object):
+    """On-disk cache of Content objects parsed from source files
+
+    Entries are keyed on the Content subclass and the path of the
+    source file, and are only used while the file's size and
+    modification time are unchanged. Each entry is the object as it
+    was immediately after parsing, so it holds the parsed metadata
+    and the computed slug and (for posts) date. The body is left out
+    if it was read from the source file, and is read again from the
+    file when first needed (as with lazily loaded content), so that
+    neither the cache nor the objects taken from it hold the bodies
+    of posts and pages that a build doesn't use.
+
+    Drafts are never cached, so that posts with a future date are
+    published once that date has passed.
+
+    The whole cache is discarded if the date settings change, as
+    these affect how post dates are parsed, or if it was written in
+    a different format (see format_version). An entry that can't be
+    unpickled is treated as missing.
+
+    Only entries that have been used or added since the cache was
+    loaded are kept when it is saved, so files that have been
+    deleted don't linger in the cache.
+
+    A cache created with directory None is kept only in memory, and
+    can be used for several builds in the same process (saving it
+    keeps the entries used in one build for the next).
+    """
+    filename = 'content.pickle'
+    # Increase when the pickled form of Content objects changes
+    format_version = 3
+
+    def __init__(self, directory, settings):
+        """Initialise an empty ContentCache
+
+        directory:  path to the cache root directory, or None
+        settings:   dictionary containing the site's settings
+        """
+        self.path = (None if directory is None
+                     else Path(directory).joinpath(self.filename))
+        self._settings = settings
+        self._fingerprint = json.dumps(
+            {'format': self.format_version, 'dates': settings['dates']},
+            sort_keys=True)
+        self._stored = {}
+        self._entries = {}
+        self._identities = {}
+
+    @classmethod
+    def load(cls, directory, settings):
+        """Return a ContentCache holding the entries stored in directory
+
+        If the cache file doesn't exist, can't be read or was written
+        with different date settings or in a different format, the
+        returned cache is empty.
+        """
+        cache = cls(directory=directory, settings=settings)
+        try:
+            with cache.path.open('rb') as file:
+                fingerprint, entries = pickle.load(file)
+        except (OSError, EOFError, ValueError, TypeError, AttributeError,
+                ImportError, pickle.UnpicklingError):
+            return cache
+        if fingerprint == cache._fingerprint:
+            cache._stored = entries
+        return cache
+
+    def save(self):
+        """Keep only the entries used since the cache was last saved
+
+        The entries are written to disk unless the cache is kept
+        only in memory.
+        """
+        if self.path is not None:
+            _write_pickle((self._fingerprint, self._entries), self.path)
+        self._stored, self._entries = self._entries, {}
+
+    @staticmethod
+    def _key(class_, file):
+        return (class_.__name__, str(file))
+
+    def get(self, class_, file, trust=False):
+        """Return the cached class_ object for file or None
+
+        The file's size and modification time are recorded, so that
+        a subsequent call to put stores them with the parsed object.
+
+        If trust is True, file is known not to have changed (see
+        majestic.git), so any entry for it is returned without
+        checking its size and modification time.
+        """
+        key = self._key(class_, file)
+        entry = self._stored.get(key)
+        if not trust or entry is None:
+            stat = file.stat()
+            identity = (stat.st_size, stat.st_mtime_ns)
+            self._identities[key] = identity
+            if entry is None or entry[0] != identity:
+                return None
+        try:
+            content = loads_with_settings(entry[1], self._settings)
+        except Exception:
+            # Unusable (such as written by an older version of majestic)
+            del self._stored[key]
+            return None
+        self._entries[key] = entry
+        return content
+
+    def put(self, class_, file, content):
+        """Store content, a class_ object freshly parsed from file"""
+        key = self._key(class_, file)
+        identity = self._identities.pop(key, None)
+        if identity is None:
+            stat = file.stat()
+            identity = (stat.st_size, stat.st_mtime_ns)
+        if getattr(content, '_from_source', False):
+            # The body can be read from file, which is unchanged
+            content = copy.copy(content)
+            content._body = None
+        entry = (identity, dumps_with_settings(content, self._settings))
+        self._entries[key] = entry
+        self._stored[key] = entry
+
+
+class HTMLCache(object):
+    """On-disk cache of html rendered from markdown text
+
+    Each entry is stored in its own file, named after a hash of the
+    markdown text combined with a fingerprint of the configuration
+    used to render it (see majestic.md.markdown_fingerprint), so a
+    change to the configuration means no existing entry is used.
+
+    Reading an entry updates its modification time, which prune uses
+    to decide which entries to remove first.
+    """
+    suffix = '.html'
+
+    def __init__(self, directory, fingerprint):
+        """Initialise HTMLCache
+
+        directory:      path to the directory in which to store entries
+        fingerprint:    str identifying the markdown configuration
+        """
+        self.directory = Path(directory)
+        self._fingerprint = fingerprint
+
+    def _path(self, text):
+        """Return the path of the entry for markdown text"""
+        key = '{0}\0{1}'.format(self._fingerprint, text)
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return self.directory.joinpath(digest[:2], digest + self.suffix)
+
+    def get(self, text):
+        """Return the cached html for markdown text, or None"""
+        path = self._path(text)
+        try:
+            with path.open(encoding='utf-8', newline='') as file:
+                html = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(str(path))
+        except FileNotFoundError:   # Removed by a concurrent prune
+            pass
+        return html
+
+    def put(self, text, html):
+        """Store html rendered from markdown text"""
+        path = self._path(text)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Unique temporary name, as worker processes may share the cache
+        temp_path = path.with_name('{0}.{1}.tmp'.format(path.name,
+                                                        os.getpid()))
+        with temp_path.open('w', encoding='utf-8', newline='') as file:
+            file.write(html)
+        os.replace(str(temp_path), str(path))
+
+    def prune(self, max_bytes=None, max_age=None):
+        """Remove entries that are too old or exceed the size limit
+
+        max_bytes:  int, total size of entries to keep (or None)
+        max_age:    int, seconds since an entry was last used (or None)
+
+        Entries are removed least recently used first.
+        """
+        entries = []
+        for path in self.directory.glob('*/*' + self.suffix):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort(reverse=True)      # Most recently used first
+
+        now = time.time()
+        total = 0
+        for mtime, size, path in entries:
+            total += size
+            too_old = max_age is not None and now - mtime > max_age
+            too_big = max_bytes is not None and total > max_bytes
+            if too_old or too_big:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+
+class HTMLBudget(object):
+    """Least-recently-used limit on the html held by content objects
+
+    Content objects keep the html converted from their bodies (see
+    Content.html). An HTMLBudget records which objects hold converted
+    html, and how much, in the order they were last used. When the
+    total exceeds max_bytes, the html of the least recently used
+    objects is discarded, to be converted again (or read from the
+    html render cache, if enabled) when next accessed.
+
+    Only html converted from an object's body is recorded: html set
+    directly can't be recomputed, so it is never discarded.
+    """
+    def __init__(self, max_bytes):
+        """Initialise HTMLBudget
+
+        max_bytes:  int, total size of html to keep in memory
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()   # id(content): (content, size)
+
+    def add(self, content, html):
+        """Record that content holds html, discarding older html if needed
+
+        The html of content itself is kept even if it alone exceeds
+        max_bytes, as it is about to be used.
+        """
+        self.discard(content)
+        size = sys.getsizeof(html)
+        self._entries[id(content)] = (content, size)
+        self.size += size
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            oldest, oldest_size = self._entries.popitem(last=False)[1]
+            self.size -= oldest_size
+            oldest._evict_html()
+
+    def touch(self, content):
+        """Mark content's html as the most recently used"""
+        try:
+            self._entries.move_to_end(id(content))
+        except KeyError:
+            pass
+
+    def discard(self, content):
+        """Stop recording content's html (as when it has been replaced)"""
+        entry = self._entries.pop(id(content), None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def __len__(self):
+        return len(self._entries)
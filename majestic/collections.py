@@ -1,10 +1,87 @@
+from collections.abc import Sequence
 from datetime import datetime
+import hashlib
+import heapq
+from itertools import groupby
 import json
+from operator import attrgetter
 
 import pytz
 
 from majestic.content import BlogObject
-from majestic.utils import chunk, absolute_urls
+from majestic.utils import chunk
+
+
+class SortedPosts(Sequence):
+    """Immutable sequence of posts sorted newest-first
+
+    The posts are sorted once when the SortedPosts is created, so a
+    single SortedPosts can be shared by every collection of a site's
+    posts. Slicing returns a SortedPosts view of the same posts, so
+    neither copies nor sorts them again. Creating a SortedPosts from
+    another (or from a view) shares its posts in the same way.
+
+    When pickled (as when sent to a worker process), only the posts
+    in view are stored.
+    """
+    __slots__ = ('_posts', '_start', '_stop')
+
+    def __init__(self, posts=()):
+        """Initialise SortedPosts by sorting posts newest-first"""
+        if isinstance(posts, SortedPosts):
+            self._set_view(posts._posts, posts._start, posts._stop)
+        else:
+            ordered = tuple(sorted(posts, key=attrgetter('sort_key'),
+                                   reverse=True))
+            self._set_view(ordered, 0, len(ordered))
+
+    def _set_view(self, posts, start, stop):
+        self._posts = posts
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, index):
+        """Return the post at index, or a SortedPosts view for a slice
+
+        Slices with a step other than 1 return a tuple of posts.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return tuple(self)[index]
+            view = SortedPosts.__new__(SortedPosts)
+            view._set_view(self._posts, self._start + start,
+                           self._start + max(start, stop))
+            return view
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('SortedPosts index out of range')
+        return self._posts[self._start + index]
+
+    def __iter__(self):
+        return map(self._posts.__getitem__, range(self._start, self._stop))
+
+    def __eq__(self, other):
+        """Compare the posts in self with those of another sequence"""
+        if not isinstance(other, (SortedPosts, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            post == other_post for post, other_post in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'SortedPosts({0!r})'.format(list(self))
+
+    def __getstate__(self):
+        return tuple(self)
+
+    def __setstate__(self, state):
+        self._set_view(state, 0, len(state))
 
 
 class PostsCollection(BlogObject):
@@ -15,16 +92,46 @@ class PostsCollection(BlogObject):
 
     Apart from the settings object, it takes only one argument on
     initialisation: a collection of post that is stored newest-first
-    (the collection is sorted in reverse order).
+    (the collection is sorted in reverse order). If the collection is
+    a SortedPosts it is used as it is, without sorting.
     """
+    # Whether output may show the site's whole list of posts and pages,
+    # so must be rewritten when it changes (see BuildManifest.fingerprint)
+    shows_listing = True
+
     def __init__(self, posts, settings):
         self._settings = settings
-        self.posts = sorted(posts, reverse=True)
+        self.posts = SortedPosts(posts)
 
     def __iter__(self):
         """Iterate over self.posts"""
         return (post for post in self.posts)
 
+    @property
+    def source_hash(self):
+        """Return a hash of the sources of self's posts, or None
+
+        This covers the url, title, date and source hash (see
+        Content.source_hash) of each of self's posts, along with
+        anything else particular to self (see _fingerprint_data), so
+        that it changes only when the posts shown by self change.
+
+        None is returned if any of the posts have no source hash.
+        """
+        posts = []
+        for post in self.posts:
+            if post.source_hash is None:
+                return None
+            posts.append([post.url, post.title, post.date.isoformat(),
+                          post.source_hash])
+        data = dict(self._fingerprint_data(), posts=posts)
+        return hashlib.sha256(
+            json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _fingerprint_data(self):
+        """Return a dictionary of data besides posts used by source_hash"""
+        return {}
+
 
 class Index(PostsCollection):
     """Index represents a blog index page
@@ -69,6 +176,12 @@ class Index(PostsCollection):
                  'newer_index_url', 'older_index_url']
         return all(getattr(self, a) == getattr(other, a) for a in attrs)
 
+    def _fingerprint_data(self):
+        """Return the page number and links to neighbouring indexes"""
+        return {'page number': self.page_number,
+                'newer index url': self.newer_index_url,
+                'older index url': self.older_index_url}
+
     def __lt__(self, other):
         """Index compares by page_number"""
         return self.page_number < other.page_number
@@ -84,10 +197,12 @@ class Index(PostsCollection):
     def paginate_posts(cls, posts, settings):
         """Split up posts across a list of index pages
 
-        The returned list is ordered by index page number.
+        The returned list is ordered by index page number. Each index
+        holds a SortedPosts view of its posts, so the posts are sorted
+        once (and not at all if posts is already a SortedPosts).
         """
         posts_per_page = settings['index']['posts per page']
-        posts_newest_first = sorted(posts, reverse=True)
+        posts_newest_first = SortedPosts(posts)
         chunked = chunk(posts_newest_first, chunk_length=posts_per_page)
 
         index_list = [cls(page_number=n, settings=settings, posts=post_list)
@@ -112,13 +227,17 @@ class Feed(PostsCollection):
         stored as a posts attribute on the object. The number chosen
         is set in the settings file under [feeds][number of posts].
 
-        The superclass's __init__ isn't called because the posts list
-        has to be sorted before being limited, so there's no point
-        calling super().__init__ and doing unnecessary work.
+        The superclass's __init__ isn't called because there's no need
+        to sort every post: a SortedPosts is sliced, and the most recent
+        posts are picked out of any other list without a full sort.
         """
         self._settings = settings
         post_limit = settings['feeds']['number of posts']
-        self.posts = sorted(posts, reverse=True)[:post_limit]
+        if isinstance(posts, SortedPosts):
+            self.posts = posts[:post_limit]
+        else:
+            self.posts = heapq.nlargest(post_limit, posts,
+                                        key=attrgetter('sort_key'))
 
 
 class RSSFeed(Feed):
@@ -136,6 +255,7 @@ class JSONFeed(Feed):
     _path_template_key = 'json feed path template'
     # _template_file_key deliberately unset as JSONFeed
     # will not be rendered using a Jinja template
+    template_name = None
 
     def render_to_disk(self, *args, **kwargs):
         """Write a valid JSON feed dictionary to disk
@@ -146,6 +266,8 @@ class JSONFeed(Feed):
 
         Intead it constructs a dictionary and serialises that
         with the standard json module.
+
+        Returns True if the file was written (see BlogObject.render_to_disk).
         """
         feed_dict = dict(
             version='https://jsonfeed.org/version/1',
@@ -158,24 +280,202 @@ class JSONFeed(Feed):
             {'id': p.url,
              'url': p.url,
              'title': p.title,
-             'content_html':
-                 absolute_urls(p.html, self._settings['site']['url']),
+             'content_html': p.feed_html,
              'date_published': p.date.isoformat(timespec='seconds')}
             for p in self.posts
             ]
-        self.output_path.parent.mkdir(parents=True, exist_ok=True)
-        with self.output_path.open(mode='w', encoding='utf-8') as file:
-            json.dump(feed_dict, file, indent=2)
+        return self._write_output(
+            lambda file: json.dump(feed_dict, file, indent=2),
+            encoding='utf-8')
 
 
 class Archives(PostsCollection):
     """An archives page for a blog
 
-    Should be initialised with all of the blog's posts.
+    Should be initialised with all of the blog's posts, unless the
+    archives are split into several pages or into periods of time
+    (see partition_posts).
+
+    Besides those of PostsCollection, it has the following attributes:
+        page_number:        1 to the number of pages in the archives
+        newer_page_url:     url to a page with more recent posts or None
+        older_page_url:     url to a page with less recent posts or None
+
+    The first page is written using the archives path template, and
+    any later pages using the archives page path template.
     """
     _path_template_key = 'archives path template'
+    _page_path_template_key = 'archives page path template'
     _template_file_key = 'archives'
 
+    def __init__(self, posts, settings, page_number=1,
+                 newer_page_url=None, older_page_url=None):
+        """Initialise Archives with posts and the site settings"""
+        super().__init__(posts=posts, settings=settings)
+        self.page_number = page_number
+        self.newer_page_url = newer_page_url
+        self.older_page_url = older_page_url
+        if page_number != 1:
+            self._path_template_key = self._page_path_template_key
+
+    def _fingerprint_data(self):
+        """Return the page number and links to neighbouring pages"""
+        return {'page number': self.page_number,
+                'newer page url': self.newer_page_url,
+                'older page url': self.older_page_url}
+
+    @classmethod
+    def paginate_posts(cls, posts, settings, **kwargs):
+        """Split up posts across a list of archives pages
+
+        Each page holds archives -> posts per page posts, or all of
+        them if that setting is null, and is given any further keyword
+        arguments. There is always at least one page, even if there
+        are no posts. The returned list is ordered by page number.
+        """
+        posts = SortedPosts(posts)
+        posts_per_page = settings['archives']['posts per page']
+        if posts_per_page is None or not posts:
+            chunked = [posts]
+        else:
+            chunked = chunk(posts, chunk_length=posts_per_page)
+
+        pages = [cls(posts=post_list, settings=settings, page_number=n,
+                     **kwargs)
+                 for n, post_list in enumerate(chunked, start=1)]
+        for newer, older in zip(pages, pages[1:]):
+            newer.older_page_url = older.url
+            older.newer_page_url = newer.url
+        return pages
+
+    @classmethod
+    def partition_posts(cls, posts, settings):
+        """Return every archives page for posts, as set in the settings
+
+        The archives of all posts (see paginate_posts) come first,
+        followed by YearArchives for each year with posts if
+        archives -> years is true, and MonthArchives for each month
+        with posts if archives -> months is true. Years and months are
+        ordered newest first.
+
+        The posts are sorted once (and not at all if posts is already
+        a SortedPosts), and the months are found in a single pass over
+        them, so that each page holds a SortedPosts view of its posts.
+        """
+        posts = SortedPosts(posts)
+        pages = cls.paginate_posts(posts, settings)
+        options = settings['archives']
+        if not (options['years'] or options['months']):
+            return pages
+
+        months = []     # [(year, month), start, stop], newest first
+        for n, post in enumerate(posts):
+            period = (post.date.year, post.date.month)
+            if months and months[-1][0] == period:
+                months[-1][2] = n + 1
+            else:
+                months.append([period, n, n + 1])
+
+        timezone = pytz.timezone(settings['dates']['timezone'])
+        if options['years']:
+            years = []
+            for year, group in groupby(months, key=lambda m: m[0][0]):
+                group = list(group)
+                years.append((timezone.localize(datetime(year, 1, 1)),
+                              posts[group[0][1]:group[-1][2]]))
+            pages.extend(YearArchives.paginate_periods(years, settings))
+        if options['months']:
+            pages.extend(MonthArchives.paginate_periods(
+                [(timezone.localize(datetime(year, month, 1)),
+                  posts[start:stop])
+                 for (year, month), start, stop in months],
+                settings))
+        return pages
+
+
+class PeriodArchives(Archives):
+    """Base class for archives of the posts from a period of time
+
+    Besides those of Archives, it has the following attributes:
+        date:               aware datetime at the start of the period
+        newer_period_url:   url to archives of the next period with
+                            posts or None
+        older_period_url:   url to archives of the previous period with
+                            posts or None
+
+    Unless they are given templates of their own (templates -> year
+    archives and month archives), period archives are rendered with
+    the archives template. As that may list every post (from
+    all_posts), they are then rewritten whenever the site's list of
+    posts changes, like other archives. Templates of their own should
+    only show the period's posts (content.posts), and period archives
+    are then rewritten only when those posts or the links to their
+    neighbours change, not whenever a post is added elsewhere.
+    """
+    @property
+    def template_name(self):
+        """Return the period's own template, or the archives template"""
+        templates = self._settings['templates']
+        return templates[self._template_file_key] or templates['archives']
+
+    @property
+    def shows_listing(self):
+        """Return True unless the period has a template of its own"""
+        return self._settings['templates'][self._template_file_key] is None
+
+    def __init__(self, posts, settings, date, page_number=1,
+                 newer_page_url=None, older_page_url=None,
+                 newer_period_url=None, older_period_url=None):
+        """Initialise PeriodArchives with posts from the period at date"""
+        self.date = date
+        self.newer_period_url = newer_period_url
+        self.older_period_url = older_period_url
+        super().__init__(posts=posts, settings=settings,
+                         page_number=page_number,
+                         newer_page_url=newer_page_url,
+                         older_page_url=older_page_url)
+
+    def _fingerprint_data(self):
+        """Return the period, page number and links to neighbours"""
+        data = super()._fingerprint_data()
+        data.update({'date': self.date.isoformat(),
+                     'newer period url': self.newer_period_url,
+                     'older period url': self.older_period_url})
+        return data
+
+    @classmethod
+    def paginate_periods(cls, periods, settings):
+        """Return the archives pages for a list of periods
+
+        periods:    [(datetime, SortedPosts)] of the start of each
+                    period and its posts, newest first
+
+        Each period is split into pages by paginate_posts, and every
+        page links to the first page of the neighbouring periods.
+        """
+        paginated = [cls.paginate_posts(posts, settings, date=date)
+                     for date, posts in periods]
+        for newer, older in zip(paginated, paginated[1:]):
+            for page in newer:
+                page.older_period_url = older[0].url
+            for page in older:
+                page.newer_period_url = newer[0].url
+        return [page for pages in paginated for page in pages]
+
+
+class YearArchives(PeriodArchives):
+    """Archives of the posts from one year"""
+    _path_template_key = 'year archives path template'
+    _page_path_template_key = 'year archives page path template'
+    _template_file_key = 'year archives'
+
+
+class MonthArchives(PeriodArchives):
+    """Archives of the posts from one month"""
+    _path_template_key = 'month archives path template'
+    _page_path_template_key = 'month archives page path template'
+    _template_file_key = 'month archives'
+
 
 class Sitemap(BlogObject):
     """Represents an XML sitemap
@@ -1,11 +1,15 @@
 from datetime import datetime
+import hashlib
+from itertools import takewhile
 from pathlib import Path
 from urllib.parse import urljoin
 
 import pytz
 
 import majestic.md as md
-from majestic.utils import normalise_slug, validate_slug
+from majestic.utils import (
+    absolute_urls, normalise_slug, validate_slug, write_file
+    )
 
 
 class DraftError(Exception):
@@ -33,6 +37,7 @@ class BlogObject(object):
     Public properties defined here:
         * URL
         * Output path
+        * Template name
         * Rendering self to a file
 
     Concrete subclasses are required to define the following class
@@ -44,7 +49,13 @@ class BlogObject(object):
     options from an object's self._settings and are the way that
     subclasses customise their output file path, url and set their
     related jinja template.
+
+    The attributes stored by BlogObject are kept in __slots__, which
+    subclasses extend (see Content), but subclasses that don't define
+    __slots__ of their own can still set any attribute.
     """
+    __slots__ = ('_settings', '_path_part', '_output_path', '_url')
+
     @property
     def _path_template_key(self):
         """Key to retrieve the class's path template from settings
@@ -88,11 +99,16 @@ class BlogObject(object):
 
     @property
     def output_path(self):
-        """Return path at which object should be written"""
-        if not hasattr(self, '_output_path'):
-            output_dir = Path(self._settings['paths']['output root'])
-            self._output_path = output_dir.joinpath(self.path_part)
-        return self._output_path
+        """Return path at which object should be written
+
+        Unless it has been overridden, the path is built from path_part
+        on each access rather than stored, as a pathlib.Path takes much
+        more memory than the path part string.
+        """
+        if hasattr(self, '_output_path'):
+            return self._output_path
+        output_dir = Path(self._settings['paths']['output root'])
+        return output_dir.joinpath(self.path_part)
 
     @output_path.setter
     def output_path(self, value):
@@ -118,25 +134,61 @@ class BlogObject(object):
         """Override url by setting it directly"""
         self._url = value
 
+    @property
+    def template_name(self):
+        """Return the name of the jinja template used to render self"""
+        return self._settings['templates'][self._template_file_key]
+
     def render_to_disk(self, environment, **kwargs):
-        """Render self with a jinja template and write to a file"""
-        template = environment.get_template(
-            self._settings['templates'][self._template_file_key])
-        rendered_html = template.render(content=self, **kwargs)
-        self.output_path.parent.mkdir(parents=True, exist_ok=True)
-        with self.output_path.open(mode='w') as file:
-            file.write(rendered_html)
+        """Render self with a jinja template and write to a file
+
+        The template is rendered as a stream, and each piece is written
+        to the file as it is produced, so the whole document is never
+        held in memory.
+
+        Returns True if the file was written, or False if output ->
+        write only if changed is true in settings and the file already
+        held the rendered contents (see utils.write_file).
+        """
+        template = environment.get_template(self.template_name)
+        stream = template.stream(content=self, **kwargs)
+        return self._write_output(stream.dump)
+
+    def _write_output(self, write, encoding=None):
+        """Write to self.output_path using write, a function of a file
+
+        The file is replaced atomically. It is flushed to disk
+        straight away if output -> fsync is "file" in settings.
+        """
+        options = self._settings['output']
+        return write_file(
+            self.output_path, write, encoding=encoding,
+            only_if_changed=options['write only if changed'],
+            fsync=options['fsync'] == 'file')
 
 
 class Content(BlogObject):
-    """Base class for content"""
+    """Base class for content
+
+    Content objects have no instance dictionary: their attributes,
+    including those computed when first accessed (such as html), are
+    kept in __slots__ to save memory when a site has many posts.
+
+    Setting any other attribute (as extensions may do) stores it in
+    self.meta, and attributes not otherwise found are looked up in
+    self.meta, so post.author is the same as post.meta['author'].
+    """
+    __slots__ = ('title', '_body', 'slug', 'source_path',
+                 'modification_date', 'meta', '_html', '_feed_html',
+                 '_source_hash', '_is_new', '_from_source')
+
     def __init__(self, *, title, body, settings,
                  slug=None, source_path=None, save_as=None,
                  modification_date=None, **kwargs):
         """Initialise Content
 
         title:                  str
-        body:                   str
+        body:                   str (or None, see below)
         settings:               dictionary
         slug:                   str (if not None)
         source_path:            pathlib.Path (if not None)
@@ -157,6 +209,9 @@ class Content(BlogObject):
         modification_date is a naive datetime in the local time, as it's
         only used for internal comparisons (which only matter on the
         system on which majestic is run).
+
+        If body is None and source_path is given, the body is read
+        from the source file the first time it is accessed.
         """
         self.title = title
         self.body = body
@@ -178,6 +233,35 @@ class Content(BlogObject):
 
         self.meta = kwargs
 
+    def __getattr__(self, name):
+        """Return self.meta[name] for attributes not otherwise found"""
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            # Not self.meta, which would recurse if meta isn't set yet
+            return object.__getattribute__(self, 'meta')[name]
+        except KeyError:
+            message = '{0!r} object has no attribute {1!r}'
+            raise AttributeError(
+                message.format(type(self).__name__, name)) from None
+
+    def __setattr__(self, name, value):
+        """Set name on self if it is defined by the class, or in meta"""
+        if hasattr(type(self), name):
+            object.__setattr__(self, name, value)
+        else:
+            self.meta[name] = value
+
+    def __delattr__(self, name):
+        """Delete name from self if it is defined by the class, or meta"""
+        if hasattr(type(self), name):
+            object.__delattr__(self, name)
+        else:
+            try:
+                del self.meta[name]
+            except KeyError:
+                raise AttributeError(name) from None
+
     def __eq__(self, other):
         """Compare self with other based on content attributes"""
         if not isinstance(other, self.__class__):
@@ -186,11 +270,24 @@ class Content(BlogObject):
                  'output_path', 'url']
         return all(getattr(self, a) == getattr(other, a) for a in attrs)
 
+    @property
+    def sort_key(self):
+        """Return a tuple by which self is ordered among other Content
+
+        The key is the lowercased title and slug, so that slugs are
+        compared if titles are the same and both are case-insensitive.
+
+        Sorting with this as the key function computes it once for each
+        object, rather than on each of the comparisons made by __lt__.
+        """
+        return (self.title.lower(), self.slug.lower())
+
     def __lt__(self, other):
         """Compare self with other based on title and slug
 
         Slugs are compared if titles are the same.
-        Both checks are case-insensitive.
+        Both checks are case-insensitive. This gives the same order
+        as comparing sort_key.
         """
         if self.title.lower() != other.title.lower():
             return self.title.lower() < other.title.lower()
@@ -207,6 +304,55 @@ class Content(BlogObject):
             self.title,
             self.source_path if self.source_path is not None else 'No path')
 
+    @property
+    def body(self):
+        """Return the markdown text of the content
+
+        If the body was not provided at initialisation (as when the
+        object was created by from_file with lazy set to True), it is
+        read from source_path and stored when first accessed.
+        """
+        if self._body is None and self.source_path is not None:
+            with self.source_path.open() as f:
+                self._body = self._split_source(f.read())[1]
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        """Set the markdown text, discarding any previously rendered html"""
+        self._body = value
+        self._from_source = False
+        self._discard_html()
+
+    def release(self):
+        """Discard the body and html, to be read again when next needed
+
+        This is only done if the body was read from source_path by
+        from_file and neither the body nor the html have been set since,
+        so that reading the file again gives the same result. Returns
+        True if the body and html were discarded.
+        """
+        if not getattr(self, '_from_source', False):
+            return False
+        self._body = None
+        self._discard_html()
+        return True
+
+    def _discard_html(self):
+        """Remove stored html so it is recomputed when next accessed"""
+        md.forget_html(self)
+        self._evict_html()
+
+    def _evict_html(self):
+        """Remove stored html without updating the html budget
+
+        Called by the html budget itself (see majestic.cache.HTMLBudget)
+        when discarding the least recently used html.
+        """
+        for attr in ['_html', '_feed_html']:
+            if hasattr(self, attr):
+                delattr(self, attr)
+
     @property
     def html(self):
         """Render self.body markdown text as HTML
@@ -215,27 +361,78 @@ class Content(BlogObject):
         markdown -> extensions. The dictionary key names are used as
         strings to import the extensions and the dictionary contents
         as the extension configuration.
+
+        The html is taken from the render cache if it is enabled
+        (see majestic.md.convert).
+
+        If cache -> html memory megabytes is set, the converted html
+        counts towards that budget and may be discarded once other
+        objects' html has been used more recently, to be converted
+        again when next accessed (see majestic.md.get_html_budget).
         """
+        budget = md.get_html_budget(self._settings)
         if not hasattr(self, '_html'):
-            self._html = md.get_markdown(self._settings).convert(self.body)
+            self._html = md.convert(self.body, self._settings)
+            if budget is not None:
+                budget.add(self, self._html)
+        elif budget is not None:
+            budget.touch(self)
         return self._html
 
+    @html.setter
+    def html(self, value):
+        """Override html by setting it directly"""
+        self._discard_html()
+        self._html = value
+        self._from_source = False
+
+    @property
+    def feed_html(self):
+        """Return self.html with relative URLs made absolute for feeds
+
+        URLs are made absolute using the site URL, so that links and
+        images work in feed readers. The result is stored along with
+        the site URL used to create it, so it is shared by the RSS and
+        JSON feeds, and is only recomputed if the body or html is set
+        or the site URL changes.
+        """
+        site_url = self._settings['site']['url']
+        if getattr(self, '_feed_html', (None, None))[0] != site_url:
+            self._feed_html = (site_url, absolute_urls(self.html, site_url))
+        return self._feed_html[1]
+
+    @staticmethod
+    def _split_source(text):
+        """Split the text of a source file into header and body
+
+        The header and body are separated by the first blank line.
+        Leading and trailing newlines are stripped from the body.
+        """
+        meta, body = text.split('\n\n', maxsplit=1)
+        return meta, body.strip('\n')
+
     @classmethod
-    def from_file(class_, file, settings):
+    def from_file(class_, file, settings, lazy=False):
         """Parse file into an object of type class_
 
         class_:     the class from which the class method was called
         file:       a pathlib.Path
         settings:   a dictionary containing the site's settings
+        lazy:       bool, read only the metadata header from file
 
         Raises DraftError if the file is explicitly marked as a draft,
         by way of 'draft' appearing by itself on a line in the metadata
         header.
+
+        If lazy is True, the file is read only as far as the first
+        blank line, and the body is read when it is first accessed.
         """
         with file.open() as f:
-            # Split on first blank line
-            meta, body = f.read().split('\n\n', maxsplit=1)
-        body = body.strip('\n')
+            if lazy:
+                meta = ''.join(takewhile(lambda line: line != '\n', f))
+                body = None
+            else:
+                meta, body = class_._split_source(f.read())
 
         # Split on first colon
         meta = [line.split(':', maxsplit=1) for line in meta.splitlines()]
@@ -253,8 +450,29 @@ class Content(BlogObject):
         # Filter out --- (etc) separators in header
         meta = [l for l in meta if len(l) == 2]
 
-        return class_(body=body, settings=settings, source_path=file,
-                      **dict(meta))
+        content = class_(body=body, settings=settings, source_path=file,
+                         **dict(meta))
+        content._from_source = True
+        return content
+
+    @property
+    def source_hash(self):
+        """Return the SHA-256 hex digest of the source file, or None
+
+        None is returned if self has no source file. The hash is
+        computed when first accessed and then stored on self.
+        """
+        if not hasattr(self, '_source_hash'):
+            if self.source_path is None:
+                return None
+            self._source_hash = hashlib.sha256(
+                self.source_path.read_bytes()).hexdigest()
+        return self._source_hash
+
+    @source_hash.setter
+    def source_hash(self, value):
+        """Override _source_hash by setting it directly"""
+        self._source_hash = value
 
     @property
     def is_new(self):
@@ -266,22 +484,33 @@ class Content(BlogObject):
         is_new raises if output_path exists but modification_date is None.
         (This will only happen through programmatic Content creation when
         neither source_path or modification_date are provided at init.)
+
+        If is_new has been set, the value set is returned instead.
+        process_blog writes content whose is_new has been set to True
+        (for example by an extension) even if its output is up to date
+        according to the build manifest; the comparison of modification
+        times is not used by process_blog.
         """
-        if not hasattr(self, '_is_new'):
-            if not self.output_path.exists():
-                return True
-            if self.modification_date is None:
-                raise ModificationDateError('modification_date is None')
-            output_timestamp = self.output_path.stat().st_mtime
-            output_date = datetime.fromtimestamp(output_timestamp)
-            self._is_new = self.modification_date > output_date
-        return self._is_new
+        if hasattr(self, '_is_new'):
+            return self._is_new
+        if not self.output_path.exists():
+            return True
+        if self.modification_date is None:
+            raise ModificationDateError('modification_date is None')
+        output_timestamp = self.output_path.stat().st_mtime
+        output_date = datetime.fromtimestamp(output_timestamp)
+        return self.modification_date > output_date
 
     @is_new.setter
     def is_new(self, value):
         """Override _is_new by setting it directly"""
         self._is_new = value
 
+    @property
+    def marked_new(self):
+        """Return True if is_new has been set to True"""
+        return getattr(self, '_is_new', False) is True
+
 
 class Page(Content):
     """A Content subclass representing a static page
@@ -289,14 +518,18 @@ class Page(Content):
     Page is just a concrete version of Content, with the BlogObject
     key variables defined.
     """
+    __slots__ = ()
     _path_template_key = 'page path template'
     _template_file_key = 'page'
 
 
 class Post(Content):
     """A Content subclass representing a blog post"""
+    __slots__ = ('date', '_sort_key')
     _path_template_key = 'post path template'
     _template_file_key = 'post'
+    # Attributes from which sort_key is made
+    _sort_key_attrs = frozenset({'date', 'title', 'slug'})
 
     def __init__(self, *, title, body, date, settings,
                  slug=None, source_path=None, **kwargs):
@@ -331,11 +564,42 @@ class Post(Content):
             return NotImplemented
         return self.date == other.date and super().__eq__(other)
 
+    @property
+    def sort_key(self):
+        """Return a tuple by which self is ordered among other Posts
+
+        Posts are ordered by date, and by title and slug if they have
+        identical dates (see Content.sort_key).
+
+        The date is converted to UTC, which doesn't change the order,
+        so that comparing keys doesn't look up each date's UTC offset.
+
+        The key is stored when first computed, and discarded when the
+        date, title or slug is set.
+        """
+        if not hasattr(self, '_sort_key'):
+            self._sort_key = (self.date.astimezone(pytz.utc),
+                              self.title.lower(), self.slug.lower())
+        return self._sort_key
+
+    def __setattr__(self, name, value):
+        """Set name as Content does, discarding any stored sort_key
+
+        The stored key is only discarded if name is one it's made from.
+        """
+        if name in self._sort_key_attrs:
+            try:
+                object.__delattr__(self, '_sort_key')
+            except AttributeError:
+                pass
+        super().__setattr__(name, value)
+
     def __lt__(self, other):
         """Compare self with other based on date
 
         If self and other have identical dates, use superclass's
-        implementation to test titles and slugs.
+        implementation to test titles and slugs. This gives the same
+        order as comparing sort_key.
         """
         if self.date != other.date:
             return self.date < other.date
@@ -0,0 +1,198 @@
+import contextlib
+import errno
+import io
+import json
+import os
+from pathlib import Path
+import socket
+import socketserver
+import traceback
+
+from majestic.cache import ContentCache
+from majestic.extensions import reload_extensions
+import majestic.md as md
+from majestic.templating import jinja_environment
+import majestic.watch as watch
+
+
+class BuildDaemon(object):
+    """Builds a site on request, keeping its source loaded between builds
+
+    The site's settings, the posts and pages parsed from its source
+    (in an in-memory ContentCache), its Jinja2 Environment and the
+    configured Markdown instance (see majestic.md) are kept between
+    builds, so each build only parses the source files that have
+    changed and only compiles templates that have changed.
+
+    Before each build the settings files, templates and extensions
+    are checked for changes. If a settings file has changed, the
+    settings are reloaded and everything derived from them is
+    discarded. If a template has changed, a new Environment is
+    created, and if an extension module has changed, the extension
+    modules and the Markdown configuration are reloaded.
+    """
+    def __init__(self, *, configure, build, settings_files=()):
+        """Initialise BuildDaemon and load the site's settings
+
+        configure:          function that returns freshly loaded settings
+        build:              function that builds the site, called with
+                            the settings, a list of command-line
+                            arguments, a ContentCache and an Environment
+        settings_files:     iterable of paths to the settings files in use
+        """
+        self._configure = configure
+        self._build = build
+        self._settings_files = [Path(file).resolve()
+                                for file in settings_files]
+        self._watcher = None
+        # Changes seen by the watcher but not yet successfully reloaded
+        self._changed = set()
+        self._load()
+
+    def _load(self):
+        """Load the settings and discard everything derived from them"""
+        self.settings = self._configure()
+        self.content_cache = ContentCache(directory=None,
+                                          settings=self.settings)
+        self.environment = None
+        md.reset_cached_markdown()
+        paths = self.settings['paths']
+        watcher = watch.make_watcher(
+            [Path(paths['templates root']), Path(paths['extensions root']),
+             *self._settings_files])
+        if self._watcher is not None:
+            self._watcher.close()
+        self._watcher = watcher
+
+    def _refresh(self):
+        """Reload whatever has changed since the last build
+
+        Changes are only forgotten once everything has been reloaded,
+        so if reloading raises (for example because a settings file
+        isn't valid JSON), it is tried again before the next build
+        rather than leaving the old settings or extensions in use.
+        """
+        changed = self._changed
+        changed |= self._watcher.changes(timeout=0)
+        if not changed:
+            return
+        if not changed.isdisjoint(self._settings_files):
+            self._load()
+
+        paths = self.settings['paths']
+        templates_dir = Path(paths['templates root']).resolve()
+        if any(templates_dir in path.parents for path in changed):
+            self.environment = None
+
+        extensions_dir = Path(paths['extensions root']).resolve()
+        if any(extensions_dir in path.parents for path in changed):
+            reload_extensions(extensions_dir)
+            md.reset_cached_markdown()
+        changed.clear()
+
+    def build(self, args):
+        """Build the site and return the exit status and output
+
+        args:       list of command-line arguments for the build
+
+        Anything printed to stdout or stderr during the build is
+        captured and returned. The status is 0 if the build succeeded.
+        Errors are reported in the output rather than raised, so that
+        a failed build doesn't stop the daemon.
+        """
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), \
+                contextlib.redirect_stderr(output):
+            try:
+                self._refresh()
+                if self.environment is None:
+                    templates = self.settings['paths']['templates root']
+                    self.environment = jinja_environment(
+                        user_templates=templates, settings=self.settings)
+                self._build(self.settings, args, self.content_cache,
+                            self.environment)
+                status = 0
+            except SystemExit as exit:
+                # Raised for invalid arguments, --help and --version
+                if exit.code is None or isinstance(exit.code, int):
+                    status = exit.code or 0
+                else:
+                    print(exit.code)
+                    status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        return status, output.getvalue()
+
+    def close(self):
+        self._watcher.close()
+
+
+class _BuildRequestHandler(socketserver.StreamRequestHandler):
+    """Handles a build request sent to the daemon's socket
+
+    Each request and response is a line of JSON. A request holds the
+    command-line arguments for the build:
+        {"args": ["--skip-feeds"]}
+    and the response the exit status and output of the build:
+        {"status": 0, "output": "..."}
+    """
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            args = [str(arg) for arg in request['args']]
+        except (ValueError, KeyError, TypeError) as error:
+            status, output = 2, 'Invalid build request: {0}\n'.format(error)
+        else:
+            status, output = self.server.builder.build(args)
+        response = json.dumps({'status': status, 'output': output})
+        self.wfile.write(response.encode('utf-8') + b'\n')
+
+
+def _remove_stale_socket(path):
+    """Remove the socket at path if nothing is listening on it
+
+    Raises OSError if another daemon is listening on the socket.
+    """
+    if not path.is_socket():
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(str(path))
+        except ConnectionRefusedError:
+            path.unlink()
+            return
+    raise OSError(errno.EADDRINUSE, 'A build daemon is already listening',
+                  str(path))
+
+
+def serve(builder, socket_path, ready=None):
+    """Run builds requested on the Unix socket at socket_path
+
+    builder:        BuildDaemon
+    socket_path:    path at which to create the socket
+    ready:          function called with the server once it is
+                    listening, or None
+
+    Requests are handled one at a time until the process is interrupted
+    or the server is shut down. The socket can only be used by its
+    owner, and is removed when the daemon stops.
+    """
+    path = Path(socket_path)
+    _remove_stale_socket(path)
+    # Create the socket without permissions for anyone else, rather than
+    # changing them afterwards, so no one else can ever connect
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(str(path),
+                                               _BuildRequestHandler)
+    finally:
+        os.umask(umask)
+    with server:
+        server.builder = builder
+        try:
+            if ready is not None:
+                ready(server)
+            server.serve_forever()
+        finally:
+            path.unlink()
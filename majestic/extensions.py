@@ -1,5 +1,6 @@
 from enum import Enum
 import importlib
+from pathlib import Path
 import sys
 
 
@@ -22,8 +23,11 @@ class ExtensionStage(Enum):
 
 def load_extensions(directory):
     """Import all modules in directory and return a list of them"""
-    # Add extensions directory to path
-    sys.path.insert(0, str(directory))
+    # Add extensions directory to path. It is made absolute because
+    # the import system caches a finder for each entry in sys.path,
+    # so a relative entry could find modules in another directory
+    # if the working directory has changed.
+    sys.path.insert(0, str(directory.resolve()))
 
     module_names = [file.stem for file in directory.iterdir()
                     if file.suffix == '.py']
@@ -34,6 +38,27 @@ def load_extensions(directory):
     return imported_modules
 
 
+def reload_extensions(directory):
+    """Reload the modules from directory that have been imported
+
+    This picks up changes made to extension modules since they were
+    imported by load_extensions. Modules whose files have been removed
+    are left alone, and new modules are imported by load_extensions.
+    """
+    directory = directory.resolve()
+    sys.path.insert(0, str(directory))
+    try:
+        for module in list(sys.modules.values()):
+            file = getattr(module, '__file__', None)
+            if file is None:
+                continue
+            file = Path(file)
+            if file.parent == directory and file.exists():
+                importlib.reload(module)
+    finally:
+        sys.path.remove(str(directory))
+
+
 def apply_extensions(*, modules, stage, settings,
                      pages=None, posts=None, objects=None):
     """Transform content with each module's process functions
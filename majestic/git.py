@@ -0,0 +1,66 @@
+from pathlib import Path
+import subprocess
+
+from majestic.utils import MARKDOWN_EXTENSIONS
+
+
+class GitError(Exception):
+    """Raised when git can't be run or reports an error"""
+    pass
+
+
+def _git(directory, *args):
+    """Run git in directory with args and return its output as bytes"""
+    try:
+        result = subprocess.run(['git', '-C', str(directory), *args],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, check=True)
+    except OSError as error:
+        raise GitError('Could not run git: {0}'.format(error)) from error
+    except subprocess.CalledProcessError as error:
+        message = error.stderr.decode('utf-8', 'replace').strip()
+        raise GitError(message) from error
+    return result.stdout
+
+
+def _paths(directory, output):
+    """Return a list of paths from git's NUL-separated output"""
+    return [Path(directory, name)
+            for name in output.decode('utf-8').split('\0') if name]
+
+
+def head_commit(directory):
+    """Return the hash of the commit checked out in directory's repo"""
+    return _git(directory, 'rev-parse', '--verify', 'HEAD').decode().strip()
+
+
+def markdown_files(directory):
+    """Return a list of the markdown files in directory known to git
+
+    These are the tracked files that haven't been deleted, and any
+    untracked files that aren't ignored. The file system isn't walked.
+    An empty list is returned if directory doesn't exist.
+    """
+    if not Path(directory).is_dir():
+        return []
+    listed = _paths(directory, _git(directory, 'ls-files', '-z', '--cached',
+                                    '--others', '--exclude-standard'))
+    deleted = set(_paths(directory,
+                         _git(directory, 'ls-files', '-z', '--deleted')))
+    return [path for path in dict.fromkeys(listed)
+            if path.suffix in MARKDOWN_EXTENSIONS and path not in deleted]
+
+
+def changed_files(directory, since):
+    """Return the set of files in directory changed since commit since
+
+    This includes changes that haven't been committed and untracked
+    files. Raises GitError if since isn't a commit in the repository
+    (for example if history has been rewritten).
+    """
+    changed = _paths(directory, _git(directory, 'diff', '--name-only',
+                                     '--no-renames', '--relative', '-z',
+                                     since, '--', '.'))
+    untracked = _paths(directory, _git(directory, 'ls-files', '-z',
+                                       '--others', '--exclude-standard'))
+    return set(changed) | set(untracked)
@@ -0,0 +1,215 @@
+import hashlib
+import json
+from pathlib import Path
+
+import majestic.md as md
+from majestic.templating import TemplateDependencies
+from majestic.utils import write_file
+
+# Settings sections that don't affect the contents of output files
+_UNRENDERED_SETTINGS = {'cache', 'output', 'preview'}
+# Options in other sections that don't affect them either
+_UNRENDERED_OPTIONS = {
+    'jinja': {'bytecode cache'},
+    'paths': {'cache root'},
+    }
+
+
+def settings_fingerprint(settings):
+    """Return a str identifying the settings used to render output
+
+    This covers every section of the settings apart from those that
+    only control how the build is carried out (such as cache and
+    output, jinja -> bytecode cache and paths -> cache root), and the
+    markdown configuration (see md.markdown_fingerprint),
+    which includes the source of the modules in the extensions directory.
+    """
+    rendered = {key: value for key, value in settings.items()
+                if key not in _UNRENDERED_SETTINGS}
+    for section, options in _UNRENDERED_OPTIONS.items():
+        if section in rendered:
+            rendered[section] = {key: value
+                                 for key, value in rendered[section].items()
+                                 if key not in options}
+    digest = hashlib.sha256()
+    digest.update(json.dumps(rendered, sort_keys=True,
+                             default=repr).encode('utf-8'))
+    digest.update(md.markdown_fingerprint(settings).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def listing_fingerprint(posts, pages):
+    """Return a str identifying the url and title of each post and page
+
+    The fingerprint also covers the date of each post, but not the
+    bodies of posts and pages, so it changes when the site's lists
+    of posts and pages (as shown on index pages) change.
+    """
+    listing = {
+        'posts': [[post.url, post.title, post.date.isoformat()]
+                  for post in posts],
+        'pages': [[page.url, page.title] for page in pages],
+        }
+    return hashlib.sha256(json.dumps(listing).encode('utf-8')).hexdigest()
+
+
+class BuildManifest(object):
+    """Records what each output file was built from
+
+    For each output file written, the manifest records:
+        source:     the hash of its source (see Content.source_hash
+                    and PostsCollection.source_hash)
+        templates:  the fingerprint of the templates used to render it
+        settings:   the fingerprint of the site's settings
+        listing:    for collections, the fingerprint of the site's
+                    posts and pages (see listing_fingerprint)
+
+    An output is stale if it doesn't exist or if any of these differ
+    from the values recorded when it was written. Unlike comparing
+    modification times, this gives the same answer on a fresh checkout
+    of the source (where every file looks new) restored alongside a
+    previously built output directory.
+
+    The manifest also stores the git commit the source was at when
+    the site was last built with since_git (see majestic.git), or None,
+    along with the set of source files that differed from that commit
+    (uncommitted changes and untracked files) at the time.
+
+    To save reading every source file to hash it, the manifest also
+    stores the hash of each source file along with the file's size and
+    modification time when it was hashed (see unchanged_source_hash).
+
+    The manifest is stored as a JSON file in the output root.
+    """
+    filename = '.majestic-manifest.json'
+
+    def __init__(self, user_templates, settings):
+        """Initialise BuildManifest with no records
+
+        user_templates:    path to user templates directory
+        settings:          dictionary of the site's settings
+        """
+        self.path = Path(settings['paths']['output root'], self.filename)
+        self.templates = TemplateDependencies(user_templates=user_templates,
+                                              settings=settings)
+        self.settings_fingerprint = settings_fingerprint(settings)
+        self._fsync = settings['output']['fsync'] == 'file'
+        self.git_commit = None
+        self.git_uncommitted = set()
+        self.listing = None
+        self._records = {}
+        self._sources = {}      # str(path): [size, mtime_ns, hash]
+        self._checked = {}      # str(path): ([size, mtime_ns], content)
+
+    @classmethod
+    def load(cls, user_templates, settings):
+        """Return BuildManifest with records stored in output root"""
+        manifest = cls(user_templates=user_templates, settings=settings)
+        try:
+            with manifest.path.open() as file:
+                stored = json.load(file)
+            manifest.git_commit = stored['git commit']
+            manifest.git_uncommitted = {
+                Path(path) for path in stored.get('git uncommitted', [])}
+            manifest._records = stored['outputs']
+            manifest._sources = stored.get('sources', {})
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return manifest
+
+    def save(self):
+        """Write the records to disk
+
+        The file is replaced atomically, and flushed to disk straight
+        away if output -> fsync is "file" in settings.
+
+        The hashes of the source files checked by unchanged_source_hash
+        are updated, if they are known.
+        """
+        for path, (identity, content) in self._checked.items():
+            # Don't read the file just to store its hash
+            source_hash = getattr(content, '_source_hash', None)
+            if source_hash is None:
+                self._sources.pop(path, None)
+            else:
+                self._sources[path] = identity + [source_hash]
+        stored = {'git commit': self.git_commit,
+                  'git uncommitted': sorted(
+                      str(path) for path in self.git_uncommitted),
+                  'sources': self._sources,
+                  'outputs': self._records}
+        write_file(self.path,
+                   lambda file: json.dump(stored, file, indent=0,
+                                          sort_keys=True),
+                   fsync=self._fsync)
+
+    def fingerprint(self, obj):
+        """Return the record that would be stored for obj
+
+        obj:        BlogObject
+
+        Objects without a source hash (see Content.source_hash and
+        PostsCollection.source_hash) have None as their source, and
+        objects without a template (such as JSONFeed) have None as
+        their templates fingerprint.
+
+        Objects that aren't read from a source file of their own, such
+        as index pages, also record self.listing, as their templates
+        may use the list of all posts and pages. Objects can declare
+        otherwise with a shows_listing attribute (see PeriodArchives).
+        """
+        template_name = getattr(obj, 'template_name', None)
+        has_source_file = getattr(obj, 'source_path', None) is not None
+        shows_listing = getattr(obj, 'shows_listing', not has_source_file)
+        return {
+            'source': getattr(obj, 'source_hash', None),
+            'templates': (None if template_name is None
+                          else self.templates.fingerprint(template_name)),
+            'settings': self.settings_fingerprint,
+            'listing': self.listing if shows_listing else None,
+            }
+
+    def recorded_source_hash(self, obj):
+        """Return the source hash recorded for obj's output, or None"""
+        recorded = self._records.get(str(obj.output_path))
+        return None if recorded is None else recorded['source']
+
+    def unchanged_source_hash(self, content):
+        """Return the stored hash of content's source file, or None
+
+        The hash is only returned if the file's size and modification
+        time are the same as when it was stored, so the file is not
+        read. Otherwise (or if content has no source file) None is
+        returned, and the hash computed for the file during this build
+        is stored by save.
+        """
+        if content.source_path is None:
+            return None
+        path = str(content.source_path)
+        try:
+            stat = content.source_path.stat()
+        except OSError:
+            return None
+        identity = [stat.st_size, stat.st_mtime_ns]
+        self._checked[path] = (identity, content)
+        stored = self._sources.get(path)
+        if stored is not None and stored[:2] == identity:
+            return stored[2]
+        return None
+
+    def is_stale(self, obj):
+        """Return True if obj's output file must be written
+
+        Objects without a source hash are always stale.
+        """
+        recorded = self._records.get(str(obj.output_path))
+        if recorded is None:
+            return True
+        current = self.fingerprint(obj)
+        if current['source'] is None or recorded != current:
+            return True
+        return not obj.output_path.exists()
+
+    def record(self, obj):
+        """Record that obj's output file has been written"""
+        self._records[str(obj.output_path)] = self.fingerprint(obj)
@@ -1,11 +1,16 @@
+import hashlib
+import json
 from pathlib import Path
 
 import markdown
 from markdown.extensions import Extension
 
+from majestic.cache import HTMLBudget, HTMLCache
 from majestic.extensions import load_extensions
 
 MD_INSTANCE = None
+HTML_CACHE = None
+HTML_BUDGET = None
 
 
 def load_custom_markdown_extensions(extensions_dir):
@@ -16,18 +21,19 @@ def load_custom_markdown_extensions(extensions_dir):
     if not extensions_dir.exists():
         return []
     load_extensions(extensions_dir)
-    return [e for e in Extension.__subclasses__()]
+    # Reloading a module (see extensions.reload_extensions) creates new
+    # classes without removing the old ones, so keep only the newest
+    classes = {(e.__module__, e.__qualname__): e
+               for e in Extension.__subclasses__()}
+    return list(classes.values())
 
 
 def get_custom_extensions(settings):
     """Instantiate custom markdown extensions with configuration"""
     classes = load_custom_markdown_extensions(
         Path(settings['paths']['extensions root']))
-    instances = []
-    for ext in classes:
-        config = settings['markdown']['extensions'].pop(ext.__name__, {})
-        instances.append(ext(**config))
-    return instances
+    configs = settings['markdown']['extensions']
+    return [ext(**configs.get(ext.__name__, {})) for ext in classes]
 
 
 def get_markdown(settings, reload=False):
@@ -35,18 +41,142 @@ def get_markdown(settings, reload=False):
 
     The returned instance will be set up with any extensions specified
     in the settings dictionary.
+
+    Configuration for custom extensions (those defined in modules in
+    the extensions directory) is stored in the settings under the
+    extension class's name, and is not passed on to markdown itself.
     """
     global MD_INSTANCE
     if MD_INSTANCE is None or reload:
-        extensions = [*get_custom_extensions(settings),
-                      *settings['markdown']['extensions'].keys()]
+        custom = get_custom_extensions(settings)
+        custom_names = {type(ext).__name__ for ext in custom}
+        all_configs = settings['markdown']['extensions']
+        configs = {name: config for name, config in all_configs.items()
+                   if name not in custom_names}
         MD_INSTANCE = markdown.Markdown(
-            extensions=extensions,
-            extension_configs=settings['markdown']['extensions']
+            extensions=[*custom, *configs.keys()],
+            extension_configs=configs
             )
     return MD_INSTANCE
 
 
-def _reset_cached_markdown():
-    global MD_INSTANCE
+def markdown_fingerprint(settings):
+    """Return a str identifying the configuration used to render html
+
+    The fingerprint covers the markdown version, the extension
+    configuration in settings and the source of the modules in
+    the extensions directory.
+    """
+    digest = hashlib.sha256()
+    digest.update(markdown.version.encode('utf-8'))
+    digest.update(json.dumps(settings['markdown']['extensions'],
+                             sort_keys=True, default=repr).encode('utf-8'))
+    extensions_dir = Path(settings['paths']['extensions root'])
+    if extensions_dir.exists():
+        for module in sorted(extensions_dir.glob('*.py')):
+            digest.update(module.name.encode('utf-8'))
+            digest.update(module.read_bytes())
+    return digest.hexdigest()
+
+
+def get_html_cache(settings):
+    """Return the HTMLCache used when converting markdown, or None
+
+    The cache is only used if cache -> rendered html is true in the
+    settings, in which case it is stored in the html subdirectory of
+    the cache root.
+    """
+    global HTML_CACHE
+    if not settings['cache']['rendered html']:
+        return None
+    directory = Path(settings['paths']['cache root'], 'html')
+    if HTML_CACHE is None or HTML_CACHE.directory != directory:
+        HTML_CACHE = HTMLCache(directory=directory,
+                               fingerprint=markdown_fingerprint(settings))
+    return HTML_CACHE
+
+
+def get_html_budget(settings):
+    """Return the HTMLBudget limiting html held in memory, or None
+
+    A budget is only used if cache -> html memory megabytes is set in
+    the settings. The same budget is returned until it is reset (see
+    reset_html_budget), so that it covers every object in a build.
+    """
+    global HTML_BUDGET
+    megabytes = settings['cache']['html memory megabytes']
+    if megabytes is None:
+        return None
+    max_bytes = megabytes * 2 ** 20
+    if HTML_BUDGET is None or HTML_BUDGET.max_bytes != max_bytes:
+        HTML_BUDGET = HTMLBudget(max_bytes=max_bytes)
+    return HTML_BUDGET
+
+
+def forget_html(content):
+    """Stop the html budget (if any) recording content's html"""
+    if HTML_BUDGET is not None:
+        HTML_BUDGET.discard(content)
+
+
+def reset_html_budget():
+    """Discard the html budget, as at the end of a build
+
+    The html already held by content objects is kept, but no longer
+    counts towards (or is discarded by) a budget.
+    """
+    global HTML_BUDGET
+    HTML_BUDGET = None
+
+
+def convert(text, settings):
+    """Convert markdown text to html
+
+    The Markdown instance is reset before conversion, so that the
+    result doesn't depend on any text converted previously (such as
+    footnotes or reference links).
+
+    If the html render cache is enabled (see get_html_cache), html
+    is taken from the cache where possible, and any newly converted
+    html is stored in it.
+    """
+    cache = get_html_cache(settings)
+    if cache is not None:
+        html = cache.get(text)
+        if html is not None:
+            return html
+    html = get_markdown(settings).reset().convert(text)
+    if cache is not None:
+        cache.put(text, html)
+    return html
+
+
+def prune_html_cache(settings):
+    """Remove old entries from the html render cache, if it is in use
+
+    Entries are removed if they have not been used in the number of
+    days set in cache -> rendered html max days, and then least
+    recently used entries are removed until the cache is smaller than
+    cache -> rendered html max megabytes. Either can be null to
+    disable that limit.
+    """
+    cache = get_html_cache(settings)
+    if cache is None:
+        return
+    max_days = settings['cache']['rendered html max days']
+    max_megabytes = settings['cache']['rendered html max megabytes']
+    cache.prune(
+        max_bytes=None if max_megabytes is None else max_megabytes * 2 ** 20,
+        max_age=None if max_days is None else max_days * 24 * 60 * 60)
+
+
+def reset_cached_markdown():
+    """Discard the Markdown instance, html cache and html budget
+
+    They are set up again from the settings when next used, such as
+    after the settings or extension modules have changed.
+    """
+    global MD_INSTANCE, HTML_CACHE
     MD_INSTANCE = None
+    HTML_CACHE = None
+    reset_html_budget()
@@ -0,0 +1,335 @@
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from functools import partial
+import os
+import sys
+
+from majestic.content import DraftError
+import majestic.md as md
+from majestic.templating import jinja_environment
+
+# Settings for the current worker process, set by _init_worker
+_worker_settings = None
+
+# Jinja environment and render_to_disk arguments for the current
+# worker process, set by _init_render_to_disk_worker
+_worker_environment = None
+_worker_render_kwargs = None
+
+
+def _init_worker(settings):
+    """Store the site's settings in a worker process"""
+    global _worker_settings
+    _worker_settings = settings
+
+
+def _init_render_worker(settings):
+    """Store the site's settings and build a Markdown instance
+
+    Each worker builds its own Markdown instance, including the
+    custom extensions in the extensions directory, once when it
+    starts, and uses it for every text it converts.
+    """
+    _init_worker(settings)
+    md.get_markdown(settings, reload=True)
+
+
+def _convert(text):
+    """Convert markdown text to html within a worker process"""
+    return md.convert(text, _worker_settings)
+
+
+def _parse_file(class_, lazy, file):
+    """Parse file into a class_ object within a worker process
+
+    Returns None if the file is a draft, so that the parent process
+    can report it without the worker writing to stderr out of order.
+    """
+    try:
+        return class_.from_file(file, _worker_settings, lazy=lazy)
+    except DraftError:
+        return None
+
+
+def worker_count(jobs):
+    """Return the number of worker processes to use
+
+    jobs:   int or None
+
+    If jobs is None or 0, one process per CPU is used.
+    """
+    if not jobs:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def _chunk_size(num_items, num_workers):
+    """Return a chunksize that gives each worker a few batches
+
+    Larger chunks cut down on pickling overhead (the settings dictionary
+    referenced by each object is pickled once per chunk rather than
+    once per object), while several chunks per worker keeps the load
+    reasonably balanced.
+    """
+    return max(1, num_items // (num_workers * 4))
+
+
+def _parse_files(class_, files, settings, jobs, lazy):
+    """Parse files, returning a list of class_ objects or None for drafts"""
+    num_workers = min(worker_count(jobs), len(files))
+
+    if num_workers <= 1:
+        parsed = []
+        for fn in files:
+            try:
+                parsed.append(class_.from_file(fn, settings, lazy=lazy))
+            except DraftError:
+                parsed.append(None)
+        return parsed
+
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             initializer=_init_worker,
+                             initargs=(settings,)) as executor:
+        parsed = list(executor.map(
+            partial(_parse_file, class_, lazy), files,
+            chunksize=_chunk_size(len(files), num_workers)))
+    for content in parsed:
+        if content is not None:
+            content._settings = settings
+    return parsed
+
+
+def parse_content_files(class_, files, settings, jobs=1, cache=None,
+                        lazy=False, changed=None):
+    """Parse files into a list of class_ objects, using jobs processes
+
+    class_:     Content subclass (Post or Page)
+    files:      iterable of pathlib.Path
+    settings:   dictionary containing the site's settings
+    jobs:       number of processes to use (see worker_count)
+    cache:      majestic.cache.ContentCache or None
+    lazy:       bool, read only the metadata header of each file
+    changed:    set of pathlib.Path or None
+
+    Files marked as drafts are reported on stderr and left out of
+    the returned list, which is in the same order as files.
+
+    When more than one process is used, the objects returned by
+    the workers have their settings replaced with settings, so
+    that every object shares the same dictionary (as they do
+    when parsed serially).
+
+    If a cache is given, files with a valid cache entry are not
+    parsed, and the objects parsed from the remaining files are
+    added to the cache. Objects taken from the cache read their
+    body from file when it is first needed, as if lazy were True.
+
+    changed can be a set of the files known to have changed since
+    the last build (see majestic.git), in which case cache entries
+    for the other files are used without checking the files.
+    """
+    files = list(files)
+    parsed = {}
+    if cache is not None:
+        for idx, fn in enumerate(files):
+            trust = changed is not None and fn not in changed
+            content = cache.get(class_, fn, trust=trust)
+            if content is not None:
+                parsed[idx] = content
+
+    to_parse = [idx for idx in range(len(files)) if idx not in parsed]
+    fresh = _parse_files(class_, [files[idx] for idx in to_parse],
+                         settings, jobs, lazy)
+    for idx, content in zip(to_parse, fresh):
+        parsed[idx] = content
+        if cache is not None and content is not None:
+            cache.put(class_, files[idx], content)
+
+    content_list = []
+    for idx, fn in enumerate(files):
+        content = parsed[idx]
+        if content is None:
+            print('{file} is marked as a draft'.format(file=fn),
+                  file=sys.stderr)
+        else:
+            content_list.append(content)
+    return content_list
+
+
+def render_pool(settings, jobs=1, **kwargs):
+    """Return a pool of worker processes to render with, or None
+
+    settings:   dictionary containing the site's settings
+    jobs:       number of processes to use (see worker_count)
+    kwargs:     passed to each object's render_to_disk
+
+    The pool can be passed to render_html and render_to_disk (with
+    the same settings and kwargs) in place of the pool each would
+    otherwise start, so that a build in several batches starts its
+    workers, and builds their Markdown instances and Jinja environments,
+    only once. None is returned if only one process would be used.
+    The caller should shut the pool down when it is done with it.
+    """
+    num_workers = worker_count(jobs)
+    if num_workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=num_workers,
+                               initializer=_init_render_to_disk_worker,
+                               initargs=(settings, kwargs))
+
+
+def render_html(content, settings, jobs=1, executor=None):
+    """Convert the bodies of content objects to html using jobs processes
+
+    content:    iterable of Content objects
+    settings:   dictionary containing the site's settings
+    jobs:       number of processes to use (see worker_count)
+    executor:   pool from render_pool to use, or None to start one
+
+    The converted html is set on each object, so that it is not
+    converted again when accessed while rendering templates. Objects
+    that already have html, and repeated objects, are skipped.
+
+    If only one process would be used, nothing is done and each
+    object's html is converted as usual when first accessed.
+
+    The converted html counts towards the html memory budget, if one
+    is set, so with a small budget it is best to also build in batches
+    (see process_blog) so that each batch's html fits within it.
+
+    Text with an entry in the html render cache (if enabled) is not
+    sent to the workers.
+    """
+    if worker_count(jobs) <= 1:
+        return
+
+    pending = {}
+    for obj in content:
+        if not hasattr(obj, '_html'):
+            pending.setdefault(id(obj), obj)
+    pending = list(pending.values())
+
+    budget = md.get_html_budget(settings)
+    cache = md.get_html_cache(settings)
+    if cache is not None:
+        uncached = []
+        for obj in pending:
+            html = cache.get(obj.body)
+            if html is None:
+                uncached.append(obj)
+            else:
+                obj._html = html
+                if budget is not None:
+                    budget.add(obj, html)
+        pending = uncached
+
+    num_workers = min(worker_count(jobs), len(pending))
+    if num_workers == 0:
+        return
+    with contextlib.ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(ProcessPoolExecutor(
+                max_workers=num_workers, initializer=_init_render_worker,
+                initargs=(settings,)))
+        html_list = executor.map(
+            _convert, [obj.body for obj in pending],
+            chunksize=_chunk_size(len(pending), num_workers))
+        for obj, html in zip(pending, html_list):
+            obj._html = html            # As if converted in this process
+            if budget is not None:
+                budget.add(obj, html)
+
+
+def _init_render_to_disk_worker(settings, render_kwargs):
+    """Set up a worker process to render objects to disk
+
+    Each worker builds its own Markdown instance and Jinja environment
+    once when it starts. render_kwargs (such as the lists of all posts
+    and pages) are passed to every object's render_to_disk.
+    """
+    global _worker_environment, _worker_render_kwargs
+    _init_render_worker(settings)
+    _worker_environment = jinja_environment(
+        user_templates=settings['paths']['templates root'],
+        settings=settings)
+    _worker_render_kwargs = render_kwargs
+
+
+def _render_chunk(objects):
+    """Render a list of objects to disk within a worker process"""
+    return [obj.render_to_disk(environment=_worker_environment,
+                               **_worker_render_kwargs)
+            for obj in objects]
+
+
+def _is_majestic_object(obj):
+    """Return True if obj's class is defined by majestic itself
+
+    Instances of classes defined elsewhere (such as in extension
+    modules) may not be importable in a worker process.
+    """
+    return type(obj).__module__.split('.')[0] == 'majestic'
+
+
+def render_to_disk(objects, environment, settings, jobs=1, serial=(),
+                   executor=None, **kwargs):
+    """Render objects to disk using jobs processes
+
+    objects:        list of BlogObjects
+    environment:    jinja2.Environment used in this process
+    settings:       dictionary containing the site's settings
+    jobs:           number of processes to use (see worker_count)
+    serial:         iterable of objects that must be rendered in
+                    this process (compared by identity)
+    executor:       pool from render_pool, made with the same
+                    settings and kwargs, or None to start one
+    kwargs:         passed to each object's render_to_disk
+
+    Returns a list of the values returned by each object's
+    render_to_disk, in the same order as objects.
+
+    Objects in serial, and objects whose class is not defined by
+    majestic (such as those from extensions), are rendered in this
+    process while the workers render the rest, each with its own Jinja
+    environment. If a batch of objects can't be sent to a worker
+    (for example because an object can't be pickled) or fails there,
+    it is rendered again in this process, so that any error is raised
+    as it would be when rendering serially.
+    """
+    serial_ids = {id(obj) for obj in serial}
+    in_pool = [idx for idx, obj in enumerate(objects)
+               if id(obj) not in serial_ids and _is_majestic_object(obj)]
+    num_workers = min(worker_count(jobs), len(in_pool))
+
+    def render(idx):
+        return objects[idx].render_to_disk(environment=environment,
+                                           **kwargs)
+
+    if num_workers <= 1:
+        return [render(idx) for idx in range(len(objects))]
+
+    results = [None] * len(objects)
+    size = _chunk_size(len(in_pool), num_workers)
+    chunks = [in_pool[start:start + size]
+              for start in range(0, len(in_pool), size)]
+    with contextlib.ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(ProcessPoolExecutor(
+                max_workers=num_workers,
+                initializer=_init_render_to_disk_worker,
+                initargs=(settings, kwargs)))
+        futures = [executor.submit(_render_chunk,
+                                   [objects[idx] for idx in chunk])
+                   for chunk in chunks]
+        pooled = set(in_pool)
+        for idx in range(len(objects)):
+            if idx not in pooled:
+                results[idx] = render(idx)
+        for chunk, future in zip(chunks, futures):
+            try:
+                chunk_results = future.result()
+            except Exception:
+                chunk_results = [render(idx) for idx in chunk]
+            for idx, result in zip(chunk, chunk_results):
+                results[idx] = result
+    return results
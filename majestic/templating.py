@@ -1,4 +1,10 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
 import jinja2
+import jinja2.meta
 
 from majestic.utils import MAJESTIC_DIR, absolute_urls
 
@@ -28,20 +34,197 @@ def rfc822_date(date):
     return template.format(weekday=weekday, month=month, d=date)
 
 
-def jinja_environment(user_templates, settings):
+class PruningBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """A jinja2 FileSystemBytecodeCache that can remove stale entries
+
+    The cache directory is created if it doesn't exist.
+    """
+    def __init__(self, directory):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        super().__init__(directory=str(directory))
+
+    def prune(self, environment):
+        """Remove entries that don't belong to a current template
+
+        An entry's key is derived from a template's name and the path
+        to its source file, so entries for templates that have been
+        deleted, renamed or shadowed by a user template are removed.
+        (Entries for templates that have been edited are replaced by
+        jinja when they are next compiled.)
+        """
+        current = set()
+        for name in environment.list_templates():
+            try:
+                _, filename, _ = environment.loader.get_source(
+                    environment, name)
+            except jinja2.TemplateNotFound:
+                continue
+            current.add(self.pattern % self.get_cache_key(name, filename))
+        prefix, suffix = self.pattern.split('%s')
+        for path in Path(self.directory).iterdir():
+            is_entry = (path.name.startswith(prefix)
+                        and path.name.endswith(suffix))
+            if is_entry and path.name not in current:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+
+def bytecode_cache_directory(settings):
+    """Return the directory to use for the jinja bytecode cache or None
+
+    This is set in settings under jinja -> bytecode cache, which
+    can be:
+        null or false:  the bytecode cache is disabled
+        true:           the jinja subdirectory of the cache root
+        str:            path to a directory
+    """
+    option = settings['jinja'].get('bytecode cache')
+    if option is None or option is False:
+        return None
+    if option is True:
+        return Path(settings['paths']['cache root'], 'jinja')
+    return Path(option)
+
+
+def prune_bytecode_cache(environment):
+    """Remove stale entries from environment's bytecode cache, if any"""
+    cache = environment.bytecode_cache
+    if isinstance(cache, PruningBytecodeCache):
+        cache.prune(environment)
+
+
+def _environment_options(settings):
+    """Return the options under jinja in settings meant for jinja itself
+
+    Keys used by majestic (such as 'bytecode cache') are left out.
+    """
+    return {key: value for key, value in settings['jinja'].items()
+            if key != 'bytecode cache'}
+
+
+def _template_dirs(user_templates):
+    """Return the template search path, in order of precedence"""
+    return [Path(user_templates), MAJESTIC_DIR.joinpath('default_templates')]
+
+
+def compiled_templates_path(settings):
+    """Return the path of the compiled templates bundle
+
+    The bundle is a zip file of Python modules in the cache root,
+    created by compile_templates.
+    """
+    return Path(settings['paths']['cache root'], 'compiled-templates.zip')
+
+
+def templates_fingerprint(user_templates, settings):
+    """Return a str identifying the templates and how they are compiled
+
+    This covers the jinja version, the jinja options in settings and
+    the name and contents of every template in the search path (so
+    adding, removing or editing any of them changes the fingerprint).
+
+    Templates are identified by name rather than path, and file
+    modification times are ignored, so a bundle restored from a cache
+    onto a fresh checkout, or used with majestic installed elsewhere,
+    is still fresh.
+    """
+    sources = {}
+    for directory in _template_dirs(user_templates):
+        if not directory.exists():
+            continue
+        for dirpath, dirnames, filenames in os.walk(str(directory)):
+            for filename in filenames:
+                path = Path(dirpath, filename)
+                name = path.relative_to(directory).as_posix()
+                if name not in sources:     # Earlier directories win
+                    sources[name] = hashlib.sha256(
+                        path.read_bytes()).hexdigest()
+
+    digest = hashlib.sha256()
+    digest.update(jinja2.__version__.encode('utf-8'))
+    digest.update(json.dumps(_environment_options(settings),
+                             sort_keys=True, default=repr).encode('utf-8'))
+    digest.update(json.dumps(sources, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _fingerprint_path(bundle_path):
+    return bundle_path.with_name(bundle_path.name + '.fingerprint')
+
+
+def compiled_templates_are_fresh(user_templates, settings):
+    """Return True if the compiled templates bundle can be used
+
+    The bundle must exist and have been compiled from the current
+    templates with the current jinja options.
+    """
+    bundle = compiled_templates_path(settings)
+    try:
+        with _fingerprint_path(bundle).open() as file:
+            stored = file.read()
+    except FileNotFoundError:
+        return False
+    current = templates_fingerprint(user_templates, settings)
+    return bundle.exists() and stored == current
+
+
+def compile_templates(user_templates, settings):
+    """Compile all templates into a bundle of Python modules
+
+    The user templates and majestic's default templates are compiled
+    into a zip file at compiled_templates_path, which is used by
+    jinja_environment instead of the template sources while it
+    is fresh (see compiled_templates_are_fresh).
+
+    Returns the path to the bundle.
+    """
+    env = jinja_environment(user_templates=user_templates,
+                            settings=settings, use_compiled=False)
+    bundle = compiled_templates_path(settings)
+    bundle.parent.mkdir(parents=True, exist_ok=True)
+    fingerprint = templates_fingerprint(user_templates, settings)
+
+    temp_bundle = bundle.with_name(bundle.name + '.tmp')
+    env.compile_templates(str(temp_bundle), zip='deflated',
+                          ignore_errors=False)
+    os.replace(str(temp_bundle), str(bundle))
+    with _fingerprint_path(bundle).open('w') as file:
+        file.write(fingerprint)
+    return bundle
+
+
+def jinja_environment(user_templates, settings, use_compiled=True):
     """Create a Jinja2 Environment with a loader for templates_dir
 
     user_templates:    path to user templates directory
     settings:          dictionary of the site's settings
+    use_compiled:      bool, load the compiled templates bundle if fresh
 
     The majestic default templates directory is also included in
     the returned Environment's template search path.
+
+    Options in settings under jinja are passed to the Environment,
+    apart from jinja -> bytecode cache which sets up a persistent
+    cache of compiled templates (see bytecode_cache_directory).
+
+    If use_compiled is True and a fresh bundle of compiled templates
+    exists (see compile_templates), templates are loaded from the
+    bundle and are not compiled at all.
     """
-    options = settings['jinja']
+    options = _environment_options(settings)
+
+    if use_compiled and compiled_templates_are_fresh(user_templates,
+                                                     settings):
+        loader = jinja2.ModuleLoader(str(compiled_templates_path(settings)))
+    else:
+        bytecode_dir = bytecode_cache_directory(settings)
+        if bytecode_dir is not None:
+            options['bytecode_cache'] = PruningBytecodeCache(bytecode_dir)
+        loader = jinja2.FileSystemLoader(
+            map(str, _template_dirs(user_templates)))  # order is important
 
-    default_templates = MAJESTIC_DIR.joinpath('default_templates')
-    loader = jinja2.FileSystemLoader(
-        map(str, [user_templates, default_templates]))  # order is important
     env = jinja2.Environment(
         loader=loader,
         undefined=jinja2.StrictUndefined,
@@ -52,3 +235,75 @@ def jinja_environment(user_templates, settings):
     env.filters['absolute_urls'] = absolute_urls  # add custom filter
 
     return env
+
+
+class TemplateDependencies(object):
+    """Finds the template files used to render each template
+
+    A template's dependencies are the template itself and every
+    template it extends, includes or imports (found by parsing
+    the templates' source, and followed recursively). If a template
+    refers to another by a name that can only be known when rendering,
+    it is treated as depending on every template.
+
+    A template's fingerprint covers the names and source of all of its
+    dependencies, so editing a template changes the fingerprint of
+    only the templates that use it (see majestic.manifest).
+    """
+    def __init__(self, user_templates, settings):
+        """Initialise TemplateDependencies
+
+        user_templates:    path to user templates directory
+        settings:          dictionary of the site's settings
+        """
+        self._env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(
+                map(str, _template_dirs(user_templates))),
+            **_environment_options(settings))
+        self._sources = {}
+        self._dependencies = {}
+        self._fingerprints = {}
+
+    def _source(self, name):
+        """Return the source of template name, or None if not found"""
+        if name not in self._sources:
+            try:
+                source, _, _ = self._env.loader.get_source(self._env, name)
+            except jinja2.TemplateNotFound:
+                source = None       # Raised properly when rendering
+            self._sources[name] = source
+        return self._sources[name]
+
+    def dependencies(self, name):
+        """Return a sorted list of the templates used to render name"""
+        if name not in self._dependencies:
+            found = set()
+            pending = [name]
+            while pending:
+                current = pending.pop()
+                if current in found:
+                    continue
+                found.add(current)
+                source = self._source(current)
+                if source is None:
+                    continue
+                referenced = jinja2.meta.find_referenced_templates(
+                    self._env.parse(source))
+                for ref in referenced:
+                    if ref is None:
+                        pending.extend(self._env.list_templates())
+                    else:
+                        pending.append(ref)
+            self._dependencies[name] = sorted(found)
+        return self._dependencies[name]
+
+    def fingerprint(self, name):
+        """Return a str identifying the templates used to render name"""
+        if name not in self._fingerprints:
+            digest = hashlib.sha256()
+            for dependency in self.dependencies(name):
+                source = self._source(dependency)
+                entry = '{0}\0{1}\0'.format(dependency, source)
+                digest.update(entry.encode('utf-8'))
+            self._fingerprints[name] = digest.hexdigest()
+        return self._fingerprints[name]
@@ -1,3 +1,4 @@
+import html
 import json
 import os
 from pathlib import Path
@@ -5,7 +6,6 @@ import re
 import string
 from urllib.parse import urljoin, urlparse
 
-from bs4 import BeautifulSoup
 from unidecode import unidecode
 
 
@@ -93,6 +93,9 @@ def chunk(iterable, chunk_length):
         yield iterable[idx:idx + chunk_length]
 
 
+MARKDOWN_EXTENSIONS = {'.md', '.mkd', '.mdown', '.mkdown', '.markdown'}
+
+
 def markdown_files(directory):
     """Return a generator of the markdown files found by walking directory
 
@@ -103,13 +106,109 @@ def markdown_files(directory):
         * mkdown
         * markdown
     """
-    extensions = {'.md', '.mkd', '.mdown', '.mkdown', '.markdown'}
     files = (Path(dirpath, f)
              for dirpath, dirnames, filenames in os.walk(str(directory))
-             for f in filenames if Path(f).suffix in extensions)
+             for f in filenames if Path(f).suffix in MARKDOWN_EXTENSIONS)
     return files
 
 
+def _same_contents(path, other_path, chunk_size=2 ** 16):
+    """Return True if the files at path and other_path are identical"""
+    if os.stat(str(path)).st_size != os.stat(str(other_path)).st_size:
+        return False
+    with open(str(path), 'rb') as file, open(str(other_path), 'rb') as other:
+        while True:
+            data = file.read(chunk_size)
+            if data != other.read(chunk_size):
+                return False
+            if not data:
+                return True
+
+
+def _fsync_directory(directory):
+    """Flush directory's entries (such as a rename) to disk
+
+    Does nothing on systems where directories can't be opened.
+    """
+    try:
+        fd = os.open(str(directory), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def fsync_files(paths):
+    """Flush the files at paths, and their directory entries, to disk
+
+    Raises OSError naming the file if one of them can't be flushed.
+    """
+    directories = {}
+    for path in paths:
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        except OSError as error:
+            raise OSError(error.errno, error.strerror, str(path)) from error
+        finally:
+            os.close(fd)
+        directories[path.parent] = None     # Ordered set
+    for directory in directories:
+        _fsync_directory(directory)
+
+
+def write_file(path, write, encoding=None, only_if_changed=False,
+               fsync=False):
+    """Atomically create or replace the file at path, returning True if written
+
+    path:               pathlib.Path
+    write:              function called with the open file (in text
+                        mode) to write its contents
+    encoding:           str or None (the locale's encoding)
+    only_if_changed:    bool, see below
+    fsync:              bool, flush the file to disk before returning
+
+    Parent directories of path are created if they don't exist.
+
+    The contents are written to a temporary file next to path, which
+    is then renamed over path. Anything reading path sees either the
+    old file or the new one, never one partly written, and if writing
+    fails the old file is left as it was.
+
+    If only_if_changed is True, the temporary file is compared with the
+    existing file. If they are the same, the temporary file is removed
+    and path is left untouched (so its modification time doesn't
+    change), and False is returned.
+
+    If fsync is True, the file's contents and the rename are flushed
+    to disk, so the new file survives a crash of the whole system.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name('.{0}.{1}.tmp'.format(path.name, os.getpid()))
+    try:
+        with temp_path.open(mode='w', encoding=encoding) as file:
+            write(file)
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        if (only_if_changed and path.exists()
+                and _same_contents(temp_path, path)):
+            temp_path.unlink()
+            return False
+        os.replace(str(temp_path), str(path))
+    except BaseException:
+        if temp_path.exists():
+            temp_path.unlink()
+        raise
+    if fsync:
+        _fsync_directory(path.parent)
+    return True
+
+
 def load_settings(default=True, local=True, files=None):
     """Load config from standard locations and specified files
 
@@ -139,17 +238,89 @@ def load_settings(default=True, local=True, files=None):
     return settings
 
 
+# Markup that absolute_urls copies without looking inside
+_MARKUP = re.compile(r'''
+      (?P<comment> <!--.*?(?:-->|\Z) )
+    | (?P<cdata> <!\[CDATA\[.*?(?:\]\]>|\Z) )
+    | (?P<declaration> <[!?][^>]*> )
+    | (?P<tag> <(?P<name>[a-zA-Z][^\s/>]*)
+               (?P<attrs>(?:"[^"]*"|'[^']*'|[^'">])*)> )
+    ''', re.DOTALL | re.VERBOSE)
+
+# A single attribute within a start tag, with an optional value
+_ATTRIBUTE = re.compile(r'''
+    (?P<name>[^\s"'>/=]+)
+    (?: (?P<equals>\s*=\s*)
+        (?P<value>"[^"]*"|'[^']*'|[^\s"'>]+) )?
+    ''', re.VERBOSE)
+
+_URL_ATTRIBUTES = {'href', 'src', 'poster'}
+
+# Elements whose contents are text, not markup
+_RAW_TEXT_ELEMENTS = {'script', 'style'}
+
+
+def _absolute_attribute(match, base_url):
+    """Return attribute match with a relative URL value made absolute
+
+    Attributes other than those in _URL_ATTRIBUTES, and those that
+    already contain an absolute URL, are returned unchanged.
+    """
+    name, value = match.group('name', 'value')
+    if value is None or name.lower() not in _URL_ATTRIBUTES:
+        return match.group(0)
+    if value[0] in '"\'':
+        quote, url = value[0], html.unescape(value[1:-1])
+    else:
+        quote, url = '"', html.unescape(value)
+    if urlparse(url).netloc:
+        return match.group(0)
+    new_value = html.escape(urljoin(base_url, url), quote=False)
+    new_value = new_value.replace(quote, html.escape(quote))
+    return '{name}{equals}{quote}{value}{quote}'.format(
+        name=name, equals=match.group('equals'), quote=quote,
+        value=new_value)
+
+
 def absolute_urls(html, base_url):
     """Change relative URLs in html to absolute URLs using base_url
 
     Arguments:
         html:           str containing HTML markup
         base_url:       str containing a URL
+
+    URLs are changed in href, src and poster attributes. The html is
+    scanned in a single pass and only those attribute values are
+    rewritten; all other markup is copied unchanged. Comments, CDATA
+    sections and the contents of script and style elements are
+    not altered.
     """
-    parsed_html = BeautifulSoup(html, 'html.parser')
-    for attr in ['href', 'src', 'poster']:
-        for tag in parsed_html.select('[{0}]'.format(attr)):
-            tag_url = tag[attr]
-            if not urlparse(tag_url).netloc:
-                tag[attr] = urljoin(base_url, tag_url)
-    return str(parsed_html)
+    def replace_attribute(match):
+        return _absolute_attribute(match, base_url)
+
+    pieces = []
+    position = 0
+    length = len(html)
+    while position < length:
+        match = _MARKUP.search(html, position)
+        if match is None:
+            break
+        pieces.append(html[position:match.start()])
+        position = match.end()
+        if match.group('tag') is None:
+            pieces.append(match.group(0))
+            continue
+
+        pieces.append('<' + match.group('name'))
+        pieces.append(_ATTRIBUTE.sub(replace_attribute, match.group('attrs')))
+        pieces.append('>')
+
+        name = match.group('name').lower()
+        if name in _RAW_TEXT_ELEMENTS:
+            end_tag = re.compile(r'</{0}\b'.format(name), re.IGNORECASE)
+            end = end_tag.search(html, position)
+            end = length if end is None else end.start()
+            pieces.append(html[position:end])
+            position = end
+    pieces.append(html[position:])
+    return ''.join(pieces)
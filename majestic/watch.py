@@ -0,0 +1,235 @@
+import ctypes
+import ctypes.util
+import os
+from pathlib import Path
+import select
+import struct
+import sys
+import time
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+               IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+               IN_MOVE_SELF)
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _ignored(path):
+    """Return True if changes to path should be ignored
+
+    These are hidden files (such as version control directories and
+    editors' swap files) and editor backup files ending with a tilde.
+    """
+    return path.name.startswith('.') or path.name.endswith('~')
+
+
+def source_paths(settings, settings_files=()):
+    """Return the paths to watch for changes to the site's source
+
+    These are the posts, pages, templates and extensions directories,
+    and settings_files (an iterable of paths to settings files).
+    The output root isn't included, even if it is inside one of
+    these directories.
+    """
+    content = Path(settings['paths']['content root'])
+    paths = [content.joinpath(settings['paths']['posts subdir']),
+             content.joinpath(settings['paths']['pages subdir']),
+             Path(settings['paths']['templates root']),
+             Path(settings['paths']['extensions root'])]
+    paths.extend(Path(file) for file in settings_files)
+    return paths
+
+
+class PollingWatcher(object):
+    """Watches files for changes by repeatedly checking them
+
+    paths is a list of files and directories to watch. Directories
+    are watched along with everything inside them. Paths that don't
+    exist are watched in case they are created.
+    """
+    def __init__(self, paths, interval=0.5):
+        """Initialise PollingWatcher and record the current state
+
+        paths:      iterable of pathlib.Path
+        interval:   seconds to wait between checks
+        """
+        self.paths = [Path(path).resolve() for path in paths]
+        self.interval = interval
+        self._state = self._snapshot()
+
+    def _snapshot(self):
+        """Return a dict of each watched file's size and mtime"""
+        state = {}
+        for path in self.paths:
+            for dirpath, dirnames, filenames in os.walk(str(path)):
+                dirnames[:] = [d for d in dirnames if not _ignored(Path(d))]
+                for name in filenames:
+                    file = Path(dirpath, name)
+                    if not _ignored(file):
+                        self._stat(file, state)
+            if not path.is_dir():
+                self._stat(path, state)
+        return state
+
+    @staticmethod
+    def _stat(path, state):
+        try:
+            stat = path.stat()
+        except OSError:
+            return
+        state[path] = (stat.st_size, stat.st_mtime_ns)
+
+    def changes(self, timeout=None):
+        """Wait for changes and return the set of paths that changed
+
+        An empty set is returned if nothing has changed within timeout
+        seconds (if timeout isn't None).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self._snapshot()
+            changed = {path for path in state.keys() | self._state.keys()
+                       if state.get(path) != self._state.get(path)}
+            self._state = state
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Watches files for changes using Linux's inotify
+
+    Takes the same paths as PollingWatcher, but waits for the kernel
+    to report changes rather than checking every file repeatedly.
+    Directories are watched recursively (including directories created
+    after the watcher), files by watching their parent directory, and
+    paths that don't exist are ignored.
+
+    Raises OSError if inotify is unavailable.
+    """
+    def __init__(self, paths, settle=0.1):
+        """Initialise InotifyWatcher and start watching paths
+
+        paths:      iterable of pathlib.Path
+        settle:     seconds to wait for further events after a change,
+                    so that a burst of changes is reported together
+        """
+        self.settle = settle
+        libc_name = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._directories = {}      # watch descriptor: directory
+        self._trees = set()         # directories watched recursively
+        self._files = set()         # files watched through their parent
+        for path in paths:
+            path = Path(path).resolve()
+            if path.is_dir():
+                self._watch_tree(path)
+            elif path.parent.is_dir():
+                self._files.add(path)
+                self._watch(path.parent)
+
+    def _watch(self, directory):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(str(directory)), _WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(directory))
+        self._directories[wd] = directory
+
+    def _watch_tree(self, directory):
+        """Watch directory and every directory beneath it"""
+        for dirpath, dirnames, filenames in os.walk(str(directory)):
+            dirnames[:] = [d for d in dirnames if not _ignored(Path(d))]
+            self._watch(Path(dirpath))
+            self._trees.add(Path(dirpath))
+
+    def _read_events(self):
+        """Return the paths named by the events waiting to be read"""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(
+                    data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, so report every watched directory
+                    changed.update(self._directories.values())
+                    continue
+                directory = self._directories.get(wd)
+                if directory is None:
+                    continue
+                path = directory.joinpath(os.fsdecode(name))
+                if _ignored(path):
+                    continue
+                if directory in self._trees:
+                    created = mask & (IN_CREATE | IN_MOVED_TO)
+                    if mask & IN_ISDIR and created:
+                        self._watch_tree(path)
+                    changed.add(path)
+                elif path in self._files:
+                    changed.add(path)
+
+    def changes(self, timeout=None):
+        """Wait for changes and return the set of paths that changed
+
+        An empty set is returned if nothing has changed within timeout
+        seconds (if timeout isn't None).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = (None if deadline is None
+                         else max(0, deadline - time.monotonic()))
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if not ready:
+                return set()
+            changed = self._read_events()
+            while select.select([self._fd], [], [], self.settle)[0]:
+                changed.update(self._read_events())
+            if changed:
+                return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(paths):
+    """Return an InotifyWatcher for paths, or a PollingWatcher
+
+    inotify is used on Linux, with polling used on other systems
+    or if inotify can't be set up (for example if the limit on the
+    number of watches has been reached).
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(paths)
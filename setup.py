@@ -13,5 +13,5 @@ setup(name='majestic',
       packages=['majestic'],
       install_requires=reqs,
       zip_safe=False,
-      scripts=['bin/majestic'],
+      scripts=['bin/majestic', 'bin/majestic-build'],
       )
@@ -1,15 +1,35 @@
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from datetime import datetime
+import io
 import os
 from pathlib import Path
 import shutil
+import subprocess
+import tempfile
 import time
 import unittest
+from unittest import mock
+
+import pytz
 
 import majestic
+from majestic.manifest import BuildManifest
+import majestic.parallel as parallel
 
 
 TESTS_DIR = Path(__file__).resolve().parent
 
 
+def run_git(directory, *args):
+    """Run git in directory, for setting up test repositories"""
+    env = dict(os.environ, GIT_AUTHOR_NAME='Test', GIT_COMMITTER_NAME='Test',
+               GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_EMAIL='test@example.com')
+    subprocess.run(['git', '-C', str(directory), *args], env=env,
+                   check=True, stdout=subprocess.DEVNULL)
+
+
 class TestFull(unittest.TestCase):
     """Test the processing of a full source directory
 
@@ -223,8 +243,8 @@ class TestFull(unittest.TestCase):
     def test_process_blog_only_write_new(self):
         """process_blog writes only Content considered new
 
-        Content subclasses (Pages and Posts) should have their
-        .is_new property checked before writing them out.
+        Content subclasses (Pages and Posts) should only be written
+        out if the build manifest considers their output stale.
 
         This test only tests single Page for simplicity.
         """
@@ -239,11 +259,307 @@ class TestFull(unittest.TestCase):
         second_mtime = output.stat().st_mtime
         self.assertEqual(first_mtime, second_mtime)
 
+    def test_process_blog_marked_new(self):
+        """Content whose is_new is set to True is written regardless"""
+        kwargs = dict(settings=self.settings, pages=True,
+                      posts=False, index=False, archives=False,
+                      feeds=False, sitemap=False)
+        majestic.process_blog(**kwargs)
+        output = self.outputdir.joinpath(self.expected['.']['pages'][0])
+        first_mtime = output.stat().st_mtime
+        time.sleep(2)
+
+        parse_content_files = majestic.parse_content_files
+
+        def parse_marked_new(*args, **kwargs):
+            content = parse_content_files(*args, **kwargs)
+            for obj in content:
+                obj.is_new = True
+            return content
+
+        with mock.patch('majestic.parse_content_files',
+                        side_effect=parse_marked_new):
+            majestic.process_blog(**kwargs)
+        self.assertNotEqual(first_mtime, output.stat().st_mtime)
+
+    def test_process_blog_write_only_changed(self):
+        """Unchanged files are not rewritten when write only if changed
+
+        Every file is rendered on both builds (with write_only_new
+        False), but none of them should be written the second time.
+        The build date (included in the RSS feed) is fixed, so that
+        the result doesn't depend on when each build runs.
+        """
+        self.settings['output']['write only if changed'] = True
+        kwargs = dict(settings=self.settings, write_only_new=False,
+                      extensions=False)
+        build_date = datetime(2017, 1, 1, tzinfo=pytz.utc)
+        with mock.patch('majestic.datetime') as mock_datetime:
+            mock_datetime.now.return_value = build_date
+            majestic.process_blog(**kwargs)
+            output = self.outputdir.joinpath(
+                self.expected['.']['pages'][0])
+            first_mtime = output.stat().st_mtime_ns
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                majestic.process_blog(**kwargs)
+        self.assertEqual(output.stat().st_mtime_ns, first_mtime)
+        self.assertIn('Skipped writing 19 unchanged files',
+                      stderr.getvalue())
+
+    def test_process_blog_fsync_batch(self):
+        """Output is flushed to disk at the end with batch fsync
+
+        Only the files written by the build are flushed, along with
+        the build manifest.
+        """
+        self.settings['output']['fsync'] = 'batch'
+        with mock.patch('os.sync') as sync, \
+                mock.patch('majestic.fsync_files') as fsync_files:
+            majestic.process_blog(settings=self.settings, extensions=False)
+        sync.assert_not_called()
+        fsync_files.assert_called_once_with(mock.ANY)
+        flushed = fsync_files.call_args[0][0]
+        output_files = [path for path in self.outputdir.rglob('*')
+                        if path.is_file()]
+        self.assertEqual(sorted(path.resolve() for path in flushed),
+                         sorted(output_files))
+
+    def test_process_blog_fresh_checkout(self):
+        """Sources with new mtimes but the same contents aren't written
+
+        This is what happens to every source file when the blog is
+        cloned afresh, with the output directory restored from a cache.
+        """
+        kwargs = dict(settings=self.settings, pages=True,
+                      posts=True, index=False, archives=False,
+                      feeds=False, sitemap=False, extensions=False)
+        majestic.process_blog(**kwargs)
+        output = self.outputdir.joinpath(self.expected['.']['pages'][0])
+        first_mtime = output.stat().st_mtime_ns
+        future = time.time() + 100
+        for source in majestic.markdown_files(self.blogdir):
+            os.utime(str(source), (future, future))
+        majestic.process_blog(**kwargs)
+        self.assertEqual(output.stat().st_mtime_ns, first_mtime)
+
+    @unittest.skipUnless(shutil.which('git'), 'git is not installed')
+    def test_process_blog_since_git(self):
+        """Only files changed in git since the last build are checked"""
+        blogdir = Path(tempfile.mkdtemp(), 'blog')
+        self.addCleanup(shutil.rmtree, str(blogdir.parent))
+        shutil.copytree(str(self.blogdir), str(blogdir),
+                        ignore=shutil.ignore_patterns('output'))
+        os.chdir(str(blogdir))
+        run_git(blogdir, 'init', '-q')
+        run_git(blogdir, 'add', '.')
+        run_git(blogdir, 'commit', '-q', '-m', 'Posts')
+        settings = majestic.load_settings()
+        settings['paths']['output root'] = str(self.outputdir)
+        settings['cache']['parsed content'] = True
+        kwargs = dict(settings=settings, index=False, archives=False,
+                      feeds=False, sitemap=False, extensions=False,
+                      since_git=True)
+        with contextlib.redirect_stderr(io.StringIO()):
+            majestic.process_blog(**kwargs)
+        output = self.outputdir
+        page = output.joinpath(self.expected['.']['pages'][0])
+        post = output.joinpath('2015', '06',
+                               self.expected['./2015/06']['posts'][0])
+        page_mtime = page.stat().st_mtime_ns
+        post_mtime = post.stat().st_mtime_ns
+
+        sources = list(majestic.markdown_files(blogdir))
+        future = time.time() + 100
+        for source in sources:
+            os.utime(str(source), (future, future))
+        changed = [s for s in sources if '3.6' in s.name][0]
+        changed.write_text(changed.read_text() + '\nMore text.\n')
+        run_git(blogdir, 'commit', '-q', '-am', 'Edit')
+
+        with mock.patch.object(majestic.Post, 'from_file',
+                               side_effect=majestic.Post.from_file) as parse:
+            with contextlib.redirect_stderr(io.StringIO()):
+                majestic.process_blog(**kwargs)
+        self.assertEqual([c[0][0] for c in parse.call_args_list],
+                         [changed.relative_to(blogdir)])
+        self.assertEqual(page.stat().st_mtime_ns, page_mtime)
+        self.assertNotEqual(post.stat().st_mtime_ns, post_mtime)
+
+    def git_blog(self):
+        """Return settings for a copy of the test blog in a git repository"""
+        blogdir = Path(tempfile.mkdtemp(), 'blog')
+        self.addCleanup(shutil.rmtree, str(blogdir.parent))
+        shutil.copytree(str(self.blogdir), str(blogdir),
+                        ignore=shutil.ignore_patterns('output'))
+        os.chdir(str(blogdir))
+        run_git(blogdir, 'init', '-q')
+        run_git(blogdir, 'add', '.')
+        run_git(blogdir, 'commit', '-q', '-m', 'Posts')
+        settings = majestic.load_settings()
+        settings['paths']['output root'] = str(self.outputdir)
+        return settings
+
+    def build_since_git(self, settings, **kwargs):
+        """Build posts and pages with since_git, returning the post path"""
+        options = dict(settings=settings, index=False, archives=False,
+                       feeds=False, sitemap=False, extensions=False,
+                       since_git=True)
+        options.update(kwargs)
+        with contextlib.redirect_stderr(io.StringIO()):
+            majestic.process_blog(**options)
+        return self.outputdir.joinpath(
+            '2015', '06', self.expected['./2015/06']['posts'][0])
+
+    @unittest.skipUnless(shutil.which('git'), 'git is not installed')
+    def test_process_blog_since_git_reverted(self):
+        """Reverting an uncommitted change rewrites the output"""
+        settings = self.git_blog()
+        source = Path('posts').joinpath(
+            [s.name for s in Path('posts').iterdir() if '3.6' in s.name][0])
+        original = source.read_text()
+        post = self.build_since_git(settings)
+        source.write_text(original + '\nUncommitted text.\n')
+        self.build_since_git(settings)
+        self.assertIn('Uncommitted text.', post.read_text())
+        run_git(Path.cwd(), 'checkout', '--', str(source))
+        self.build_since_git(settings)
+        self.assertNotIn('Uncommitted text.', post.read_text())
+
+    @unittest.skipUnless(shutil.which('git'), 'git is not installed')
+    def test_process_blog_since_git_uses_cache(self):
+        """since_git parses only changed files without the cache setting"""
+        settings = self.git_blog()
+        self.assertFalse(settings['cache']['parsed content'])
+        self.build_since_git(settings)
+        source = Path('posts').joinpath(
+            [s.name for s in Path('posts').iterdir() if '3.6' in s.name][0])
+        source.write_text(source.read_text() + '\nMore text.\n')
+        run_git(Path.cwd(), 'commit', '-q', '-am', 'Edit')
+        with mock.patch.object(majestic.Post, 'from_file',
+                               side_effect=majestic.Post.from_file) as parse:
+            self.build_since_git(settings)
+        self.assertEqual([c[0][0] for c in parse.call_args_list], [source])
+
+    @unittest.skipUnless(shutil.which('git'), 'git is not installed')
+    def test_process_blog_since_git_no_pages(self):
+        """A blog without a pages directory can be built with since_git"""
+        settings = self.git_blog()
+        shutil.rmtree('pages')
+        post = self.build_since_git(settings)
+        self.assertTrue(post.exists())
+
+    def test_process_blog_since_git_not_a_repository(self):
+        """since_git outside a repository raises GitError"""
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(directory))
+        self.settings['paths']['content root'] = str(directory)
+        self.outputdir.mkdir(exist_ok=True)
+        with self.assertRaises(majestic.git.GitError):
+            self.build_since_git(self.settings)
+
+    @unittest.skipUnless(shutil.which('git'), 'git is not installed')
+    def test_process_blog_since_git_partial_build(self):
+        """A build skipping posts doesn't hide changes to them later"""
+        settings = self.git_blog()
+        source = Path('posts').joinpath(
+            [s.name for s in Path('posts').iterdir() if '3.6' in s.name][0])
+        post = self.build_since_git(settings)
+        source.write_text(source.read_text() + '\nCommitted text.\n')
+        run_git(Path.cwd(), 'commit', '-q', '-am', 'Edit')
+        self.build_since_git(settings, posts=False)
+        self.assertNotIn('Committed text.', post.read_text())
+        self.build_since_git(settings)
+        self.assertIn('Committed text.', post.read_text())
+
+    def test_process_blog_single_post_change(self):
+        """Changing an old post rewrites only the outputs that show it
+
+        These are the post itself, its index page and the archives.
+        The feeds only include the newest posts and are left alone.
+        """
+        source = self.blogdir.joinpath('posts', 'pelican-3.0.md')
+        original = source.read_text()
+        self.addCleanup(source.write_text, original)
+        self.settings['feeds']['number of posts'] = 3
+        with contextlib.redirect_stderr(io.StringIO()):
+            majestic.process_blog(settings=self.settings, extensions=False)
+        output_files = [path for path in self.outputdir.rglob('*')
+                        if path.is_file()]
+        mtimes = {path: path.stat().st_mtime_ns for path in output_files}
+        time.sleep(0.01)
+
+        source.write_text(original + '\nA correction.\n')
+        with contextlib.redirect_stderr(io.StringIO()):
+            majestic.process_blog(settings=self.settings, extensions=False)
+        rewritten = {str(path.relative_to(self.outputdir))
+                     for path in output_files
+                     if path.stat().st_mtime_ns != mtimes[path]}
+        self.assertEqual(rewritten, {
+            '2012/08/pelican-3-0-released.html', 'page-2.html',
+            'archives.html', 'sitemap.xml', BuildManifest.filename})
+
+    def test_process_blog_partitioned_archives_change(self):
+        """Changing a post rewrites only the archives that show it
+
+        The year and month archives of other periods are left alone.
+        """
+        source = self.blogdir.joinpath('posts', 'pelican-3.0.md')
+        original = source.read_text()
+        self.addCleanup(source.write_text, original)
+        self.settings['archives']['years'] = True
+        self.settings['archives']['months'] = True
+        kwargs = dict(settings=self.settings, posts=False, pages=False,
+                      index=False, feeds=False, sitemap=False,
+                      extensions=False)
+        with contextlib.redirect_stderr(io.StringIO()):
+            majestic.process_blog(**kwargs)
+        archives = [path for path in self.outputdir.rglob('index.html')]
+        mtimes = {path: path.stat().st_mtime_ns for path in archives}
+        self.assertIn(self.outputdir.joinpath('2012', '08', 'index.html'),
+                      mtimes)
+        time.sleep(0.01)
+
+        source.write_text(original + '\nA correction.\n')
+        with contextlib.redirect_stderr(io.StringIO()):
+            majestic.process_blog(**kwargs)
+        rewritten = {str(path.relative_to(self.outputdir))
+                     for path in archives
+                     if path.stat().st_mtime_ns != mtimes[path]}
+        self.assertEqual(rewritten, {'2012/index.html',
+                                     '2012/08/index.html'})
+
+    def test_process_blog_archives_only_reads_no_posts(self):
+        """Rebuilding only the archives doesn't read unchanged posts"""
+        kwargs = dict(settings=self.settings, posts=False, pages=False,
+                      index=False, feeds=False, sitemap=False,
+                      extensions=False, lazy=True)
+        with contextlib.redirect_stderr(io.StringIO()):
+            majestic.process_blog(**kwargs)
+        with mock.patch.object(Path, 'read_bytes', autospec=True,
+                               side_effect=Path.read_bytes) as read_bytes:
+            with contextlib.redirect_stderr(io.StringIO()):
+                majestic.process_blog(**kwargs)
+        self.assertEqual([c for c in read_bytes.call_args_list
+                          if c[0][0].suffix == '.md'], [])
+
+    def test_process_blog_failure_resets_html_budget(self):
+        """The html budget is reset even if the build fails"""
+        self.settings['cache']['html memory megabytes'] = 1
+        majestic.md.get_html_budget(self.settings)
+        self.outputdir.mkdir(exist_ok=True)
+        with mock.patch('majestic.render_to_disk',
+                        side_effect=ValueError('Broken template')):
+            with self.assertRaises(ValueError):
+                majestic.process_blog(settings=self.settings,
+                                      extensions=False)
+        self.assertIsNone(majestic.md.HTML_BUDGET)
+
     def test_process_blog_force_write_all(self):
         """process_blog can be forced to write 'old' Content
 
-        By default, Content subclasses have their .is_new property
-        checked before writing them out. But this can be overridden
+        By default, Content subclasses are checked against the build
+        manifest before writing them out. But this can be overridden
         by passing False for write_only_new in the process_blog call.
 
         This test only tests single Page for simplicity.
@@ -258,3 +574,318 @@ class TestFull(unittest.TestCase):
         majestic.process_blog(**kwargs)
         second_mtime = output.stat().st_mtime
         self.assertNotEqual(first_mtime, second_mtime)
+
+    def test_process_blog_parallel_jobs(self):
+        """process_blog writes the same files when parsing in parallel"""
+        majestic.process_blog(settings=self.settings, extensions=False,
+                              jobs=2)
+        os.chdir(str(self.outputdir))
+        for dirpath, dirnames, filenames in os.walk('.'):
+            self.assertTrue(dirpath in self.expected)
+            self.assertEqual(
+                set(self.expected[dirpath]['dirs']),
+                set(dirnames))
+
+    def test_process_blog_parallel_extensions(self):
+        """Extension objects are written when rendering in parallel"""
+        self.settings['templates']['post'] = 'extension-test.html'
+        self.settings['templates']['page'] = 'extension-test.html'
+        majestic.process_blog(settings=self.settings, index=False,
+                              archives=False, feeds=False, sitemap=False,
+                              jobs=2)
+        for name in ['extension-test.html', 'objects_to_write.html']:
+            self.assertTrue(self.outputdir.joinpath(name).exists())
+        for post in self.outputdir.glob('20*/*/*.html'):
+            with post.open() as f:
+                self.assertEqual(f.read().strip(), 'post')
+
+    def test_process_blog_content_cache(self):
+        """process_blog stores parsed content when the cache is enabled"""
+        cache_dir = self.outputdir.joinpath('.cache')
+        self.settings['paths']['cache root'] = str(cache_dir)
+        self.settings['cache']['parsed content'] = True
+        majestic.process_blog(settings=self.settings, extensions=False)
+        self.assertTrue(cache_dir.joinpath('content.pickle').exists())
+        # A warm build writes the same output
+        majestic.process_blog(settings=self.settings, extensions=False,
+                              write_only_new=False)
+        self.assertTrue(self.outputdir.joinpath('sitemap.xml').exists())
+
+    def test_process_blog_lazy(self):
+        """process_blog writes the same files when loading lazily"""
+        majestic.process_blog(settings=self.settings, extensions=False,
+                              lazy=True)
+        os.chdir(str(self.outputdir))
+        for dirpath, dirnames, filenames in os.walk('.'):
+            self.assertTrue(dirpath in self.expected)
+            self.assertEqual(
+                set(self.expected[dirpath]['dirs']),
+                set(dirnames))
+
+    def test_process_blog_batches(self):
+        """Building in batches writes the same files and releases bodies"""
+        def read_output():
+            contents = {}
+            for dirpath, dirnames, filenames in os.walk(str(self.outputdir)):
+                for name in filenames:
+                    if name not in {'rss.xml', 'sitemap.xml',
+                                    BuildManifest.filename}:
+                        path = Path(dirpath, name)
+                        contents[path] = path.read_bytes()
+            return contents
+
+        majestic.process_blog(settings=self.settings, write_only_new=False)
+        expected = read_output()
+        shutil.rmtree(str(self.outputdir))
+        with mock.patch.object(majestic.Content, 'release',
+                               autospec=True, return_value=True) as release:
+            majestic.process_blog(settings=self.settings, batch_size=4,
+                                  write_only_new=False)
+        self.assertEqual(read_output(), expected)
+        released = {id(call[0][0]) for call in release.call_args_list}
+        # Each post and page, including the two added by the extension
+        self.assertEqual(len(released), 14)
+
+    def test_process_blog_batches_share_pool(self):
+        """Every batch is converted and rendered by one pool of workers"""
+        initializers = []
+
+        def make_pool(*args, **kwargs):
+            initializers.append(kwargs.get('initializer'))
+            return ProcessPoolExecutor(*args, **kwargs)
+
+        with mock.patch('majestic.parallel.ProcessPoolExecutor',
+                        side_effect=make_pool):
+            majestic.process_blog(settings=self.settings, batch_size=4,
+                                  jobs=2, write_only_new=False)
+        render_initializers = [init for init in initializers
+                               if init is not parallel._init_worker]
+        self.assertEqual(render_initializers,
+                         [parallel._init_render_to_disk_worker])
+
+    def test_process_blog_sorts_posts_once(self):
+        """Without extensions the posts are sorted once, into SortedPosts
+
+        Each post's sort key is then only looked up once.
+        """
+        sort_key = majestic.Post.sort_key
+        looked_up = []
+
+        def counted_sort_key(post):
+            looked_up.append(post)
+            return sort_key.fget(post)
+
+        with mock.patch.object(majestic.Post, 'sort_key',
+                               property(counted_sort_key)):
+            majestic.process_blog(settings=self.settings, extensions=False,
+                                  write_only_new=False)
+        self.assertEqual(len(looked_up), len(set(map(id, looked_up))))
+
+    def test_process_blog_batches_content_cache(self):
+        """Posts taken from the content cache don't keep their bodies
+
+        Unchanged posts aren't in any batch, so they are never released,
+        and must not have their bodies loaded from cache entries written
+        by an earlier, unbatched build.
+        """
+        blogdir = Path(tempfile.mkdtemp(), 'blog')
+        self.addCleanup(shutil.rmtree, str(blogdir.parent))
+        shutil.copytree(str(self.blogdir), str(blogdir),
+                        ignore=shutil.ignore_patterns('output'))
+        os.chdir(str(blogdir))
+        settings = majestic.load_settings()
+        settings['paths']['output root'] = str(self.outputdir)
+        settings['cache']['parsed content'] = True
+        # Cache entries are written by a normal build, with bodies loaded
+        majestic.process_blog(settings=settings, extensions=False)
+        kwargs = dict(settings=settings, extensions=False, batch_size=2)
+
+        changed = sorted(majestic.markdown_files(blogdir.joinpath('posts')))[0]
+        changed.write_text(changed.read_text() + '\nMore text.\n')
+        stat = changed.stat()
+        os.utime(str(changed), ns=(stat.st_atime_ns,
+                                   stat.st_mtime_ns + 10 ** 9))
+
+        parsed = []
+        parse_content_files = majestic.parse_content_files
+
+        def record_parsed(*args, **kwargs):
+            content = parse_content_files(*args, **kwargs)
+            parsed.extend(content)
+            return content
+
+        with mock.patch('majestic.parse_content_files',
+                        side_effect=record_parsed):
+            majestic.process_blog(**kwargs)
+        unchanged = [c for c in parsed
+                     if c.source_path.resolve() != changed.resolve()]
+        self.assertEqual(len(unchanged), len(parsed) - 1)
+        self.assertEqual([c for c in unchanged if c._body is not None], [])
+
+    def test_process_blog_feed_html_shared(self):
+        """Feed html is made once per post, before the feeds are sent out
+
+        Each post's html is made absolute in this process, so the RSS
+        and JSON feeds share it even when rendered by different workers.
+        """
+        with mock.patch('majestic.content.absolute_urls',
+                        wraps=majestic.content.absolute_urls) as absolute:
+            majestic.process_blog(settings=self.settings, posts=False,
+                                  pages=False, index=False, archives=False,
+                                  sitemap=False, extensions=False, jobs=2)
+        self.assertEqual(absolute.call_count,
+                         self.settings['feeds']['number of posts'])
+        for name in self.expected['.']['feeds']:
+            self.assertTrue(self.outputdir.joinpath(name).exists())
+
+    def test_process_blog_template_change(self):
+        """Editing a template rewrites only the content that uses it"""
+        templates = self.outputdir.joinpath('.templates')
+        shutil.copytree(self.settings['paths']['templates root'],
+                        str(templates))
+        self.settings['paths']['templates root'] = str(templates)
+        kwargs = dict(settings=self.settings, posts=True, pages=True,
+                      index=False, archives=False, feeds=False,
+                      sitemap=False, extensions=False)
+        majestic.process_blog(**kwargs)
+        page = self.outputdir.joinpath(self.expected['.']['pages'][0])
+        post = self.outputdir.joinpath(
+            '2015', '06', self.expected['./2015/06']['posts'][0])
+        page_mtime = page.stat().st_mtime
+        post_mtime = post.stat().st_mtime
+        time.sleep(2)
+        post_template = templates.joinpath('post.html')
+        post_template.write_text(post_template.read_text() + '\n')
+        majestic.process_blog(**kwargs)
+        self.assertEqual(page_mtime, page.stat().st_mtime)
+        self.assertNotEqual(post_mtime, post.stat().st_mtime)
+
+
+class TestMain(unittest.TestCase):
+    """Test the command-line interface"""
+    def test_rejects_jobs(self):
+        """A --jobs that isn't a whole number of at least 0 is a usage error"""
+        for value in ['-3', 'x']:
+            with self.subTest(value=value), \
+                    self.assertRaises(SystemExit) as exit:
+                majestic.main(['--jobs={0}'.format(value)])
+            self.assertIn('--jobs', str(exit.exception.code))
+
+    def test_rejects_batch_size(self):
+        """A --batch-size below 1 is a usage error"""
+        for value in ['0', '-3', 'many']:
+            with self.subTest(value=value), \
+                    self.assertRaises(SystemExit) as exit:
+                majestic.main(['--batch-size={0}'.format(value)])
+            self.assertIn('--batch-size', str(exit.exception.code))
+
+
+class FakeWatcher(object):
+    """Reports each set of changes in turn, then raises KeyboardInterrupt"""
+    def __init__(self, *changes):
+        self._changes = list(changes)
+        self.closed = False
+
+    def changes(self, timeout=None):
+        if not self._changes:
+            raise KeyboardInterrupt
+        return set(self._changes.pop(0))
+
+    def close(self):
+        self.closed = True
+
+
+class TestWatchAndRebuild(unittest.TestCase):
+    """Test rebuilding the blog when its source changes"""
+    def setUp(self):
+        os.chdir(str(TESTS_DIR.joinpath('test-full')))
+        self.settings = majestic.load_settings()
+        self.settings_file = Path('settings.json').resolve()
+        self.post = Path('posts', 'example.md').resolve()
+        self.reloaded = majestic.load_settings()
+        self.builds = []
+
+    def build(self, settings, content_cache):
+        self.builds.append((settings, content_cache))
+
+    def run_watch(self, *changes, build=None):
+        with self.assertRaises(KeyboardInterrupt), \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            majestic.watch_and_rebuild(
+                settings=self.settings, reload_settings=lambda: self.reloaded,
+                build=build or self.build, settings_files=['settings.json'],
+                watcher=FakeWatcher(*changes))
+        return stderr.getvalue()
+
+    def test_rebuild_on_change(self):
+        """Each change causes a rebuild using the same content cache"""
+        self.run_watch([self.post], [], [self.post])
+        self.assertEqual(len(self.builds), 2)
+        (first_settings, first_cache), (_, second_cache) = self.builds
+        self.assertIs(first_settings, self.settings)
+        self.assertIs(first_cache, second_cache)
+        self.assertIsNone(first_cache.path)
+
+    def test_settings_change(self):
+        """Settings are reloaded and the cache discarded when they change"""
+        self.run_watch([self.post], [self.settings_file])
+        (_, first_cache), (settings, second_cache) = self.builds
+        self.assertIs(settings, self.reloaded)
+        self.assertIsNot(first_cache, second_cache)
+
+    def test_extension_change(self):
+        """Extension modules are reloaded when one of them changes"""
+        extension = Path(self.settings['paths']['extensions root'],
+                         'test.py').resolve()
+        with mock.patch('majestic.reload_extensions') as reload_extensions:
+            self.run_watch([self.post])
+            reload_extensions.assert_not_called()
+            self.run_watch([extension])
+        reload_extensions.assert_called_once_with(extension.parent)
+
+    def test_build_error(self):
+        """An error while building is printed and watching continues"""
+        def build(settings, content_cache):
+            self.builds.append(settings)
+            raise ValueError('Broken template')
+        output = self.run_watch([self.post], [self.post], build=build)
+        self.assertEqual(len(self.builds), 2)
+        self.assertIn('ValueError: Broken template', output)
+
+    def test_build_exit(self):
+        """A build exiting with a message is printed without a traceback"""
+        def build(settings, content_cache):
+            self.builds.append(settings)
+            raise SystemExit('majestic: not a git repository')
+        output = self.run_watch([self.post], [self.post], build=build)
+        self.assertEqual(len(self.builds), 2)
+        self.assertIn('majestic: not a git repository', output)
+        self.assertNotIn('Traceback', output)
+
+    def test_broken_settings(self):
+        """A settings file that fails to load is printed and watching continues
+
+        The first build breaks the settings file, so reloading it raises
+        an error. The next change is built with the settings in use
+        before the settings file was broken.
+        """
+        temp_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(temp_dir))
+        settings_file = temp_dir.joinpath('settings.json')
+        settings_file.write_text('{}')
+
+        def build(settings, content_cache):
+            self.builds.append(settings)
+            settings_file.write_text('{"site": ')
+
+        with self.assertRaises(KeyboardInterrupt), \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            majestic.watch_and_rebuild(
+                settings=self.settings,
+                reload_settings=lambda: majestic.load_settings(
+                    local=False, files=[settings_file]),
+                build=build, settings_files=[settings_file],
+                watcher=FakeWatcher([self.post], [settings_file],
+                                    [self.post]))
+        self.assertEqual(self.builds, [self.settings, self.settings])
+        self.assertIn('JSONDecodeError', stderr.getvalue())
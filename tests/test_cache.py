@@ -0,0 +1,257 @@
+import unittest
+from majestic import load_settings
+from majestic.cache import (
+    ContentCache, HTMLBudget, HTMLCache, dumps_with_settings,
+    loads_with_settings
+    )
+from majestic.content import Post, Page
+from majestic.parallel import parse_content_files
+
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+import time
+from unittest import mock
+
+
+TESTS_DIR = Path(__file__).resolve().parent
+TEST_BLOG_DIR = TESTS_DIR.joinpath('test-blog')
+
+
+class TestContentCache(unittest.TestCase):
+    """Test the on-disk cache of parsed content"""
+    def setUp(self):
+        os.chdir(str(TEST_BLOG_DIR))
+        settings_path = TEST_BLOG_DIR.joinpath('settings.json')
+        self.settings = load_settings(files=[settings_path], local=False)
+        self.cache_dir = Path(tempfile.mkdtemp())
+        self.source_dir = Path(tempfile.mkdtemp())
+        self.source = self.source_dir.joinpath('post.md')
+        self.source.write_text(
+            'title: Cached\ndate: 2015-01-01 12:00\n\nSome *body* text.')
+
+    def tearDown(self):
+        shutil.rmtree(str(self.cache_dir))
+        shutil.rmtree(str(self.source_dir))
+
+    def parse(self, cache):
+        return parse_content_files(Post, [self.source], self.settings,
+                                   cache=cache)
+
+    def test_pickle_with_settings(self):
+        """Settings are left out when pickling and restored on loading"""
+        post = Post.from_file(self.source, self.settings)
+        data = dumps_with_settings(post, self.settings)
+        other_settings = load_settings(
+            files=[TEST_BLOG_DIR.joinpath('settings.json')], local=False)
+        restored = loads_with_settings(data, other_settings)
+        self.assertIs(restored._settings, other_settings)
+        self.assertEqual(post, restored)
+
+    def test_cache_miss_then_hit(self):
+        """Cached objects are used on the next run without parsing"""
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.assertIsNone(cache.get(Post, self.source))
+        first = self.parse(cache)
+        cache.save()
+
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        with mock.patch.object(Post, 'from_file') as from_file:
+            second = self.parse(cache)
+        from_file.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertIs(second[0]._settings, self.settings)
+
+    def test_cache_hit_without_body(self):
+        """Cached objects read their body from file when it's needed
+
+        The body read by a normal build is not stored, so a lazy build
+        using the cache gets objects without bodies loaded.
+        """
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        first = self.parse(cache)
+        self.assertIsNotNone(first[0]._body)
+        cache.save()
+
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        second = parse_content_files(Post, [self.source], self.settings,
+                                     cache=cache, lazy=True)
+        self.assertIsNone(second[0]._body)
+        self.assertEqual(second[0].body, first[0].body)
+
+    def test_in_memory_cache(self):
+        """A cache without a directory keeps entries between builds"""
+        cache = ContentCache(directory=None, settings=self.settings)
+        first = self.parse(cache)
+        cache.save()
+        self.assertEqual(os.listdir(str(self.cache_dir)), [])
+
+        for build in range(2):
+            with mock.patch.object(Post, 'from_file') as from_file:
+                self.assertEqual(self.parse(cache), first)
+            from_file.assert_not_called()
+            cache.save()
+
+    def test_cache_invalidated_by_change(self):
+        """Changing the source file invalidates its cache entry"""
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.parse(cache)
+        cache.save()
+
+        self.source.write_text(
+            'title: Changed\ndate: 2015-01-01 12:00\n\nNew body text.')
+        stat = self.source.stat()
+        os.utime(str(self.source), ns=(stat.st_atime_ns,
+                                       stat.st_mtime_ns + 10 ** 9))
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.assertIsNone(cache.get(Post, self.source))
+        self.assertEqual(self.parse(cache)[0].title, 'Changed')
+
+    def test_cache_keyed_on_class(self):
+        """A file cached as a Post is not returned as a Page"""
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.parse(cache)
+        self.assertIsNone(cache.get(Page, self.source))
+
+    def test_cache_discarded_on_date_settings_change(self):
+        """Changing the date settings discards the whole cache"""
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.parse(cache)
+        cache.save()
+
+        self.settings['dates']['timezone'] = 'Asia/Tokyo'
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.assertIsNone(cache.get(Post, self.source))
+
+    def test_cache_discarded_on_format_change(self):
+        """A cache written in an older format is discarded"""
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.parse(cache)
+        cache.save()
+
+        with mock.patch.object(ContentCache, 'format_version',
+                               ContentCache.format_version + 1):
+            cache = ContentCache.load(self.cache_dir, self.settings)
+        self.assertIsNone(cache.get(Post, self.source))
+
+    def test_unusable_entry_ignored(self):
+        """An entry that can't be unpickled is treated as missing"""
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.parse(cache)
+        key = cache._key(Post, self.source)
+        identity, data = cache._stored[key]
+        cache._stored[key] = (identity, b'junk')
+        for trust in [False, True]:
+            self.assertIsNone(cache.get(Post, self.source, trust=trust))
+        self.assertEqual(self.parse(cache)[0].title, 'Cached')
+
+    def test_save_drops_unused_entries(self):
+        """Entries not used since loading are not saved again"""
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.parse(cache)
+        cache.save()
+
+        ContentCache.load(self.cache_dir, self.settings).save()
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.assertIsNone(cache.get(Post, self.source))
+
+    def test_corrupt_cache_ignored(self):
+        """An unreadable cache file gives an empty cache"""
+        self.cache_dir.joinpath(ContentCache.filename).write_bytes(b'junk')
+        cache = ContentCache.load(self.cache_dir, self.settings)
+        self.assertIsNone(cache.get(Post, self.source))
+
+
+class TestHTMLCache(unittest.TestCase):
+    """Test the on-disk cache of html rendered from markdown"""
+    def setUp(self):
+        self.cache_dir = Path(tempfile.mkdtemp())
+        self.cache = HTMLCache(self.cache_dir, fingerprint='abc')
+
+    def tearDown(self):
+        shutil.rmtree(str(self.cache_dir))
+
+    def entries(self):
+        return list(self.cache_dir.glob('*/*.html'))
+
+    def test_get_put(self):
+        """Stored html is returned for the same markdown text"""
+        self.assertIsNone(self.cache.get('*a*'))
+        self.cache.put('*a*', '<p><em>a</em></p>\r\n')
+        self.assertEqual(self.cache.get('*a*'), '<p><em>a</em></p>\r\n')
+
+    def test_fingerprint_in_key(self):
+        """Entries are not shared between different fingerprints"""
+        self.cache.put('*a*', '<p><em>a</em></p>')
+        other = HTMLCache(self.cache_dir, fingerprint='xyz')
+        self.assertIsNone(other.get('*a*'))
+
+    def test_prune_by_age(self):
+        """prune removes entries not used within max_age seconds"""
+        self.cache.put('old', '<p>old</p>')
+        self.cache.put('new', '<p>new</p>')
+        old_path = self.cache._path('old')
+        past = time.time() - 1000
+        os.utime(str(old_path), (past, past))
+        self.cache.prune(max_age=500)
+        self.assertEqual(self.entries(), [self.cache._path('new')])
+
+    def test_prune_by_size(self):
+        """prune removes least recently used entries over max_bytes"""
+        for n in range(5):
+            self.cache.put(str(n), 'x' * 10)
+            past = time.time() - 1000 + n
+            os.utime(str(self.cache._path(str(n))), (past, past))
+        self.cache.get('0')         # Most recently used
+        self.cache.prune(max_bytes=25)
+        self.assertEqual(set(self.entries()),
+                         {self.cache._path('0'), self.cache._path('4')})
+
+
+class TestHTMLBudget(unittest.TestCase):
+    """Test the least-recently-used limit on html held in memory"""
+    def setUp(self):
+        self.html = 'x' * 100
+        self.size = sys.getsizeof(self.html)
+        self.pages = [mock.Mock() for n in range(3)]
+
+    def test_evicts_least_recently_used(self):
+        """Html over the budget is discarded, oldest use first"""
+        budget = HTMLBudget(max_bytes=self.size * 2)
+        first, second, third = self.pages
+        budget.add(first, self.html)
+        budget.add(second, self.html)
+        budget.touch(first)
+        budget.add(third, self.html)
+        second._evict_html.assert_called_once_with()
+        first._evict_html.assert_not_called()
+        self.assertEqual(len(budget), 2)
+        self.assertEqual(budget.size, self.size * 2)
+
+    def test_keeps_newest_over_budget(self):
+        """Html larger than the whole budget is kept until replaced"""
+        budget = HTMLBudget(max_bytes=1)
+        first, second, third = self.pages
+        budget.add(first, self.html)
+        first._evict_html.assert_not_called()
+        budget.add(second, self.html)
+        first._evict_html.assert_called_once_with()
+        self.assertEqual(len(budget), 1)
+
+    def test_discard(self):
+        """Discarded html no longer counts towards the budget"""
+        budget = HTMLBudget(max_bytes=self.size * 2)
+        first, second, third = self.pages
+        budget.add(first, self.html)
+        budget.add(second, self.html)
+        budget.discard(first)
+        budget.add(third, self.html)
+        self.assertEqual(budget.size, self.size * 2)
+        for page in self.pages:
+            page._evict_html.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -3,14 +3,18 @@ import majestic
 from majestic.content import (
     BlogObject, Content, Page, Post, ModificationDateError
     )
-from majestic.utils import markdown_files
+from majestic.utils import absolute_urls, markdown_files
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from operator import attrgetter
 import os
 from pathlib import Path
+import pickle
+import random
 import string
 import tempfile
 import time
+from unittest import mock
 
 import pytz
 
@@ -480,6 +484,54 @@ class TestContent(unittest.TestCase):
         content.is_new = True
         self.assertTrue(content.is_new)
 
+    def test_content_marked_new(self):
+        """Content.marked_new is True only once is_new is set to True
+
+        A newer source file makes is_new True, but doesn't mark it.
+        """
+        content = Content(title=self.title, body=self.body,
+                          slug=self.slug, settings=self.settings,
+                          source_path=self.newest_file)
+        content.output_path = self.oldest_file
+        self.assertTrue(content.is_new)
+        self.assertFalse(content.marked_new)
+        content.is_new = True
+        self.assertTrue(content.marked_new)
+
+    def test_content_slots(self):
+        """Content, Page and Post have no instance dictionary"""
+        for content in [Content(title=self.title, body=self.body,
+                                settings=self.settings),
+                        Page(title=self.title, body=self.body,
+                             settings=self.settings),
+                        Post(title=self.title, body=self.body,
+                             date=datetime(2015, 1, 1),
+                             settings=self.settings)]:
+            self.assertFalse(hasattr(content, '__dict__'))
+
+    def test_content_attributes_in_meta(self):
+        """Other attributes are stored in and looked up from meta"""
+        content = Content(title=self.title, body=self.body,
+                          settings=self.settings, author='Rob')
+        self.assertEqual(content.author, 'Rob')
+        content.test_attr = 'page'
+        self.assertEqual(content.meta, {'author': 'Rob', 'test_attr': 'page'})
+        del content.author
+        self.assertFalse(hasattr(content, 'author'))
+        self.assertFalse(hasattr(content, '_html'))     # Not yet computed
+        with self.assertRaises(AttributeError):
+            del content.author
+
+    def test_content_pickle(self):
+        """Content with computed and extra attributes can be pickled"""
+        content = Content(title=self.title, body='*text*',
+                          settings=self.settings, author='Rob')
+        content.html
+        content.test_attr = 'page'
+        restored = pickle.loads(pickle.dumps(content))
+        self.assertEqual(restored.meta, content.meta)
+        self.assertEqual(restored._html, content._html)
+
     def test_content_lt_title(self):
         """Content with different titles compare properly"""
         post_1 = Content(title='title a',
@@ -512,6 +564,38 @@ class TestContent(unittest.TestCase):
         self.assertTrue(post_1 < post_2)
         self.assertFalse(post_2 < post_1)
 
+    def test_content_feed_html(self):
+        """Content.feed_html is html with absolute URLs"""
+        content = Content(title=self.title, body='[a](/a)',
+                          settings=self.settings)
+        self.assertEqual(
+            content.feed_html,
+            '<p><a href="http://www.example.com/a">a</a></p>')
+
+    def test_content_feed_html_stored(self):
+        """Content.feed_html is computed once for the same site URL"""
+        content = Content(title=self.title, body='[a](/a)',
+                          settings=self.settings)
+        with mock.patch('majestic.content.absolute_urls',
+                        side_effect=absolute_urls) as mock_absolute:
+            content.feed_html
+            content.feed_html
+        self.assertEqual(mock_absolute.call_count, 1)
+
+    def test_content_feed_html_invalidated(self):
+        """Content.feed_html changes with the body and site URL"""
+        content = Content(title=self.title, body='[a](/a)',
+                          settings=self.settings)
+        content.feed_html
+        content.body = '[b](/b)'
+        self.assertEqual(
+            content.feed_html,
+            '<p><a href="http://www.example.com/b">b</a></p>')
+        self.settings['site']['url'] = 'http://example.org'
+        self.assertEqual(
+            content.feed_html,
+            '<p><a href="http://example.org/b">b</a></p>')
+
 
 class TestPage(unittest.TestCase):
     """Test the Page content classes"""
@@ -710,6 +794,37 @@ class TestPost(unittest.TestCase):
                       date=self.naive_date, settings=self.settings)
         self.assertLess(post_1, post_2)
 
+    def test_post_sort_key(self):
+        """Sorting by sort_key gives the same order as comparing Posts"""
+        posts = [
+            Post(title=title, slug=slug, body=self.body, date=date,
+                 settings=self.settings)
+            for date in [datetime(2014, 1, 1), datetime(2015, 1, 1)]
+            for title in ['title a', 'Title A', 'title B']
+            for slug in ['slug-b', 'Slug-a']
+            ]
+        random.shuffle(posts)
+        by_key = sorted(posts, key=attrgetter('sort_key'))
+        self.assertEqual([id(post) for post in by_key],
+                         [id(post) for post in sorted(posts)])
+        self.assertEqual(by_key[0].sort_key,
+                         (by_key[0].date, 'title a', 'slug-a'))
+
+    def test_post_sort_key_stored(self):
+        """sort_key is stored, and discarded when date, title or slug change"""
+        post = Post(title='title a', slug='slug-a', body=self.body,
+                    date=self.naive_date, settings=self.settings)
+        key = post.sort_key
+        self.assertIs(post.sort_key, key)
+        post.author = 'Someone'
+        self.assertIs(post.sort_key, key)
+        post.title = 'Title B'
+        self.assertEqual(post.sort_key[1], 'title b')
+        post.slug = 'Slug-B'
+        self.assertEqual(post.sort_key[2], 'slug-b')
+        post.date = post.date - timedelta(days=1)
+        self.assertEqual(post.sort_key[0], post.date)
+
     def test_post_future_date_raises_DraftPost(self):
         """Initialising a Post with a future date raises DraftError"""
         with self.assertRaises(majestic.DraftError):
@@ -852,3 +967,89 @@ class TestFromFile(unittest.TestCase):
             Post.from_file(
                 file=self.posts_path.joinpath('test_explicit_draft.md'),
                 settings=self.settings)
+
+    def test_lazy_reads_header_only(self):
+        """.from_file with lazy=True doesn't read the body up front"""
+        page = Page.from_file(self.pages_path.joinpath('about.md'),
+                              settings=self.settings, lazy=True)
+        self.assertEqual(page.title, 'About majestic')
+        self.assertIsNone(page._body)
+
+    def test_lazy_body_loaded_on_access(self):
+        """A lazily loaded body is read from the source file when used"""
+        about = self.pages_path.joinpath('about.md')
+        eager = Page.from_file(about, settings=self.settings)
+        lazy = Page.from_file(about, settings=self.settings, lazy=True)
+        self.assertEqual(eager.body, lazy.body)
+        self.assertEqual(eager.html, lazy.html)
+        self.assertEqual(eager, lazy)
+
+    def test_lazy_explicit_draft(self):
+        """.from_file with lazy=True raises DraftError for drafts"""
+        with self.assertRaises(majestic.DraftError):
+            Post.from_file(
+                file=self.posts_path.joinpath('test_explicit_draft.md'),
+                settings=self.settings, lazy=True)
+
+    def test_release(self):
+        """Released content reads its body from the source file again"""
+        page = Page.from_file(self.pages_path.joinpath('about.md'),
+                              settings=self.settings)
+        body, html = page.body, page.html
+        self.assertTrue(page.release())
+        self.assertIsNone(page._body)
+        self.assertFalse(hasattr(page, '_html'))
+        self.assertEqual(page.body, body)
+        self.assertEqual(page.html, html)
+
+    def test_release_keeps_changes(self):
+        """Content whose body or html was set is not released"""
+        about = self.pages_path.joinpath('about.md')
+        changed_body = Page.from_file(about, settings=self.settings)
+        changed_body.body = '*New*'
+        changed_html = Page.from_file(about, settings=self.settings)
+        changed_html.html = '<p>New</p>'
+        no_source = Page(title='Page', body='Body', settings=self.settings)
+        for page in [changed_body, changed_html, no_source]:
+            self.assertFalse(page.release())
+        self.assertEqual(changed_body.body, '*New*')
+        self.assertEqual(changed_html.html, '<p>New</p>')
+
+    def test_html_budget(self):
+        """Html over the memory budget is discarded and converted again"""
+        self.settings['cache']['html memory megabytes'] = 0
+        try:
+            about = self.pages_path.joinpath('about.md')
+            first, second = [Page.from_file(about, settings=self.settings)
+                             for n in range(2)]
+            html = first.html
+            second.html
+            self.assertFalse(hasattr(first, '_html'))
+            self.assertTrue(hasattr(second, '_html'))
+            self.assertEqual(first.html, html)
+            self.assertFalse(hasattr(second, '_html'))
+        finally:
+            majestic.md.reset_html_budget()
+
+    def test_html_budget_keeps_set_html(self):
+        """Html set directly is never discarded by the memory budget"""
+        self.settings['cache']['html memory megabytes'] = 0
+        try:
+            about = self.pages_path.joinpath('about.md')
+            changed, other = [Page.from_file(about, settings=self.settings)
+                              for n in range(2)]
+            changed.html
+            changed.html = '<p>New</p>'
+            other.html
+            self.assertEqual(changed._html, '<p>New</p>')
+            self.assertEqual(len(majestic.md.HTML_BUDGET), 1)
+        finally:
+            majestic.md.reset_html_budget()
+
+    def test_setting_body_discards_html(self):
+        """Setting the body of content discards rendered html"""
+        page = Page.from_file(self.pages_path.joinpath('about.md'),
+                              settings=self.settings)
+        page.html
+        page.body = '*New*'
+        self.assertEqual(page.html, '<p><em>New</em></p>')
@@ -0,0 +1,182 @@
+import unittest
+import majestic
+from majestic import daemon
+
+import json
+import os
+from pathlib import Path
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+
+TESTS_DIR = Path(__file__).resolve().parent
+CLIENT = TESTS_DIR.parent.joinpath('bin', 'majestic-build')
+
+
+class TestBuildDaemon(unittest.TestCase):
+    """Test building a site on request while keeping it loaded"""
+    def setUp(self):
+        self.blogdir = Path(tempfile.mkdtemp()).joinpath('blog')
+        self.addCleanup(shutil.rmtree, str(self.blogdir.parent))
+        shutil.copytree(str(TESTS_DIR.joinpath('test-full')),
+                        str(self.blogdir))
+        os.chdir(str(self.blogdir))
+        self.configured = 0
+        self.builds = []
+        self.builder = daemon.BuildDaemon(configure=self.configure,
+                                          build=self.build,
+                                          settings_files=['settings.json'])
+        self.addCleanup(self.builder.close)
+
+    def configure(self):
+        self.configured += 1
+        return majestic.load_settings()
+
+    def build(self, settings, args, content_cache, environment):
+        self.builds.append((settings, content_cache, environment))
+        if args == ['fail']:
+            raise ValueError('Broken template')
+        elif args == ['bad-args']:
+            raise SystemExit('Unknown option')
+        print('Built with', *args)
+
+    def test_state_kept(self):
+        """Settings, content cache and environment are kept between builds"""
+        self.assertEqual(self.builder.build(['--skip-feeds']),
+                         (0, 'Built with --skip-feeds\n'))
+        self.builder.build([])
+        first, second = self.builds
+        self.assertEqual(first, second)
+        self.assertEqual(self.configured, 1)
+
+    def test_template_change(self):
+        """A new environment is created when a template changes"""
+        self.builder.build([])
+        template = self.blogdir.joinpath('templates', 'post.html')
+        template.write_text(template.read_text() + '\n')
+        self.builder.build([])
+        (_, first_cache, first_env), (_, second_cache, second_env) = \
+            self.builds
+        self.assertIsNot(first_env, second_env)
+        self.assertIs(first_cache, second_cache)
+
+    def test_settings_change(self):
+        """Settings are reloaded and the cache discarded when they change"""
+        self.builder.build([])
+        settings_file = self.blogdir.joinpath('settings.json')
+        settings_file.write_text(settings_file.read_text() + '\n')
+        self.builder.build([])
+        (first_settings, first_cache, _), (second_settings, second_cache, _) \
+            = self.builds
+        self.assertEqual(self.configured, 2)
+        self.assertIsNot(first_settings, second_settings)
+        self.assertIsNot(first_cache, second_cache)
+
+    def test_broken_settings_retried(self):
+        """Settings that fail to reload are tried again on the next build
+
+        Later builds report the error too, rather than quietly using the
+        settings loaded before the file was broken.
+        """
+        self.builder.build([])
+        settings_file = self.blogdir.joinpath('settings.json')
+        text = settings_file.read_text()
+        settings_file.write_text('{"site": ')
+        for _ in range(2):
+            status, output = self.builder.build([])
+            self.assertEqual(status, 1)
+            self.assertIn('JSONDecodeError', output)
+        self.assertEqual(len(self.builds), 1)
+        settings_file.write_text(text)
+        self.assertEqual(self.builder.build([]),
+                         (0, 'Built with\n'))
+        self.assertEqual(len(self.builds), 2)
+
+    def test_errors_reported(self):
+        """Errors are returned as output with a non-zero status"""
+        status, output = self.builder.build(['fail'])
+        self.assertEqual(status, 1)
+        self.assertIn('ValueError: Broken template', output)
+        self.assertEqual(self.builder.build(['bad-args']),
+                         (1, 'Unknown option\n'))
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix sockets')
+class TestServe(unittest.TestCase):
+    """Test requesting builds over the daemon's socket"""
+    def setUp(self):
+        self.blogdir = Path(tempfile.mkdtemp()).joinpath('blog')
+        self.addCleanup(shutil.rmtree, str(self.blogdir.parent))
+        shutil.copytree(str(TESTS_DIR.joinpath('test-full')),
+                        str(self.blogdir))
+        os.chdir(str(self.blogdir))
+        self.socket = self.blogdir.joinpath('build.sock')
+
+        def build(settings, args, content_cache, environment):
+            majestic.process_blog(settings=settings,
+                                  content_cache=content_cache,
+                                  environment=environment,
+                                  feeds='--skip-feeds' not in args)
+
+        builder = daemon.BuildDaemon(configure=majestic.load_settings,
+                                     build=build)
+        self.addCleanup(builder.close)
+        ready = threading.Event()
+        servers = []
+
+        def on_ready(server):
+            servers.append(server)
+            ready.set()
+
+        thread = threading.Thread(
+            target=daemon.serve, args=(builder, self.socket, on_ready))
+        thread.start()
+        ready.wait(5)
+        self.addCleanup(thread.join)
+        self.addCleanup(servers[0].shutdown)
+
+    def request(self, *args):
+        return subprocess.run(
+            [sys.executable, str(CLIENT),
+             '--socket={0}'.format(self.socket), *args],
+            stderr=subprocess.PIPE, universal_newlines=True)
+
+    def test_build_requests(self):
+        """Builds are run for the client and the socket is private"""
+        self.assertEqual(self.socket.stat().st_mode & 0o777, 0o600)
+        result = self.request('--skip-feeds')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        output = self.blogdir.joinpath('output')
+        self.assertTrue(output.joinpath('index.html').exists())
+        self.assertFalse(output.joinpath('rss.xml').exists())
+        self.assertEqual(self.request().returncode, 0)
+        self.assertTrue(output.joinpath('rss.xml').exists())
+
+    def test_invalid_request(self):
+        """Malformed requests get an error response"""
+        with socket.socket(socket.AF_UNIX) as connection:
+            connection.connect(str(self.socket))
+            connection.sendall(b'not json\n')
+            response = json.loads(connection.makefile().readline())
+        self.assertEqual(response['status'], 2)
+
+    def test_daemon_already_running(self):
+        """A second daemon can't take over a socket in use"""
+        with self.assertRaises(OSError):
+            daemon.serve(None, self.socket)
+
+    def test_no_daemon(self):
+        """The client reports that no daemon is listening"""
+        result = subprocess.run(
+            [sys.executable, str(CLIENT), '--socket=missing.sock'],
+            stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn('Could not connect', result.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,86 @@
+import unittest
+import majestic.git as git
+
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
+
+
+GIT_ENV = dict(os.environ,
+               GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='Test',
+               GIT_COMMITTER_EMAIL='test@example.com')
+
+
+def run_git(directory, *args):
+    """Run git in directory, for setting up test repositories"""
+    subprocess.run(['git', '-C', str(directory), *args], env=GIT_ENV,
+                   check=True, stdout=subprocess.DEVNULL)
+
+
+@unittest.skipUnless(shutil.which('git'), 'git is not installed')
+class TestGit(unittest.TestCase):
+    """Test finding source files and changes with git"""
+    def setUp(self):
+        self.repo = Path(tempfile.mkdtemp())
+        self.content = self.repo.joinpath('content')
+        self.content.mkdir()
+        for name in ['a.md', 'b.md', 'c.md', 'notes.txt']:
+            self.content.joinpath(name).write_text(name)
+        self.repo.joinpath('outside.md').write_text('outside')
+        run_git(self.repo, 'init', '-q')
+        run_git(self.repo, 'add', '.')
+        run_git(self.repo, 'commit', '-q', '-m', 'First')
+        self.first = git.head_commit(self.content)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.repo))
+
+    def path(self, name):
+        return Path(self.content, name)
+
+    def test_markdown_files(self):
+        """Tracked and untracked markdown files are listed"""
+        self.path('c.md').unlink()
+        self.path('d.md').write_text('d')
+        self.assertEqual(sorted(git.markdown_files(self.content)),
+                         [self.path('a.md'), self.path('b.md'),
+                          self.path('d.md')])
+
+    def test_markdown_files_missing_directory(self):
+        """No files are listed for a directory that doesn't exist"""
+        self.assertEqual(git.markdown_files(self.path('pages')), [])
+
+    def test_changed_files(self):
+        """Committed, uncommitted and untracked changes are found"""
+        self.path('a.md').write_text('changed')
+        run_git(self.repo, 'commit', '-q', '-am', 'Second')
+        self.assertNotEqual(git.head_commit(self.content), self.first)
+        self.path('b.md').write_text('not committed')
+        self.path('d.md').write_text('untracked')
+        self.repo.joinpath('outside.md').write_text('changed')
+        self.assertEqual(git.changed_files(self.content, self.first),
+                         {self.path('a.md'), self.path('b.md'),
+                          self.path('d.md')})
+
+    def test_no_changes(self):
+        """Nothing is reported as changed since the current commit"""
+        self.assertEqual(git.changed_files(self.content, self.first), set())
+
+    def test_unknown_commit(self):
+        """GitError is raised for a commit not in the repository"""
+        with self.assertRaises(git.GitError):
+            git.changed_files(self.content, '0' * 40)
+
+    def test_not_a_repository(self):
+        """GitError is raised outside of a repository"""
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(directory))
+        with self.assertRaises(git.GitError):
+            git.head_commit(directory)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
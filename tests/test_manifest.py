@@ -0,0 +1,171 @@
+import unittest
+from majestic import load_settings
+from majestic.content import Page, Post
+from majestic.manifest import BuildManifest, settings_fingerprint
+
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+
+TESTS_DIR = Path(__file__).resolve().parent
+TEST_BLOG_DIR = TESTS_DIR.joinpath('test-blog')
+
+
+class TestBuildManifest(unittest.TestCase):
+    """Test recording what each output file was built from"""
+    def setUp(self):
+        os.chdir(str(TEST_BLOG_DIR))
+        settings_path = TEST_BLOG_DIR.joinpath('settings.json')
+        self.settings = load_settings(files=[settings_path], local=False)
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.templates = self.temp_dir.joinpath('templates')
+        self.templates.mkdir()
+        self.templates.joinpath('base.html').write_text('{{ content.body }}')
+        self.templates.joinpath('post.html').write_text(
+            '{% extends "base.html" %}')
+        self.templates.joinpath('page.html').write_text('Page')
+        self.output = self.temp_dir.joinpath('output')
+        self.settings['paths']['output root'] = str(self.output)
+        self.settings['paths']['templates root'] = str(self.templates)
+        self.source = self.temp_dir.joinpath('post.md')
+        self.source.write_text(
+            'title: A post\ndate: 2015-01-01 12:00\n\nBody')
+        self.manifest = self.load()
+
+    def tearDown(self):
+        shutil.rmtree(str(self.temp_dir))
+
+    def load(self):
+        return BuildManifest.load(self.templates, self.settings)
+
+    def post(self):
+        return Post.from_file(self.source, self.settings)
+
+    def written(self, obj):
+        """Write obj's output file, record it and return obj"""
+        obj.output_path.parent.mkdir(parents=True, exist_ok=True)
+        obj.output_path.touch()
+        self.manifest.record(obj)
+        return obj
+
+    def test_unrecorded_is_stale(self):
+        """Outputs with no record are stale"""
+        post = self.post()
+        post.output_path.parent.mkdir(parents=True)
+        post.output_path.touch()
+        self.assertTrue(self.manifest.is_stale(post))
+
+    def test_recorded_not_stale(self):
+        """Outputs recorded from unchanged sources are not stale"""
+        self.assertFalse(self.manifest.is_stale(self.written(self.post())))
+
+    def test_missing_output_stale(self):
+        """Recorded outputs that have been deleted are stale"""
+        post = self.written(self.post())
+        post.output_path.unlink()
+        self.assertTrue(self.manifest.is_stale(post))
+
+    def test_no_source_stale(self):
+        """Objects without a source file are always stale"""
+        page = Page(title='a', body='', settings=self.settings)
+        self.assertTrue(self.manifest.is_stale(self.written(page)))
+
+    def test_touched_source_not_stale(self):
+        """A source file with a new mtime but the same bytes isn't stale
+
+        This is what happens to every file in a fresh checkout.
+        """
+        self.written(self.post())
+        future = time.time() + 100
+        os.utime(str(self.source), (future, future))
+        post = self.post()
+        self.assertTrue(post.is_new)
+        self.assertFalse(self.manifest.is_stale(post))
+
+    def test_edited_source_stale(self):
+        """Changing the source file makes its output stale"""
+        self.written(self.post())
+        self.source.write_text(
+            'title: A post\ndate: 2015-01-01 12:00\n\nNew')
+        self.assertTrue(self.manifest.is_stale(self.post()))
+
+    def test_edited_template_stale(self):
+        """Editing a template makes only outputs that use it stale"""
+        post = self.written(self.post())
+        page = self.written(Page.from_file(self.source, self.settings))
+        self.manifest.save()
+        self.templates.joinpath('base.html').write_text('{{ content }}')
+        manifest = self.load()
+        self.assertTrue(manifest.is_stale(post))
+        self.assertFalse(manifest.is_stale(page))
+
+    def test_changed_settings_stale(self):
+        """Changing a setting used in rendering makes outputs stale"""
+        post = self.written(self.post())
+        self.manifest.save()
+        self.settings['output']['fsync'] = 'file'
+        self.assertFalse(self.load().is_stale(post))
+        self.settings['site']['title'] = 'A new title'
+        self.assertTrue(self.load().is_stale(post))
+
+    def test_save_load(self):
+        """Records are saved to and loaded from the output root"""
+        post = self.written(self.post())
+        self.manifest.save()
+        self.assertTrue(self.output.joinpath(BuildManifest.filename).exists())
+        self.assertFalse(self.load().is_stale(post))
+
+    def test_unchanged_source_hash(self):
+        """Source hashes are reused while size and mtime are the same"""
+        post = self.post()
+        self.assertIsNone(self.manifest.unchanged_source_hash(post))
+        source_hash = self.written(post).source_hash
+        self.manifest.save()
+
+        manifest = self.load()
+        self.assertEqual(manifest.unchanged_source_hash(self.post()),
+                         source_hash)
+        self.source.write_text(
+            'title: A post\ndate: 2015-01-01 12:00\n\nNew body')
+        self.assertIsNone(manifest.unchanged_source_hash(self.post()))
+
+    def test_unchanged_source_hash_not_computed(self):
+        """Hashes are only stored if they were computed in the build"""
+        self.manifest.unchanged_source_hash(self.post())
+        self.manifest.save()
+        self.assertIsNone(self.load().unchanged_source_hash(self.post()))
+
+    def test_save_fsync(self):
+        """With output -> fsync set to "file" the manifest is flushed"""
+        self.written(self.post())
+        with mock.patch('os.fsync') as fsync:
+            self.manifest.save()
+            fsync.assert_not_called()
+            self.settings['output']['fsync'] = 'file'
+            self.load().save()
+        self.assertEqual(fsync.call_count, 2)
+
+    def test_settings_fingerprint(self):
+        """The settings fingerprint covers extensions' source"""
+        self.settings['paths']['extensions root'] = str(self.temp_dir)
+        before = settings_fingerprint(self.settings)
+        self.assertEqual(before, settings_fingerprint(self.settings))
+        self.temp_dir.joinpath('ext.py').write_text('x = 1')
+        self.assertNotEqual(before, settings_fingerprint(self.settings))
+
+    def test_settings_fingerprint_build_options(self):
+        """Options that only affect how the build runs are left out"""
+        before = settings_fingerprint(self.settings)
+        self.settings['jinja']['bytecode cache'] = str(self.temp_dir)
+        self.settings['paths']['cache root'] = str(self.temp_dir)
+        self.assertEqual(before, settings_fingerprint(self.settings))
+        self.settings['paths']['templates root'] = str(self.temp_dir)
+        self.assertNotEqual(before, settings_fingerprint(self.settings))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
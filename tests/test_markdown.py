@@ -3,12 +3,17 @@ import unittest
 import majestic
 import majestic.md as md
 
+from pathlib import Path
+import shutil
+import tempfile
+from unittest import mock
+
 
 class TestMarkdown(unittest.TestCase):
     """Test the majestic package's markdown module"""
     def setUp(self):
         self.settings = majestic.load_settings(local=False)
-        md._reset_cached_markdown()
+        md.reset_cached_markdown()
 
     def test_get_markdown(self):
         """get_markdown returns a Markdown instance"""
@@ -47,5 +52,58 @@ class TestMarkdown(unittest.TestCase):
         self.assertEqual(expected, rendered)
 
 
+class TestMarkdownCache(unittest.TestCase):
+    """Test converting markdown with the html render cache"""
+    def setUp(self):
+        self.settings = majestic.load_settings(local=False)
+        self.cache_dir = Path(tempfile.mkdtemp())
+        self.settings['paths']['cache root'] = str(self.cache_dir)
+        self.settings['cache']['rendered html'] = True
+        md.reset_cached_markdown()
+
+    def tearDown(self):
+        md.reset_cached_markdown()
+        shutil.rmtree(str(self.cache_dir))
+
+    def test_get_html_cache_disabled(self):
+        """get_html_cache returns None unless the cache is enabled"""
+        self.settings['cache']['rendered html'] = False
+        self.assertIsNone(md.get_html_cache(self.settings))
+
+    def test_convert_uses_cache(self):
+        """Converted html is reused without invoking markdown"""
+        self.assertEqual(md.convert('*abc*', self.settings),
+                         '<p><em>abc</em></p>')
+        md.reset_cached_markdown()
+        with mock.patch.object(md, 'get_markdown') as get_markdown:
+            html = md.convert('*abc*', self.settings)
+        get_markdown.assert_not_called()
+        self.assertEqual(html, '<p><em>abc</em></p>')
+
+    def test_fingerprint_extension_config(self):
+        """Changing the markdown extensions changes the fingerprint"""
+        before = md.markdown_fingerprint(self.settings)
+        self.settings['markdown']['extensions'].update(
+            {'markdown.extensions.smarty': {}})
+        self.assertNotEqual(before, md.markdown_fingerprint(self.settings))
+
+    def test_custom_extension_config_not_removed(self):
+        """get_markdown doesn't remove custom extension configuration"""
+        class ConfigExtension(md.Extension):
+            def __init__(self, **kwargs):
+                self.config = {'option': ['default', '']}
+                super().__init__(**kwargs)
+
+            def extendMarkdown(self, md, md_globals):
+                pass
+
+        configs = self.settings['markdown']['extensions']
+        configs['ConfigExtension'] = {'option': 'custom'}
+        with mock.patch.object(md, 'load_custom_markdown_extensions',
+                               return_value=[ConfigExtension]):
+            md.get_markdown(self.settings)
+        self.assertEqual(configs['ConfigExtension'], {'option': 'custom'})
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
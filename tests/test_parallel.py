@@ -0,0 +1,183 @@
+import unittest
+from majestic import load_settings
+from majestic.content import Post, Page
+import majestic.md as md
+from majestic.parallel import (
+    parse_content_files, render_html, render_to_disk, worker_count
+    )
+from majestic.templating import jinja_environment
+from majestic.utils import markdown_files
+
+import contextlib
+import io
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+
+
+TESTS_DIR = Path(__file__).resolve().parent
+TEST_BLOG_DIR = TESTS_DIR.joinpath('test-blog')
+
+
+class TestParseContentFiles(unittest.TestCase):
+    """Test parsing source files with a pool of worker processes"""
+    def setUp(self):
+        os.chdir(str(TEST_BLOG_DIR))
+        settings_path = TEST_BLOG_DIR.joinpath('settings.json')
+        self.settings = load_settings(files=[settings_path], local=False)
+        self.post_files = sorted(
+            markdown_files(TEST_BLOG_DIR.joinpath('posts')))
+
+    def parse(self, class_, files, jobs):
+        """Parse files, discarding the draft messages on stderr"""
+        with contextlib.redirect_stderr(io.StringIO()):
+            return parse_content_files(class_, files, self.settings, jobs)
+
+    def test_worker_count(self):
+        """worker_count uses one process per CPU when given 0 or None"""
+        self.assertEqual(worker_count(3), 3)
+        self.assertEqual(worker_count(0), os.cpu_count())
+        self.assertEqual(worker_count(None), os.cpu_count())
+
+    def test_parallel_matches_serial(self):
+        """Parsing in worker processes gives the same posts as serially"""
+        serial = self.parse(Post, self.post_files, jobs=1)
+        parallel = self.parse(Post, self.post_files, jobs=3)
+        self.assertEqual(serial, parallel)
+
+    def test_parallel_sort_order(self):
+        """Sorting parallel results matches sorting serial results"""
+        serial = sorted(self.parse(Post, self.post_files, jobs=1))
+        parallel = sorted(self.parse(Post, self.post_files, jobs=3))
+        self.assertEqual([p.source_path for p in serial],
+                         [p.source_path for p in parallel])
+
+    def test_parallel_shares_settings(self):
+        """Objects from worker processes use the caller's settings"""
+        for post in self.parse(Post, self.post_files, jobs=2):
+            self.assertIs(post._settings, self.settings)
+
+    def test_parallel_reports_drafts(self):
+        """Draft files are reported on stderr and left out"""
+        draft = TEST_BLOG_DIR.joinpath('posts', 'test_explicit_draft.md')
+        about = TEST_BLOG_DIR.joinpath('pages', 'about.md')
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            result = parse_content_files(Page, [draft, about],
+                                         self.settings, jobs=2)
+        self.assertEqual([p.source_path for p in result], [about])
+        self.assertIn('{0} is marked as a draft'.format(draft),
+                      stderr.getvalue())
+
+
+class TestRenderHTML(unittest.TestCase):
+    """Test converting markdown with a pool of worker processes"""
+    def setUp(self):
+        os.chdir(str(TEST_BLOG_DIR))
+        settings_path = TEST_BLOG_DIR.joinpath('settings.json')
+        self.settings = load_settings(files=[settings_path], local=False)
+        self.settings['markdown']['extensions'].update(
+            {'markdown.extensions.smarty': {}})
+        md.reset_cached_markdown()
+        self.bodies = ["'{0}' [link][{0}]\n\n[{0}]: /{0}".format(n)
+                       for n in range(20)]
+        self.pages = [Page(title=str(n), body=body, settings=self.settings)
+                      for n, body in enumerate(self.bodies)]
+
+    def tearDown(self):
+        md.reset_cached_markdown()
+
+    def test_render_html_matches_serial(self):
+        """html converted by workers matches serial conversion"""
+        render_html(self.pages, self.settings, jobs=3)
+        for page in self.pages:
+            self.assertTrue(hasattr(page, '_html'))
+        expected = [md.convert(body, self.settings) for body in self.bodies]
+        self.assertEqual([p.html for p in self.pages], expected)
+        self.assertIn('&lsquo;', self.pages[0].html)    # smarty was used
+
+    def test_render_html_single_job(self):
+        """With one job html is left to be converted when accessed"""
+        render_html(self.pages, self.settings, jobs=1)
+        for page in self.pages:
+            self.assertFalse(hasattr(page, '_html'))
+
+    def test_render_html_skips_rendered(self):
+        """Objects that already have html are not converted again"""
+        self.pages[0].html = 'existing'
+        render_html(self.pages + self.pages[:1], self.settings, jobs=2)
+        self.assertEqual(self.pages[0].html, 'existing')
+
+
+class TestRenderToDisk(unittest.TestCase):
+    """Test rendering objects to disk with a pool of worker processes"""
+    def setUp(self):
+        os.chdir(str(TEST_BLOG_DIR))
+        settings_path = TEST_BLOG_DIR.joinpath('settings.json')
+        self.settings = load_settings(files=[settings_path], local=False)
+        self.output_dir = Path(tempfile.mkdtemp())
+        self.settings['paths']['output root'] = str(self.output_dir)
+        self.env = jinja_environment(
+            user_templates=self.settings['paths']['templates root'],
+            settings=self.settings)
+        self.pages = [Page(title=str(n), body='*{0}*'.format(n),
+                           slug='page-{0}'.format(n), settings=self.settings)
+                      for n in range(8)]
+
+    def tearDown(self):
+        shutil.rmtree(str(self.output_dir))
+
+    def render(self, objects, jobs, serial=()):
+        render_to_disk(objects, environment=self.env, settings=self.settings,
+                       jobs=jobs, serial=serial,
+                       all_posts=[], all_pages=self.pages)
+
+    def read_all(self, objects):
+        return [obj.output_path.read_text() for obj in objects]
+
+    def test_parallel_matches_serial(self):
+        """Files rendered by workers match those rendered serially"""
+        self.render(self.pages, jobs=1)
+        serial = self.read_all(self.pages)
+        for page in self.pages:
+            page.output_path.unlink()
+        self.render(self.pages, jobs=3)
+        self.assertEqual(self.read_all(self.pages), serial)
+
+    def test_unpicklable_rendered_serially(self):
+        """Objects that can't be sent to a worker are rendered here
+
+        The page is a majestic Page, so it is sent to the pool, but
+        the lock in its metadata can't be pickled. Its batch is then
+        rendered again in this process.
+        """
+        page = Page(title='locked', body='*locked*', slug='locked',
+                    settings=self.settings, lock=threading.Lock())
+        objects = self.pages + [page]
+        self.render(objects, jobs=1)
+        serial = self.read_all(objects)
+        for obj in objects:
+            obj.output_path.unlink()
+        self.render(objects, jobs=2)
+        self.assertEqual(self.read_all(objects), serial)
+
+    def test_serial_objects_not_sent(self):
+        """Objects given as serial are rendered in this process"""
+        rendered = []
+
+        class RecordingPage(Page):
+            def render_to_disk(self, *args, **kwargs):
+                rendered.append(self)
+                return super().render_to_disk(*args, **kwargs)
+
+        page = RecordingPage(title='local', body='', slug='local',
+                             settings=self.settings)
+        self.render(self.pages + [page], jobs=2, serial=[self.pages[0]])
+        self.assertEqual(rendered, [page])
+        self.assertTrue(self.pages[0].output_path.exists())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -2,16 +2,22 @@ import unittest
 from majestic import load_settings
 from majestic.content import Post, Page
 from majestic.collections import (
-    PostsCollection, Archives, Index, RSSFeed, JSONFeed, Sitemap
+    PostsCollection, Archives, Index, RSSFeed, JSONFeed, Sitemap,
+    SortedPosts, YearArchives, MonthArchives
     )
+from majestic.templating import jinja_environment
 from majestic.utils import absolute_urls
 
 from datetime import datetime, timedelta
 import json
 import os
 from pathlib import Path
+import pickle
 import random
 import shutil
+import tempfile
+import tracemalloc
+from unittest import mock
 from urllib.parse import urljoin
 
 import pytz
@@ -78,6 +84,36 @@ class TestIndex(unittest.TestCase):
             for attribute in attr_list:
                 self.assertTrue(hasattr(index, attribute))
 
+    def test_Index_source_hash(self):
+        """Only indexes showing a changed post have a new source hash"""
+        for post in self.posts:
+            post.source_hash = post.title
+        before = [i.source_hash for i in
+                  Index.paginate_posts(posts=self.posts,
+                                       settings=self.settings)]
+        self.posts[0].source_hash = 'changed'       # Oldest post, last page
+        after = [i.source_hash for i in
+                 Index.paginate_posts(posts=self.posts,
+                                      settings=self.settings)]
+        self.assertEqual(before[:2], after[:2])
+        self.assertNotEqual(before[2], after[2])
+
+    def test_Index_source_hash_neighbours(self):
+        """An index's source hash covers the links to its neighbours"""
+        for post in self.posts:
+            post.source_hash = post.title
+        first, second, last = Index.paginate_posts(posts=self.posts,
+                                                   settings=self.settings)
+        before = second.source_hash
+        second.older_index_url = None
+        self.assertNotEqual(second.source_hash, before)
+
+    def test_Index_source_hash_no_source(self):
+        """Indexes with posts that have no source file have no hash"""
+        index = Index(page_number=1, posts=self.posts,
+                      settings=self.settings)
+        self.assertIsNone(index.source_hash)
+
     def test_Index_output_path(self):
         """Index properly sets output path"""
         self.settings['paths']['output root'] = ''
@@ -184,6 +220,139 @@ class TestArchives(unittest.TestCase):
         self.assertEqual(arch._path_template_key, 'archives path template')
         self.assertEqual(arch._template_file_key, 'archives')
 
+    def test_Archives_partition_default(self):
+        """By default partition_posts returns one page of every post"""
+        pages = Archives.partition_posts(posts=self.posts,
+                                         settings=self.settings)
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(pages[0].posts, sorted(self.posts, reverse=True))
+        self.assertEqual(pages[0].url, 'http://www.example.com/archives/')
+        self.assertIsNone(pages[0].older_page_url)
+
+    def test_Archives_paginate_posts(self):
+        """Archives can be split into linked pages"""
+        self.settings['archives']['posts per page'] = 15
+        first, second, last = Archives.paginate_posts(
+            posts=self.posts, settings=self.settings)
+        self.assertEqual([len(p.posts) for p in [first, second, last]],
+                         [15, 15, 10])
+        self.assertEqual(
+            second.url, 'http://www.example.com/archives/page-2/')
+        self.assertEqual(first.older_page_url, second.url)
+        self.assertEqual(second.newer_page_url, first.url)
+        self.assertEqual(second.older_page_url, last.url)
+        self.assertIsNone(last.older_page_url)
+
+    def test_Archives_partition_periods(self):
+        """partition_posts creates archives of each year and month"""
+        self.settings['archives']['years'] = True
+        self.settings['archives']['months'] = True
+        old_post = Post(title='old post', body='', settings=self.settings,
+                        date=datetime(2014, 12, 31, 23))
+        posts = SortedPosts(self.posts + [old_post])
+        everything, *periods = Archives.partition_posts(
+            posts=posts, settings=self.settings)
+        self.assertEqual(len(everything.posts), 41)
+        self.assertEqual(
+            [(type(p), p.date.year, p.date.month, len(p.posts), p.url)
+             for p in periods],
+            [(YearArchives, 2015, 1, 40, 'http://www.example.com/2015/'),
+             (YearArchives, 2014, 1, 1, 'http://www.example.com/2014/'),
+             (MonthArchives, 2015, 9, 22,
+              'http://www.example.com/2015/09/'),
+             (MonthArchives, 2015, 8, 18,
+              'http://www.example.com/2015/08/'),
+             (MonthArchives, 2014, 12, 1,
+              'http://www.example.com/2014/12/')])
+        year_2015, year_2014, september, august, december = periods
+        self.assertEqual(year_2015.older_period_url, year_2014.url)
+        self.assertEqual(august.newer_period_url, september.url)
+        self.assertEqual(august.older_period_url, december.url)
+        self.assertEqual(list(august.posts), list(posts[22:40]))
+        for page in periods:
+            self.assertIs(page.posts._posts, posts._posts)
+
+    def test_Archives_partition_paginated_periods(self):
+        """Each period's archives are split into pages"""
+        self.settings['archives']['months'] = True
+        self.settings['archives']['posts per page'] = 10
+        pages = Archives.partition_posts(posts=self.posts,
+                                         settings=self.settings)
+        months = [p for p in pages if isinstance(p, MonthArchives)]
+        self.assertEqual([(p.date.month, p.page_number) for p in months],
+                         [(9, 1), (9, 2), (9, 3), (8, 1), (8, 2)])
+        self.assertEqual(months[1].url,
+                         'http://www.example.com/2015/09/page-2/')
+        self.assertEqual(months[4].newer_period_url, months[0].url)
+
+    def test_PeriodArchives_source_hash(self):
+        """Only period archives holding a changed post have a new hash"""
+        self.settings['archives']['months'] = True
+        for post in self.posts:
+            post.source_hash = post.title
+        before = [p.source_hash for p in Archives.partition_posts(
+            posts=self.posts, settings=self.settings)]
+        min(self.posts).source_hash = 'changed'     # Oldest, in August
+        after = [p.source_hash for p in Archives.partition_posts(
+            posts=self.posts, settings=self.settings)]
+        everything, september, august = zip(before, after)
+        self.assertNotEqual(*everything)
+        self.assertEqual(*september)
+        self.assertNotEqual(*august)
+
+    def test_PeriodArchives_templates(self):
+        """Period archives use the archives template unless given their own
+
+        Only those with a template of their own don't show the listing
+        of every post (see BuildManifest.fingerprint).
+        """
+        self.settings['archives']['years'] = True
+        self.settings['archives']['months'] = True
+        self.settings['templates']['month archives'] = 'month.html'
+        pages = Archives.partition_posts(posts=self.posts,
+                                         settings=self.settings)
+        year = [p for p in pages if isinstance(p, YearArchives)][0]
+        month = [p for p in pages if isinstance(p, MonthArchives)][0]
+        self.assertEqual(year.template_name,
+                         self.settings['templates']['archives'])
+        self.assertTrue(year.shows_listing)
+        self.assertEqual(month.template_name, 'month.html')
+        self.assertFalse(month.shows_listing)
+
+    def test_Archives_render_streams_to_disk(self):
+        """Rendering archives doesn't hold the whole document in memory
+
+        The peak memory allocated while rendering should be a small
+        fraction of the size of the file written.
+        """
+        os.chdir(str(TEST_BLOG_DIR))
+        output_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, str(output_dir))
+        self.settings['paths']['output root'] = str(output_dir)
+        starting_date = datetime(2015, 9, 22, 19)
+        posts = [Post(title='A long post title {0} '.format(i) + 'x' * 200,
+                      body='', date=starting_date - timedelta(i),
+                      settings=self.settings)
+                 for i in range(3000)]
+        for post in posts:
+            post.url                        # Cache urls before measuring
+        env = jinja_environment(
+            user_templates=self.settings['paths']['templates root'],
+            settings=self.settings)
+        env.get_template(self.settings['templates']['archives'])
+        arch = Archives(posts=posts, settings=self.settings)
+
+        tracemalloc.start()
+        try:
+            arch.render_to_disk(env, all_posts=arch.posts)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        size = arch.output_path.stat().st_size
+        self.assertGreater(size, 500000)
+        self.assertLess(peak, size / 10)
+
 
 class TestPostsCollection(unittest.TestCase):
     """Test the PostsCollection base class
@@ -223,6 +392,79 @@ class TestPostsCollection(unittest.TestCase):
             self.assertEqual(post, sorted_posts[idx])
 
 
+class TestSortedPosts(unittest.TestCase):
+    """Test the shared, immutable newest-first sequence of posts"""
+    def setUp(self):
+        settings_path = TEST_BLOG_DIR.joinpath('settings.json')
+        self.settings = load_settings(files=[settings_path],
+                                      local=False)
+        self.settings['index']['posts per page'] = 3
+        starting_date = datetime(2015, 9, 22, 19)
+        self.posts = [
+            Post(title='post {}'.format(i), body='Here’s some text!',
+                 date=starting_date - timedelta(i),
+                 settings=self.settings)
+            for i in range(10)
+            ]
+        self.expected = sorted(self.posts, reverse=True)
+        random.shuffle(self.posts)      # Ensure not sorted
+        self.sorted_posts = SortedPosts(self.posts)
+
+    def test_sorted(self):
+        """SortedPosts holds the posts newest-first"""
+        self.assertEqual(list(self.sorted_posts), self.expected)
+        self.assertEqual(self.sorted_posts, self.expected)
+        self.assertEqual(len(self.sorted_posts), 10)
+        self.assertEqual(self.sorted_posts[-1], self.expected[-1])
+        with self.assertRaises(IndexError):
+            self.sorted_posts[10]
+
+    def test_immutable(self):
+        """SortedPosts can't be changed"""
+        with self.assertRaises(TypeError):
+            self.sorted_posts[0] = self.posts[0]
+        self.assertFalse(hasattr(self.sorted_posts, 'sort'))
+        self.posts.clear()
+        self.assertEqual(len(self.sorted_posts), 10)
+
+    def test_slices_are_views(self):
+        """Slices share the posts and are sliced relative to the view"""
+        view = self.sorted_posts[2:8]
+        self.assertIsInstance(view, SortedPosts)
+        self.assertIs(view._posts, self.sorted_posts._posts)
+        self.assertEqual(view, self.expected[2:8])
+        self.assertEqual(view[1:-1], self.expected[3:7])
+        self.assertEqual(view[::2], tuple(self.expected[2:8:2]))
+        self.assertEqual(self.sorted_posts[8:2], [])
+
+    def test_pickle_view(self):
+        """Only the posts in view are pickled"""
+        view = self.sorted_posts[:2]
+        self.assertEqual(pickle.loads(pickle.dumps(view)), view)
+        self.assertLess(len(pickle.dumps(view)),
+                        len(pickle.dumps(self.sorted_posts)))
+
+    def test_collections_do_not_sort(self):
+        """Collections given a SortedPosts use it without sorting"""
+        with mock.patch.object(Post, '__lt__') as less_than:
+            indexes = Index.paginate_posts(posts=self.sorted_posts,
+                                           settings=self.settings)
+            archives = Archives(posts=self.sorted_posts,
+                                settings=self.settings)
+            feed = RSSFeed(posts=self.sorted_posts, settings=self.settings)
+        less_than.assert_not_called()
+        self.assertEqual([post for index in indexes for post in index],
+                         self.expected)
+        self.assertIs(archives.posts._posts, self.sorted_posts._posts)
+        self.assertIs(feed.posts._posts, self.sorted_posts._posts)
+
+    def test_feed_partial_selection(self):
+        """Feeds pick the newest posts from an unsorted list"""
+        self.settings['feeds']['number of posts'] = 4
+        feed = JSONFeed(posts=self.posts, settings=self.settings)
+        self.assertEqual(feed.posts, self.expected[:4])
+
+
 class TestSitemap(unittest.TestCase):
     """Test the Sitemap class
 
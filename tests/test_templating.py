@@ -1,12 +1,19 @@
 import unittest
 from majestic import load_settings
-from majestic.templating import jinja_environment, rfc822_date
+from majestic.templating import (
+    jinja_environment, rfc822_date, PruningBytecodeCache,
+    bytecode_cache_directory, prune_bytecode_cache,
+    compile_templates, compiled_templates_are_fresh, TemplateDependencies
+    )
 from majestic.utils import absolute_urls
 
 from datetime import datetime
 import locale
 import os
 from pathlib import Path
+import shutil
+import tempfile
+import time
 
 import pytz
 import jinja2
@@ -86,6 +93,196 @@ class TestTemplating(unittest.TestCase):
         self.assertEqual(env.filters['absolute_urls'], absolute_urls)
 
 
+class TestBytecodeCache(unittest.TestCase):
+    """Test the persistent jinja bytecode cache"""
+    def setUp(self):
+        os.chdir(str(TEST_BLOG_DIR))
+        settings_path = TEST_BLOG_DIR.joinpath('settings.json')
+        self.settings = load_settings(files=[settings_path], local=False)
+        self.cache_dir = Path(tempfile.mkdtemp())
+        self.settings['jinja']['bytecode cache'] = str(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.cache_dir))
+
+    def environment(self):
+        return jinja_environment(
+            user_templates=self.settings['paths']['templates root'],
+            settings=self.settings)
+
+    def test_bytecode_cache_directory(self):
+        """bytecode_cache_directory interprets jinja -> bytecode cache"""
+        self.assertEqual(bytecode_cache_directory(self.settings),
+                         self.cache_dir)
+        self.settings['jinja']['bytecode cache'] = True
+        self.assertEqual(
+            bytecode_cache_directory(self.settings),
+            Path(self.settings['paths']['cache root'], 'jinja'))
+        for disabled in [None, False]:
+            self.settings['jinja']['bytecode cache'] = disabled
+            self.assertIsNone(bytecode_cache_directory(self.settings))
+
+    def test_bytecode_cache_disabled_by_default(self):
+        """jinja_environment doesn't use a bytecode cache by default"""
+        self.settings['jinja']['bytecode cache'] = None
+        self.assertIsNone(self.environment().bytecode_cache)
+
+    def test_bytecode_cache_stores_templates(self):
+        """Compiled templates are written to the cache directory"""
+        env = self.environment()
+        self.assertIsInstance(env.bytecode_cache, PruningBytecodeCache)
+        env.get_template('page.html')
+        self.assertEqual(len(list(self.cache_dir.iterdir())), 1)
+
+    def test_bytecode_cache_prune(self):
+        """Entries not belonging to a current template are removed"""
+        env = self.environment()
+        env.get_template('page.html')
+        stale = self.cache_dir.joinpath(
+            env.bytecode_cache.pattern % 'deleted-template')
+        stale.touch()
+        unrelated = self.cache_dir.joinpath('unrelated.txt')
+        unrelated.touch()
+        prune_bytecode_cache(env)
+        remaining = set(self.cache_dir.iterdir())
+        self.assertEqual(len(remaining), 2)
+        self.assertNotIn(stale, remaining)
+        self.assertIn(unrelated, remaining)
+
+
+class TestCompileTemplates(unittest.TestCase):
+    """Test compiling templates ahead of time into a module bundle"""
+    def setUp(self):
+        os.chdir(str(TEST_BLOG_DIR))
+        settings_path = TEST_BLOG_DIR.joinpath('settings.json')
+        self.settings = load_settings(files=[settings_path], local=False)
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.templates = self.temp_dir.joinpath('templates')
+        shutil.copytree(self.settings['paths']['templates root'],
+                        str(self.templates))
+        self.settings['paths']['cache root'] = str(
+            self.temp_dir.joinpath('cache'))
+
+    def tearDown(self):
+        shutil.rmtree(str(self.temp_dir))
+
+    def environment(self):
+        return jinja_environment(user_templates=self.templates,
+                                 settings=self.settings)
+
+    def test_compile_templates_bundle(self):
+        """compile_templates writes a bundle that is then used"""
+        self.assertFalse(
+            compiled_templates_are_fresh(self.templates, self.settings))
+        bundle = compile_templates(self.templates, self.settings)
+        self.assertTrue(bundle.exists())
+        self.assertTrue(
+            compiled_templates_are_fresh(self.templates, self.settings))
+        env = self.environment()
+        self.assertIsInstance(env.loader, jinja2.ModuleLoader)
+        for name in ['page.html', 'majestic-rss.xml']:
+            self.assertEqual(env.get_template(name).name, name)
+
+    def test_compiled_templates_render(self):
+        """Templates loaded from the bundle render as from source"""
+        source_env = self.environment()
+        compile_templates(self.templates, self.settings)
+        compiled_env = self.environment()
+        self.assertIsInstance(compiled_env.loader, jinja2.ModuleLoader)
+        for env in [source_env, compiled_env]:
+            rendered = env.get_template('archives.html').render(
+                all_posts=[])
+            self.assertIn('<h1>Index</h1>', rendered)
+
+    def test_compiled_templates_stale(self):
+        """The bundle is not used after a template is edited"""
+        compile_templates(self.templates, self.settings)
+        page = self.templates.joinpath('page.html')
+        page.write_text(page.read_text() + '\n')
+        self.assertFalse(
+            compiled_templates_are_fresh(self.templates, self.settings))
+        self.assertIsInstance(self.environment().loader,
+                              jinja2.FileSystemLoader)
+
+    def test_compiled_templates_restored(self):
+        """A bundle restored elsewhere with new mtimes is still fresh"""
+        compile_templates(self.templates, self.settings)
+        restored = self.temp_dir.joinpath('checkout', 'templates')
+        shutil.copytree(str(self.templates), str(restored))
+        future = time.time() + 100
+        for path in restored.iterdir():
+            os.utime(str(path), (future, future))
+        self.assertTrue(
+            compiled_templates_are_fresh(restored, self.settings))
+
+    def test_compiled_templates_stale_options(self):
+        """The bundle is not used after jinja options change"""
+        compile_templates(self.templates, self.settings)
+        self.settings['jinja']['trim_blocks'] = True
+        self.assertFalse(
+            compiled_templates_are_fresh(self.templates, self.settings))
+
+
+class TestTemplateDependencies(unittest.TestCase):
+    """Test finding the templates used to render each template"""
+    def setUp(self):
+        os.chdir(str(TEST_BLOG_DIR))
+        settings_path = TEST_BLOG_DIR.joinpath('settings.json')
+        self.settings = load_settings(files=[settings_path], local=False)
+        self.temp_dir = Path(tempfile.mkdtemp())
+        self.templates = self.temp_dir.joinpath('templates')
+        self.templates.mkdir()
+        sources = {
+            'base.html': '{% block body %}{% endblock %}',
+            'post.html': ('{% extends "base.html" %}{% block body %}'
+                          '{% include "byline.html" %}{% endblock %}'),
+            'byline.html': '{% import "macros.html" as m %}',
+            'macros.html': '{% macro x() %}{% endmacro %}',
+            'page.html': 'Page',
+            'dynamic.html': '{% include name %}',
+            }
+        for name, source in sources.items():
+            self.templates.joinpath(name).write_text(source)
+        self.deps = TemplateDependencies(self.templates, self.settings)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.temp_dir))
+
+    def test_dependencies(self):
+        """Extended, included and imported templates are dependencies"""
+        self.assertEqual(
+            self.deps.dependencies('post.html'),
+            ['base.html', 'byline.html', 'macros.html', 'post.html'])
+        self.assertEqual(self.deps.dependencies('page.html'), ['page.html'])
+
+    def test_dependencies_dynamic(self):
+        """A dynamic include depends on every template"""
+        self.assertEqual(len(self.deps.dependencies('dynamic.html')),
+                         len(list(self.templates.iterdir())) + 2)
+
+    def test_fingerprint_unchanged(self):
+        """Fingerprints are the same for unchanged templates"""
+        other = TemplateDependencies(self.templates, self.settings)
+        self.assertEqual(self.deps.fingerprint('post.html'),
+                         other.fingerprint('post.html'))
+
+    def test_fingerprint_edited_dependency(self):
+        """Editing a template changes only the fingerprints that use it"""
+        post = self.deps.fingerprint('post.html')
+        page = self.deps.fingerprint('page.html')
+        self.templates.joinpath('macros.html').write_text('')
+        other = TemplateDependencies(self.templates, self.settings)
+        self.assertNotEqual(other.fingerprint('post.html'), post)
+        self.assertEqual(other.fingerprint('page.html'), page)
+
+    def test_fingerprint_ignores_mtime(self):
+        """Touching a template doesn't change its fingerprint"""
+        post = self.deps.fingerprint('post.html')
+        os.utime(str(self.templates.joinpath('macros.html')))
+        other = TemplateDependencies(self.templates, self.settings)
+        self.assertEqual(other.fingerprint('post.html'), post)
+
+
 class TestRFC822Date(unittest.TestCase):
     """Test the rfc822_date function"""
     def test_rfc822_date_basic(self):
@@ -1,7 +1,12 @@
 import unittest
 import majestic.utils as utils
 
+import os
+from pathlib import Path
+import shutil
 import string
+import tempfile
+from unittest import mock
 
 
 class TestSlugFunctions(unittest.TestCase):
@@ -149,6 +154,102 @@ class TestChunk(unittest.TestCase):
         self.assertEqual(expected, list(result))
 
 
+class TestWriteFile(unittest.TestCase):
+    """Test write_file, which can skip writing unchanged contents"""
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        self.path = self.dir.joinpath('sub', 'file.txt')
+
+    def tearDown(self):
+        shutil.rmtree(str(self.dir))
+
+    def write(self, text, **kwargs):
+        return utils.write_file(self.path, lambda f: f.write(text), **kwargs)
+
+    def age_file(self):
+        """Set the file's mtime in the past and return it"""
+        os.utime(str(self.path), ns=(0, 10 ** 9))
+        return self.path.stat().st_mtime_ns
+
+    def test_write_file_creates_parents(self):
+        """write_file creates missing directories and writes the file"""
+        self.assertTrue(self.write('abc'))
+        self.assertEqual(self.path.read_text(), 'abc')
+
+    def test_write_file_always_writes(self):
+        """Without only_if_changed the file is always rewritten"""
+        self.write('abc')
+        mtime = self.age_file()
+        self.assertTrue(self.write('abc'))
+        self.assertNotEqual(self.path.stat().st_mtime_ns, mtime)
+
+    def test_write_file_skips_unchanged(self):
+        """Identical contents are not written when only_if_changed"""
+        self.write('abc')
+        mtime = self.age_file()
+        self.assertFalse(self.write('abc', only_if_changed=True))
+        self.assertEqual(self.path.stat().st_mtime_ns, mtime)
+        self.assertEqual(list(self.path.parent.iterdir()), [self.path])
+
+    def test_write_file_replaces_changed(self):
+        """Different contents are written when only_if_changed"""
+        self.write('abc')
+        self.assertTrue(self.write('abd', only_if_changed=True))
+        self.assertEqual(self.path.read_text(), 'abd')
+        self.assertEqual(list(self.path.parent.iterdir()), [self.path])
+
+    def test_write_file_error_leaves_original(self):
+        """An error while writing leaves the existing file as it was"""
+        self.write('abc')
+
+        def fail(file):
+            file.write('partial')
+            raise ValueError
+
+        for only_if_changed in [False, True]:
+            with self.assertRaises(ValueError):
+                utils.write_file(self.path, fail,
+                                 only_if_changed=only_if_changed)
+            self.assertEqual(self.path.read_text(), 'abc')
+            self.assertEqual(list(self.path.parent.iterdir()), [self.path])
+
+    def test_write_file_replaces_atomically(self):
+        """The file is written elsewhere and renamed over path"""
+        self.write('abc')
+
+        def check_untouched(file):
+            self.assertEqual(self.path.read_text(), 'abc')
+            file.write('new')
+
+        utils.write_file(self.path, check_untouched)
+        self.assertEqual(self.path.read_text(), 'new')
+
+    def test_write_file_fsync(self):
+        """With fsync the file and its directory are flushed to disk"""
+        with mock.patch('os.fsync') as fsync:
+            self.write('abc')
+            fsync.assert_not_called()
+            self.write('abd', fsync=True)
+            self.assertEqual(fsync.call_count, 2)
+
+    def test_fsync_files(self):
+        """fsync_files flushes each file and each directory once"""
+        other = self.path.with_name('other')
+        self.write('abc')
+        other.write_text('def')
+        with mock.patch('os.fsync') as fsync:
+            utils.fsync_files([self.path, other])
+        self.assertEqual(fsync.call_count, 3)
+
+    def test_fsync_files_error(self):
+        """An error flushing a file names the file"""
+        self.write('abc')
+        with mock.patch('os.fsync', side_effect=OSError(5, 'I/O error')):
+            with self.assertRaises(OSError) as raised:
+                utils.fsync_files([self.path])
+        self.assertEqual(raised.exception.filename, str(self.path))
+
+
 class TestAbsoluteURLs(unittest.TestCase):
     """Test the absolute_urls function
 
@@ -199,3 +300,51 @@ class TestAbsoluteURLs(unittest.TestCase):
         '''.strip()
         result = utils.absolute_urls(html=html, base_url=self.base_url)
         self.assertEqual(expected, result)
+
+    def test_absolute_urls_poster(self):
+        """absolute_urls changes relative URLs in poster attributes"""
+        html = '<video poster="/still.jpg" src="/film.mp4"></video>'
+        expected = ('<video poster="http://example.com/still.jpg" '
+                    'src="http://example.com/film.mp4"></video>')
+        result = utils.absolute_urls(html=html, base_url=self.base_url)
+        self.assertEqual(expected, result)
+
+    def test_absolute_urls_leaves_absolute(self):
+        """absolute_urls doesn't change URLs that are already absolute"""
+        html = ('<a href="https://example.org/page">a</a>'
+                '<img src="//cdn.example.org/image.jpg">')
+        result = utils.absolute_urls(html=html, base_url=self.base_url)
+        self.assertEqual(html, result)
+
+    def test_absolute_urls_quoting(self):
+        """absolute_urls handles single-quoted and unquoted values
+
+        Unquoted values are quoted when rewritten, and entities in
+        values are decoded before the URL is resolved.
+        """
+        html = "<a href='/a'>a</a><a href=/b>b</a><a href=\"/c?x=1&amp;y\">"
+        expected = ("<a href='http://example.com/a'>a</a>"
+                    '<a href="http://example.com/b">b</a>'
+                    '<a href="http://example.com/c?x=1&amp;y">')
+        result = utils.absolute_urls(html=html, base_url=self.base_url)
+        self.assertEqual(expected, result)
+
+    def test_absolute_urls_markup_untouched(self):
+        """absolute_urls leaves other markup exactly as it was
+
+        This includes other attributes (even if they contain text
+        that looks like a URL attribute), comments, and the contents
+        of script elements.
+        """
+        html = '''\
+<!-- <a href="/commented"> -->
+<p class=x title='src="/not-a-url"' data-src="/data">Text &amp; <br></p>
+<script>var link = '<a href="/in-script">';</script>
+<IMG SRC="/upper.png" ALT="a > b">'''
+        expected = '''\
+<!-- <a href="/commented"> -->
+<p class=x title='src="/not-a-url"' data-src="/data">Text &amp; <br></p>
+<script>var link = '<a href="/in-script">';</script>
+<IMG SRC="http://example.com/upper.png" ALT="a > b">'''
+        result = utils.absolute_urls(html=html, base_url=self.base_url)
+        self.assertEqual(expected, result)
@@ -0,0 +1,121 @@
+import unittest
+from majestic import load_settings
+import majestic.watch as watch
+
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+from unittest import mock
+
+
+TESTS_DIR = Path(__file__).resolve().parent
+
+
+class WatcherTests(object):
+    """Tests shared by each kind of watcher
+
+    Subclasses set make_watcher to a function taking a list of paths.
+    """
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp()).resolve()
+        self.tree = self.directory.joinpath('posts')
+        self.tree.mkdir()
+        self.existing = self.tree.joinpath('existing.md')
+        self.existing.write_text('Existing')
+        self.settings_file = self.directory.joinpath('settings.json')
+        self.settings_file.write_text('{}')
+        self.watcher = self.make_watcher([self.tree, self.settings_file])
+        self.addCleanup(self.watcher.close)
+
+    def tearDown(self):
+        shutil.rmtree(str(self.directory))
+
+    def changes(self):
+        return self.watcher.changes(timeout=2)
+
+    def test_no_changes(self):
+        """An empty set is returned if nothing changes before the timeout"""
+        self.assertEqual(self.watcher.changes(timeout=0.1), set())
+
+    def test_create(self):
+        """Files created in a watched directory are reported"""
+        new = self.tree.joinpath('new.md')
+        new.write_text('New')
+        self.assertIn(new, self.changes())
+
+    def test_modify(self):
+        """Files modified in a watched directory are reported"""
+        self.existing.write_text('Changed contents')
+        self.assertIn(self.existing, self.changes())
+
+    def test_delete(self):
+        """Files deleted from a watched directory are reported"""
+        self.existing.unlink()
+        self.assertIn(self.existing, self.changes())
+
+    def test_new_subdirectory(self):
+        """Files in directories created after watching starts are reported"""
+        subdirectory = self.tree.joinpath('2017')
+        subdirectory.mkdir()
+        self.changes()
+        new = subdirectory.joinpath('new.md')
+        new.write_text('New')
+        self.assertIn(new, self.changes())
+
+    def test_watched_file(self):
+        """Changes to a watched file are reported, not its neighbours"""
+        self.directory.joinpath('unwatched.txt').write_text('Unwatched')
+        self.settings_file.write_text('{"changed": true}')
+        self.assertEqual(self.changes(), {self.settings_file})
+
+    def test_hidden_files_ignored(self):
+        """Changes to hidden and backup files are ignored"""
+        self.tree.joinpath('.existing.md.swp').write_text('Swap')
+        self.tree.joinpath('existing.md~').write_text('Backup')
+        self.assertEqual(self.watcher.changes(timeout=0.5), set())
+
+
+class TestPollingWatcher(WatcherTests, unittest.TestCase):
+    """Test watching for changes by polling"""
+    @staticmethod
+    def make_watcher(paths):
+        return watch.PollingWatcher(paths, interval=0.01)
+
+    def setUp(self):
+        super().setUp()
+        # Make sure modifications change the recorded modification time
+        stat = self.existing.stat()
+        os.utime(str(self.existing), ns=(stat.st_atime_ns,
+                                         stat.st_mtime_ns - 10 ** 9))
+        self.watcher._state = self.watcher._snapshot()
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'requires inotify')
+class TestInotifyWatcher(WatcherTests, unittest.TestCase):
+    """Test watching for changes with inotify"""
+    make_watcher = staticmethod(watch.InotifyWatcher)
+
+
+class TestSourcePaths(unittest.TestCase):
+    """Test finding the paths to watch for a site"""
+    def test_source_paths(self):
+        """Content, templates, extensions and settings files are watched"""
+        os.chdir(str(TESTS_DIR.joinpath('test-full')))
+        settings = load_settings()
+        paths = watch.source_paths(settings, ['settings.json'])
+        self.assertEqual(
+            [str(path) for path in paths],
+            ['posts', 'pages', 'templates', 'extensions', 'settings.json'])
+
+    def test_make_watcher(self):
+        """make_watcher falls back to polling if inotify is unavailable"""
+        with mock.patch.object(watch, 'InotifyWatcher',
+                               side_effect=OSError):
+            watcher = watch.make_watcher([TESTS_DIR])
+        self.assertIsInstance(watcher, watch.PollingWatcher)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)